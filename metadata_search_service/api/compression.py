@@ -0,0 +1,261 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ASGI middleware that compresses responses based on content-encoding negotiation"""
+
+import asyncio
+import zlib
+from typing import Callable, Dict, List, Optional, Protocol
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class StreamCompressor(Protocol):
+    """Compresses the body of a single response incrementally"""
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress a chunk of the body and return the output available so far"""
+        ...
+
+    def flush(self) -> bytes:
+        """Return the remaining output after the last chunk of the body"""
+        ...
+
+
+class _BrotliCompressor:
+    """Adapts the incremental brotli compressor to the StreamCompressor protocol"""
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress a chunk of the body"""
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        """Finish the brotli stream"""
+        return self._compressor.finish()
+
+
+def _gzip_compressor(level: int) -> Callable[[], StreamCompressor]:
+    # a window size of 16 + 15 bits writes a gzip header and trailer
+    return lambda: zlib.compressobj(min(max(level, 1), 9), zlib.DEFLATED, 31)
+
+
+def _brotli_compressor(level: int) -> Callable[[], StreamCompressor]:
+    return lambda: _BrotliCompressor(quality=min(max(level, 0), 11))
+
+
+def _zstd_compressor(level: int) -> Callable[[], StreamCompressor]:
+    return lambda: zstandard.ZstdCompressor(level=min(max(level, 1), 22)).compressobj()
+
+
+def compress_body(compressor: StreamCompressor, body: bytes, last: bool) -> bytes:
+    """
+    Compress a chunk of a response body.
+
+    Args:
+        compressor: The compressor of the response
+        body: The chunk of the body
+        last: Whether this is the last chunk of the body
+
+    Returns:
+        The compressed output that is available after this chunk
+    """
+    compressed = compressor.compress(body)
+    return compressed + compressor.flush() if last else compressed
+
+
+def get_compressors(level: int) -> Dict[str, Callable[[], StreamCompressor]]:
+    """
+    Get the compressors of all supported content-encodings,
+    in the order of preference.
+
+    The ``br`` and ``zstd`` encodings are only supported if the optional
+    ``brotli`` and ``zstandard`` packages are installed. Compressors are
+    not thread-safe, so every response creates its own one.
+
+    Args:
+        level: The compression level, which is limited to the range
+            of each encoding
+
+    Returns:
+        A dictionary that maps each content-encoding to a function
+        that creates a new compressor for it
+    """
+    compressors: Dict[str, Callable[[], StreamCompressor]] = {}
+    if zstandard is not None:
+        compressors["zstd"] = _zstd_compressor(level)
+    if brotli is not None:
+        compressors["br"] = _brotli_compressor(level)
+    compressors["gzip"] = _gzip_compressor(level)
+    return compressors
+
+
+def select_encoding(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """
+    Select the content-encoding for a response, based on the
+    ``Accept-Encoding`` header of the request.
+
+    Args:
+        accept_encoding: The value of the ``Accept-Encoding`` header
+        encodings: The supported content-encodings, in the order of preference
+
+    Returns:
+        The encoding with the highest quality value, or None if the client
+        does not accept any of the supported encodings
+    """
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+
+    best_encoding = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+    return best_encoding
+
+
+class CompressedResponse:  # pylint: disable=too-many-instance-attributes
+    """
+    Sends the messages of a single response, compressing its body
+    unless it is too small or encoded already.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        send: Send,
+        encoding: str,
+        create_compressor: Callable[[], StreamCompressor],
+        minimum_size: int,
+        offload_size: int,
+    ):
+        self.send = send
+        self.encoding = encoding
+        self.create_compressor = create_compressor
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.start_message: Optional[Message] = None
+        self.compressor: Optional[StreamCompressor] = None
+        self.passthrough = False
+
+    async def compress(self, body: bytes, last: bool) -> bytes:
+        """Compress a chunk of the body, in a worker thread if it is large"""
+        assert self.compressor is not None
+        if len(body) >= self.offload_size:
+            return await asyncio.to_thread(compress_body, self.compressor, body, last)
+        return compress_body(self.compressor, body, last)
+
+    async def __call__(self, message: Message) -> None:
+        if self.passthrough:
+            await self.send(message)
+            return
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            # the first body message decides whether to compress or not
+            assert self.start_message is not None
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            if "content-encoding" in headers or (
+                not more_body and len(body) < self.minimum_size
+            ):
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            self.compressor = self.create_compressor()
+            body = await self.compress(body, last=not more_body)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                # the length of a compressed stream is not known in advance
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(body))
+            await self.send(self.start_message)
+        else:
+            body = await self.compress(body, last=not more_body)
+        await self.send(
+            {"type": "http.response.body", "body": body, "more_body": more_body}
+        )
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with the best content-encoding that is accepted by
+    the client, among ``zstd``, ``br`` and ``gzip``.
+
+    Only responses with a body of at least ``minimum_size`` bytes are
+    compressed, while streaming responses are always compressed chunk by
+    chunk. Bodies and chunks of at least ``offload_size`` bytes are
+    compressed in a worker thread, so that compressing them does not block
+    the event loop.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        level: int = 5,
+        offload_size: int = 65536,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.compressors = get_compressors(level)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = select_encoding(
+            Headers(scope=scope).get("accept-encoding", ""), list(self.compressors)
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        response = CompressedResponse(
+            send,
+            encoding,
+            self.compressors[encoding],
+            minimum_size=self.minimum_size,
+            offload_size=self.offload_size,
+        )
+        await self.app(scope, receive, response)
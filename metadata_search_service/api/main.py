@@ -19,18 +19,199 @@ Additional endpoints might be structured in dedicated modules
 (each of them having a sub-router).
 """
 
-from fastapi import Depends, FastAPI, HTTPException
+import asyncio
+import contextlib
+import logging
+from typing import Any, Dict, List, Optional
+
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from ghga_service_chassis_lib.api import configure_app
 
+from metadata_search_service.api.compression import CompressionMiddleware
 from metadata_search_service.api.deps import get_config
+from metadata_search_service.api.responses import FastJSONResponse
 from metadata_search_service.config import CONFIG, Config
-from metadata_search_service.core.search import perform_search
-from metadata_search_service.models import DocumentType, SearchQuery, SearchResult
+from metadata_search_service.core.cache import DATA_VERSIONS, get_search_cache
+from metadata_search_service.core.documents import get_document_with_references
+from metadata_search_service.core.facets import refresh_facet_store
+from metadata_search_service.core.search import (
+    export_search,
+    get_search_etag,
+    perform_batch_search,
+    perform_federated_search,
+    perform_search,
+)
+from metadata_search_service.dao.backend import reads_metadata_store
+from metadata_search_service.dao.db import close_db, connect_db
+from metadata_search_service.dao.memory_index import clear_memory_indexes
+from metadata_search_service.dao.utils import (
+    InvalidCursorError,
+    InvalidReferenceError,
+    InvalidSortError,
+    can_convert_raw_bson,
+)
+from metadata_search_service.models import (
+    BatchSearchQuery,
+    BatchSearchResult,
+    Document,
+    DocumentType,
+    FederatedSearchResult,
+    FilterOption,
+    SearchQuery,
+    SearchResult,
+)
+from metadata_search_service.pubsub.main import watch_metadata_store
 
-# pylint: disable=too-many-arguments
+# pylint: disable=too-many-arguments, too-many-locals
 
 app = FastAPI()
 configure_app(app, config=CONFIG)
+if CONFIG.compress_responses:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=CONFIG.compression_minimum_size,
+        level=CONFIG.compression_level,
+        offload_size=CONFIG.compression_offload_size,
+    )
+
+
+@app.on_event("startup")
+async def startup():
+    """
+    Create the pooled database client shared by all requests
+    and start the background tasks that watch the metadata store
+    for changes and keep the precomputed facets up to date.
+    Changes also drop the snapshot of the in-memory index, if used.
+
+    Backends that search a prebuilt file, like the SQLite database or
+    the snapshot file of the in-memory index, do not need the metadata
+    store, so the service does not connect to it for them.
+
+    Raw BSON hits need python-bsonjs, so they are turned off without it.
+    """
+    app.state.background_tasks = []
+    if CONFIG.raw_bson_hits and not can_convert_raw_bson():
+        logging.warning(
+            "Raw BSON hits are turned off since python-bsonjs is not installed"
+        )
+    if not reads_metadata_store(CONFIG):
+        return
+    await connect_db(CONFIG)
+    if CONFIG.search_backend == "memory":
+        # take a new snapshot of the metadata store once it changes
+        DATA_VERSIONS.add_listener(lambda _: clear_memory_indexes())
+    if CONFIG.watch_changes:
+        app.state.background_tasks.append(
+            asyncio.create_task(watch_metadata_store(CONFIG))
+        )
+    if CONFIG.precompute_facets:
+        app.state.background_tasks.append(
+            asyncio.create_task(refresh_facet_store(CONFIG))
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Stop all background tasks, close the pooled database client
+    and log the usage of the search cache of this worker.
+    """
+    for task in app.state.background_tasks:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    close_db()
+    logging.info("Search cache usage: %s", get_search_cache(CONFIG).stats())
+
+
+def check_search_parameters(
+    skip: int, limit: int, max_facet_options: Optional[int]
+) -> None:
+    """
+    Check the pagination and facet parameters of a search.
+
+    Args:
+        skip: The number of documents to skip
+        limit: The total number of documents to retrieve
+        max_facet_options: The maximum number of options per facet
+
+    Raises:
+        HTTPException: If any of the parameters is out of range
+    """
+    if skip < 0:
+        raise HTTPException(
+            status_code=400,
+            detail="'skip' parameter must be greater than or equal to 0",
+        )
+    if limit < 0:
+        raise HTTPException(
+            status_code=400,
+            detail="'limit' parameter must be greater than or equal to 0",
+        )
+    if max_facet_options is not None and max_facet_options < 1:
+        raise HTTPException(
+            status_code=400,
+            detail="'max_facet_options' parameter must be greater than 0",
+        )
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    Parse a comma-separated list of fields.
+
+    Args:
+        fields: A comma-separated list of fields, like ``id,title,has_study.type``
+
+    Returns:
+        A list of fields, or None if no fields were given
+    """
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def parse_filters(filters: List[str]) -> List[FilterOption]:
+    """
+    Parse filters that are given as ``key:value``.
+
+    Args:
+        filters: A list of filters, like ``type:Exome sequencing``
+
+    Returns:
+        A list of filter options
+
+    Raises:
+        HTTPException: If a filter is not given as ``key:value``
+    """
+    filter_options = []
+    for query_filter in filters:
+        key, separator, value = query_filter.partition(":")
+        if not separator or not key:
+            raise HTTPException(
+                status_code=400,
+                detail="'filter' parameter must be given as 'key:value'",
+            )
+        filter_options.append(FilterOption(key=key, value=value))
+    return filter_options
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """
+    Check whether an entity tag matches the ``If-None-Match`` header
+    of a request, using the weak comparison.
+
+    Args:
+        etag: The entity tag of the current representation
+        if_none_match: The value of the ``If-None-Match`` header
+
+    Returns:
+        Whether or not the entity tag matches
+    """
+    candidates = [x.strip() for x in if_none_match.split(",")]
+    if "*" in candidates:
+        return True
+    return etag.removeprefix("W/") in {x.removeprefix("W/") for x in candidates}
 
 
 @app.get("/", summary="Index for Metadata Search Service")
@@ -50,28 +231,288 @@ async def search(
     return_facets: bool = False,
     skip: int = 0,
     limit: int = 10,
+    after: Optional[str] = None,
+    max_facet_options: Optional[int] = None,
+    disjunctive_facets: bool = False,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    sort: Optional[str] = None,
     config: Config = Depends(get_config),
 ):
-    """Search metadata based on a given query string and filters."""
-    if skip < 0:
+    """
+    Search metadata based on a given query string and filters.
+
+    The hits of a text search are sorted by relevance, all other hits in
+    the order of their insertion. With ``sort``, hits are sorted by one of
+    the configured sort fields instead, like ``title``, or ``-title`` for
+    descending order.
+
+    Instead of using ``skip``, deep pages can be retrieved efficiently
+    by passing the ``next_cursor`` of the previous page as ``after``.
+
+    Each facet returns its most frequent values, limited to
+    ``max_facet_options`` (or the configured maximum). With
+    ``disjunctive_facets``, the counts of each facet ignore the filters
+    on that facet field, so that multiple values can be selected.
+
+    Only the comma-separated ``fields`` are included in each hit, if given.
+    Otherwise, the configured default fields of the document type are used.
+    Use ``*`` to include all fields.
+
+    The references of the comma-separated reference fields in ``expand``,
+    like ``has_study,has_file``, are replaced by the referenced documents
+    in each hit.
+    """
+    check_search_parameters(skip=skip, limit=limit, max_facet_options=max_facet_options)
+    try:
+        response = await perform_search(
+            document_type=document_type,
+            search_query=query.query,
+            filters=query.filters,
+            return_facets=return_facets,
+            skip=skip,
+            limit=limit,
+            config=config,
+            after=after,
+            max_facet_options=max_facet_options,
+            disjunctive_facets=disjunctive_facets,
+            fields=parse_fields(fields),
+            expand=parse_fields(expand),
+            sort=sort,
+        )
+    except InvalidCursorError as exc:
         raise HTTPException(
             status_code=400,
-            detail="'skip' parameter must be greater than or equal to 0",
+            detail="'after' parameter must be a cursor returned by a previous search",
+        ) from exc
+    except (InvalidReferenceError, InvalidSortError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return FastJSONResponse(response)
+
+
+@app.get(
+    "/rpc/search",
+    summary="Search metadata by keywords and facets, cacheable",
+    response_model=SearchResult,
+    responses={304: {"description": "The cached search result is still valid"}},
+)
+async def search_get(
+    request: Request,
+    document_type: DocumentType,
+    query: str = "*",
+    filters: List[str] = Query(
+        [], alias="filter", description="A filter as 'key:value', can be repeated"
+    ),
+    return_facets: bool = False,
+    skip: int = 0,
+    limit: int = 10,
+    after: Optional[str] = None,
+    max_facet_options: Optional[int] = None,
+    disjunctive_facets: bool = False,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    sort: Optional[str] = None,
+    config: Config = Depends(get_config),
+):
+    """
+    Search metadata like ``/rpc/search``, but with the query string and
+    the filters in the URL, such that search results can be cached.
+
+    While the metadata store is watched for changes, the search result
+    carries an ``ETag``, which is the same on all workers and changes
+    whenever the collections that the search depends on change. If it
+    matches the ``If-None-Match`` header, the search is not performed again.
+    """
+    check_search_parameters(skip=skip, limit=limit, max_facet_options=max_facet_options)
+    search_params: Dict[str, Any] = {
+        "document_type": document_type,
+        "search_query": query,
+        "filters": parse_filters(filters),
+        "return_facets": return_facets,
+        "skip": skip,
+        "limit": limit,
+        "after": after,
+        "max_facet_options": max_facet_options,
+        "disjunctive_facets": disjunctive_facets,
+        "fields": parse_fields(fields),
+        "expand": parse_fields(expand),
+        "sort": sort,
+    }
+
+    headers = {"Cache-Control": "no-cache"}
+    try:
+        etag = get_search_etag(config=config, **search_params)
+        if etag is not None:
+            headers["ETag"] = etag
+            if_none_match = request.headers.get("if-none-match", "")
+            if etag_matches(etag, if_none_match):
+                return Response(status_code=304, headers=headers)
+
+        response = await perform_search(config=config, **search_params)
+    except InvalidCursorError as exc:
+        raise HTTPException(
+            status_code=400,
+            detail="'after' parameter must be a cursor returned by a previous search",
+        ) from exc
+    except (InvalidReferenceError, InvalidSortError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return FastJSONResponse(response, headers=headers)
+
+
+@app.post(
+    "/rpc/search/batch",
+    summary="Perform a batch of searches at once",
+    response_model=BatchSearchResult,
+)
+async def search_batch(
+    queries: List[BatchSearchQuery],
+    config: Config = Depends(get_config),
+):
+    """
+    Perform multiple searches, each with its own query string, filters
+    and parameters, in a single request.
+
+    The searches run concurrently and their results are returned in the
+    order of the queries. Identical queries are only performed once.
+    """
+    if len(queries) > config.batch_max_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch must not contain more than {config.batch_max_size} queries",
         )
-    if limit < 0:
+    for query in queries:
+        check_search_parameters(
+            skip=query.skip,
+            limit=query.limit,
+            max_facet_options=query.max_facet_options,
+        )
+
+    try:
+        results = await perform_batch_search(
+            searches=[
+                {
+                    "document_type": query.document_type,
+                    "search_query": query.query,
+                    "filters": query.filters,
+                    "return_facets": query.return_facets,
+                    "skip": query.skip,
+                    "limit": query.limit,
+                    "after": query.after,
+                    "max_facet_options": query.max_facet_options,
+                    "disjunctive_facets": query.disjunctive_facets,
+                    "fields": query.fields,
+                    "expand": query.expand,
+                    "sort": query.sort,
+                }
+                for query in queries
+            ],
+            config=config,
+        )
+    except InvalidCursorError as exc:
         raise HTTPException(
             status_code=400,
-            detail="'limit' parameter must be greater than or equal to 0",
+            detail="'after' parameter must be a cursor returned by a previous search",
+        ) from exc
+    except (InvalidReferenceError, InvalidSortError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return FastJSONResponse({"results": results})
+
+
+@app.post(
+    "/rpc/search/federated",
+    summary="Search metadata of all document types by keywords",
+    response_model=FederatedSearchResult,
+)
+async def search_federated(
+    query: SearchQuery,
+    skip: int = 0,
+    limit: int = 10,
+    config: Config = Depends(get_config),
+):
+    """
+    Search all types of document based on a given query string and get
+    their hits as a single list, ordered by relevance, together with
+    the number of hits per type of document.
+
+    Types of document that cannot be searched in time are left out,
+    in which case the result is marked as ``partial``.
+    """
+    if query.filters:
+        raise HTTPException(
+            status_code=400,
+            detail="Filters are not supported when searching all document types",
         )
+    check_search_parameters(skip=skip, limit=limit, max_facet_options=None)
+    if limit == 0:
+        raise HTTPException(
+            status_code=400, detail="'limit' parameter must be greater than 0"
+        )
+    response = await perform_federated_search(
+        search_query=query.query, skip=skip, limit=limit, config=config
+    )
+    return FastJSONResponse(response)
+
+
+@app.post(
+    "/rpc/search/export",
+    summary="Export all metadata matching keywords and facets",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def export(
+    query: SearchQuery,
+    document_type: DocumentType,
+    fields: Optional[str] = None,
+    config: Config = Depends(get_config),
+):
+    """
+    Export all hits for a given query string and filters as
+    newline-delimited JSON, with one hit per line.
 
-    hits, facets, count = await perform_search(
-        document_type=document_type,
-        search_query=query.query,
-        filters=query.filters,
-        return_facets=return_facets,
-        skip=skip,
-        limit=limit,
-        config=config,
+    Hits are streamed while they are read from the metadata store,
+    so that there is no limit on the number of hits.
+    """
+    return StreamingResponse(
+        export_search(
+            document_type=document_type,
+            search_query=query.query,
+            filters=query.filters,
+            config=config,
+            fields=parse_fields(fields),
+        ),
+        media_type="application/x-ndjson",
     )
-    response = {"facets": facets, "count": count, "hits": hits}
-    return response
+
+
+@app.get(
+    "/documents/{document_type}/{document_id}",
+    summary="Get a document by its ID",
+    response_model=Document,
+)
+async def get_document(
+    document_type: DocumentType,
+    document_id: str,
+    expand: Optional[str] = None,
+    config: Config = Depends(get_config),
+):
+    """
+    Get a document by its type and ID.
+
+    The references of the comma-separated reference fields in ``expand``,
+    like ``has_study,has_file``, are replaced by the referenced documents.
+    """
+    try:
+        document = await get_document_with_references(
+            document_type=document_type,
+            document_id=document_id,
+            expand=parse_fields(expand),
+            config=config,
+        )
+    except InvalidReferenceError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if document is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No {document_type.value} with ID {document_id} found",
+        )
+    return FastJSONResponse(document)
@@ -0,0 +1,38 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Responses that are returned by the FastAPI endpoints"""
+
+from typing import Any
+
+import orjson
+from fastapi.responses import ORJSONResponse
+
+# pylint: disable=no-member
+
+
+class FastJSONResponse(ORJSONResponse):
+    """
+    A JSON response that serializes its content with orjson, as it is.
+
+    Endpoints that return this response directly are neither validated
+    against their ``response_model`` nor passed through ``jsonable_encoder``,
+    which are both expensive for large documents. The ``response_model``
+    is still used for the OpenAPI schema, so the content must conform to it.
+    Values that orjson does not support, like an ``ObjectId``,
+    are serialized as strings.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
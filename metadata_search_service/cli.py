@@ -0,0 +1,128 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Command line interface for building the indexes of the search backends"""
+
+import argparse
+import asyncio
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.core.utils import DEFAULT_FACET_FIELDS
+from metadata_search_service.dao.db import close_db
+from metadata_search_service.dao.document import get_all_documents
+from metadata_search_service.dao.memory_index import MemoryIndex
+from metadata_search_service.dao.snapshot_file import write_snapshot_file
+from metadata_search_service.dao.sqlite_index import build_sqlite_database
+from metadata_search_service.dao.utils import read_json_collections
+
+
+async def _load_collections(config: Config) -> Dict[str, List[Dict]]:
+    """Take a snapshot of all collections of the metadata store."""
+    try:
+        return await get_all_documents(config)
+    finally:
+        close_db()
+
+
+def load_collections(
+    json_dir: Optional[Path] = None, config: Config = CONFIG
+) -> Dict[str, List[Dict]]:
+    """
+    Load the documents of all collections, either from a directory of
+    JSON files (see ``read_json_collections``) or from the metadata store.
+
+    Args:
+        json_dir: A directory of JSON files, or None to use the metadata store
+        config: The config
+
+    Returns:
+        The documents of each collection
+    """
+    if json_dir is not None:
+        return read_json_collections(json_dir)
+    return asyncio.run(_load_collections(config))
+
+
+def build_sqlite(args: argparse.Namespace, config: Config = CONFIG) -> None:
+    """Build the database of the SQLite search backend."""
+    path = args.output or config.sqlite_path
+    build_sqlite_database(
+        path,
+        load_collections(args.json_dir, config),
+        facet_fields=DEFAULT_FACET_FIELDS,
+        field_weights=config.search_field_weights,
+    )
+    print(f"Built the SQLite database at {path}")
+
+
+def build_snapshot(args: argparse.Namespace, config: Config = CONFIG) -> None:
+    """Build the snapshot file of the in-memory index."""
+    path = args.output or config.memory_snapshot_path
+    if not path:
+        raise SystemExit("Either --output or memory_snapshot_path is required.")
+    memory_index = MemoryIndex(
+        load_collections(args.json_dir, config), config.search_field_weights
+    )
+    write_snapshot_file(path, memory_index, facet_fields=DEFAULT_FACET_FIELDS)
+    print(f"Built the snapshot file at {path}")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get the parser of the command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="metadata-search-service-index",
+        description="Build the indexes of the search backends from a snapshot"
+        " of the metadata store, which is configured like the service.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    commands = [
+        (
+            "build-sqlite",
+            build_sqlite,
+            "Build the database of the SQLite search backend.",
+            "sqlite_path",
+        ),
+        (
+            "build-snapshot",
+            build_snapshot,
+            "Build the snapshot file of the in-memory index.",
+            "memory_snapshot_path",
+        ),
+    ]
+    for name, func, help_text, path_setting in commands:
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument(
+            "--output",
+            help=f"The path of the file (defaults to the configured {path_setting})",
+        )
+        subparser.add_argument(
+            "--json-dir",
+            type=Path,
+            help="Read the collections from the JSON files in this directory"
+            " instead of the metadata store",
+        )
+        subparser.set_defaults(func=func)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the command line interface."""
+    args = get_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
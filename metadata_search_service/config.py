@@ -15,6 +15,8 @@
 
 """Config Parameter Modeling and Parsing"""
 
+from typing import Dict, List, Literal, Optional
+
 from ghga_service_chassis_lib.api import ApiConfigBase
 from ghga_service_chassis_lib.config import config_from_yaml
 
@@ -29,6 +31,81 @@ class Config(ApiConfigBase):
     # are inherited from PubSubConfigBase;
     db_url: str = "mongodb://localhost:27017"
     db_name: str = "metadata-store"
+    # connection pool of the database client shared by all requests of a worker
+    db_max_pool_size: int = 100
+    db_min_pool_size: int = 0
+    db_max_idle_time_ms: Optional[int] = None
+    # time to wait for the database on startup before coming up without it
+    db_startup_timeout_ms: int = 5000
+    # in-process cache of search results, bounded by the number of entries and
+    # their approximate size in bytes (set max entries to 0 to disable it)
+    search_cache_max_entries: int = 1024
+    search_cache_ttl: float = 60.0
+    search_cache_max_bytes: int = 64 * 1024 * 1024
+    # watch the metadata store for changes, using change streams; if the
+    # database is not a replica set, the collections can be polled for changes
+    # in the given interval instead, which is opt-in since polling is not free
+    watch_changes: bool = True
+    poll_changes: bool = False
+    change_poll_interval: float = 10.0
+    # polling, like starting to watch, compares cheap fingerprints of the
+    # collections, which miss in-place updates that keep their size; entity
+    # tags that depend on such fingerprints expire after this many seconds,
+    # and cached results after the time-to-live of the search cache
+    approximate_etag_max_age: float = 60.0
+    # maximum number of options per facet, which can be set per facet field
+    # (using keys like "has_study.type"); use 0 to return all options
+    facet_max_options: int = 20
+    facet_max_options_per_field: Dict[str, int] = {}
+    # precompute the facets of searches without query and filters,
+    # refreshing them on changes and in the given interval
+    precompute_facets: bool = True
+    facet_refresh_interval: float = 300.0
+    # number of documents fetched per batch when exporting search results
+    export_batch_size: int = 1000
+    # maximum number of searches per batch and how many of them run at once
+    batch_max_size: int = 20
+    batch_max_concurrency: int = 8
+    # seconds to wait for each collection in a search across all document types
+    federated_search_timeout: float = 2.0
+    # pass the content of search hits from BSON to JSON without decoding it;
+    # this needs python-bsonjs and is turned off with a warning without it;
+    # the JSON is the same as without this option, since hits with values
+    # like datetimes are decoded
+    raw_bson_hits: bool = False
+    # fields to include in each search hit by default, per document type
+    # (like {"Dataset": ["title", "type"]}); all fields if not given
+    search_default_fields: Dict[str, List[str]] = {}
+    # fields that search hits can be sorted by, besides relevance; these
+    # should be single valued top level fields with an index in the metadata
+    # store, such that the first pages are a top-k sort on that index
+    sort_fields: List[str] = ["id", "title"]
+    # compress responses of at least the minimum size (in bytes) with gzip,
+    # or brotli and zstd if installed; streaming responses like exports are
+    # compressed chunk by chunk; bodies and chunks of at least the offload
+    # size are compressed in a worker thread
+    compress_responses: bool = True
+    compression_minimum_size: int = 1024
+    compression_level: int = 5
+    compression_offload_size: int = 65536
+    # maximum number of references that are expanded per field and document
+    expand_max_items: int = 100
+    # search the metadata store with its aggregation pipelines ("mongodb"),
+    # an in-memory index of a snapshot of it ("memory"), which is taken
+    # on first use and taken again when changes are noticed, or a read-only
+    # SQLite database at sqlite_path ("sqlite"), which is built beforehand
+    # with `metadata-search-service-index build-sqlite`
+    search_backend: Literal["mongodb", "memory", "sqlite"] = "mongodb"
+    sqlite_path: str = "metadata_store.sqlite3"
+    # load the in-memory index from a snapshot file, which is memory-mapped
+    # and shared by all workers, instead of indexing the metadata store in
+    # each worker; built beforehand with
+    # `metadata-search-service-index build-snapshot`
+    memory_snapshot_path: Optional[str] = None
+    # weights of the fields for ranking text searches with the in-memory index
+    # or SQLite (like {"title": 2.0}); fields with weight 0 are not searchable;
+    # SQLite can only weight the fields that were weighted when it was built
+    search_field_weights: Dict[str, float] = {"title": 2.0}
 
 
 CONFIG = Config()
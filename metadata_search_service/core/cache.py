@@ -0,0 +1,356 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process cache for search results"""
+
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import orjson
+
+from metadata_search_service.config import CONFIG, Config
+
+_SEARCH_CACHE: Optional["SearchCache"] = None
+
+# pylint: disable=too-many-arguments, too-many-instance-attributes, no-member
+
+
+class SearchCache:
+    """
+    A bounded least-recently-used cache whose entries expire after a
+    time-to-live. Besides the number of entries, the cache is bounded by
+    the approximate size of all cached values in bytes, since a single
+    entry can hold any number of hits.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries: "OrderedDict[str, Tuple[float, int, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Get the value for a given key.
+
+        Args:
+            key: The cache key
+
+        Returns:
+            The cached value, or None if the key is not cached or has expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Cache a value for a given key, evicting the least recently used
+        entries if the cache is full. Values that are larger than the
+        whole byte budget of the cache are not cached at all.
+
+        Args:
+            key: The cache key
+            value: The value to cache, which must be JSON serializable
+        """
+        if self.max_entries <= 0:
+            return
+        size = len(orjson.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        while self._entries and (
+            len(self._entries) >= self.max_entries or self._size + size > self.max_bytes
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self._size += size
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get statistics about the usage of the cache.
+
+        Returns:
+            A dictionary with the number of entries, their size in bytes,
+            and the number of hits, misses and evictions
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: str) -> None:
+        """Remove the entry for a given key."""
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+
+class DataVersions:
+    """
+    Per-collection versions of the metadata store, which change whenever a
+    collection changes. Cache keys include the versions of all collections
+    that a cached result depends on, so that changes invalidate exactly
+    the affected entries.
+
+    While the metadata store is ``watched``, versions are derived from the
+    metadata store itself, like the cluster time of the last change of a
+    collection, such that all workers and replicas agree on them. Other
+    versions are random, so they never match a version of another process.
+    Versions that might miss some changes, like the ones derived from
+    cheap fingerprints of collections, are ``approximate``.
+    """
+
+    def __init__(self):
+        self.watched = False
+        self._initial_version = uuid.uuid4().hex
+        self._initial_approximate = False
+        self._versions: Dict[str, str] = {}
+        self._approximate: Set[str] = set()
+        self._listeners: List[Callable[[str], None]] = []
+
+    def get(self, collection_names: Iterable[str]) -> Dict[str, str]:
+        """
+        Get the current versions of a given set of collections.
+
+        Args:
+            collection_names: The names of the collections
+
+        Returns:
+            A dictionary that maps each collection name to its version
+        """
+        return {name: self._get(name) for name in sorted(collection_names)}
+
+    def _get(self, collection_name: str) -> str:
+        """Get the current version of a collection, starting at the initial one."""
+        if collection_name not in self._versions:
+            self._versions[collection_name] = self._initial_version
+            if self._initial_approximate:
+                self._approximate.add(collection_name)
+        return self._versions[collection_name]
+
+    def is_approximate(self, collection_names: Iterable[str]) -> bool:
+        """
+        Check whether the current version of any of the given
+        collections might miss some changes.
+
+        Args:
+            collection_names: The names of the collections
+
+        Returns:
+            True if any of the versions is approximate, False otherwise
+        """
+        return any(
+            name in self._approximate
+            or (name not in self._versions and self._initial_approximate)
+            for name in collection_names
+        )
+
+    def bump(
+        self,
+        collection_name: str,
+        version: Optional[str] = None,
+        approximate: bool = False,
+    ) -> None:
+        """
+        Record a change of a collection and notify all listeners.
+
+        Args:
+            collection_name: The name of the collection that changed
+            version: The new version of the collection, which should be
+                derived from the metadata store. Defaults to a random version
+            approximate: Whether the new version might miss some changes
+        """
+        self._versions[collection_name] = version or uuid.uuid4().hex
+        if approximate:
+            self._approximate.add(collection_name)
+        else:
+            self._approximate.discard(collection_name)
+        for listener in self._listeners:
+            listener(collection_name)
+
+    def bump_all(
+        self, version: Optional[str] = None, approximate: bool = False
+    ) -> None:
+        """
+        Record a change of all collections, including the collections
+        that do not have a version yet.
+
+        Args:
+            version: The new version of all collections (see ``bump``)
+            approximate: Whether the new version might miss some changes
+        """
+        self._initial_version = version or uuid.uuid4().hex
+        self._initial_approximate = approximate
+        for collection_name in list(self._versions):
+            self.bump(collection_name, self._initial_version, approximate)
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        Register a callable that is invoked with the name of
+        a collection whenever that collection changes.
+
+        Args:
+            listener: The callable to invoke
+        """
+        self._listeners.append(listener)
+
+
+DATA_VERSIONS = DataVersions()
+
+
+def make_search_etag(cache_key: str, max_age: Optional[float] = None) -> str:
+    """
+    Build a weak entity tag for a search result, which changes whenever
+    the result might change.
+
+    The entity tag is only valid across processes if the data versions
+    in the cache key are derived from the metadata store
+    (see ``DataVersions``). If the versions are approximate, the entity
+    tag should expire after a maximum age instead, which happens at the
+    same time in all processes, since it is based on the wall clock.
+
+    Args:
+        cache_key: The cache key of the search, including the normalized
+            query and the data versions of the collections it depends on
+        max_age: The maximum age of the entity tag in seconds, if any
+
+    Returns:
+        The entity tag, including its quotes
+    """
+    if max_age:
+        cache_key += f"|{int(time.time() // max_age)}"
+    digest = hashlib.sha256(cache_key.encode("utf8"))
+    return f'W/"{digest.hexdigest()[:32]}"'
+
+
+def get_search_cache(config: Config = CONFIG) -> SearchCache:
+    """
+    Get the search cache of this worker process.
+    The cache is created on first use.
+
+    Args:
+        config: The config
+
+    Returns:
+        The search cache
+    """
+    global _SEARCH_CACHE  # pylint: disable=global-statement
+    if _SEARCH_CACHE is None:
+        _SEARCH_CACHE = SearchCache(
+            max_entries=config.search_cache_max_entries,
+            ttl=config.search_cache_ttl,
+            max_bytes=config.search_cache_max_bytes,
+        )
+    return _SEARCH_CACHE
+
+
+def normalize_search_query(search_query: Optional[str]) -> str:
+    """
+    Normalize the whitespace of a search query string, such that queries
+    that only differ in whitespace are searched for in the same way.
+
+    Args:
+        search_query: The search query string
+
+    Returns:
+        The normalized search query string, which is "*" for empty queries
+    """
+    return " ".join((search_query or "").split()) or "*"
+
+
+def make_search_cache_key(
+    document_type: str,
+    search_query: str = "*",
+    filters: List = None,
+    return_facets: bool = False,
+    skip: int = 0,
+    limit: int = 10,
+    after: Optional[str] = None,
+    max_facet_options: Optional[int] = None,
+    disjunctive_facets: bool = False,
+    fields: Optional[List[str]] = None,
+    expand: Optional[List[str]] = None,
+    sort: Optional[str] = None,
+    data_versions: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Build a canonical cache key for a search, such that searches that
+    only differ in whitespace or in the order of their filters share
+    the same key. Such searches must therefore be performed with the
+    normalized query (see ``normalize_search_query``).
+
+    Args:
+        document_type: The type of document
+        search_query: The search query string
+        filters: A list of filters
+        return_facets: Whether or not facets are returned
+        skip: The number of documents to skip
+        limit: The total number of documents to retrieve
+        after: A cursor to continue after
+        max_facet_options: The maximum number of options per facet
+        disjunctive_facets: Whether or not facets are disjunctive
+        fields: The fields to include in each hit
+        expand: The reference fields of each hit to expand
+        sort: The sort option
+        data_versions: The versions of the collections the search depends on
+
+    Returns:
+        The cache key
+    """
+    normalized_filters = sorted({(x.key, x.value) for x in filters or []})
+    return json.dumps(
+        [
+            document_type,
+            normalize_search_query(search_query),
+            normalized_filters,
+            return_facets,
+            skip,
+            limit,
+            after,
+            max_facet_options,
+            disjunctive_facets,
+            sorted(set(fields)) if fields is not None else None,
+            sorted(set(expand or [])),
+            sort,
+            data_versions or {},
+        ]
+    )
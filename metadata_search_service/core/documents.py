@@ -0,0 +1,186 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Business logic for retrieving documents and their references"""
+
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.dao.backend import get_backend
+from metadata_search_service.dao.utils import (
+    InvalidReferenceError,
+    check_reference_field,
+    get_reference_collection_name,
+)
+
+
+class ReferenceLoader:
+    """
+    Loads referenced documents for the duration of a request.
+
+    All documents that are requested from the same collection before the
+    loader gets to run are retrieved with a single query, and each document
+    is only retrieved once, no matter how often it is referenced.
+    """
+
+    def __init__(self, config: Config = CONFIG):
+        self.config = config
+        self.backend = get_backend(config)
+        self._memo: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._queue: Dict[str, List[str]] = {}
+        self._dispatch_task: Optional[asyncio.Task] = None
+
+    def load(self, collection_name: str, document_id: str) -> asyncio.Future:
+        """
+        Request a document from a collection.
+
+        Args:
+            collection_name: The collection in the metadata store that has the document
+            document_id: The ID of the document
+
+        Returns:
+            A future that resolves to the document, or to None if there is none
+        """
+        key = (collection_name, document_id)
+        future = self._memo.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._memo[key] = future
+            self._queue.setdefault(collection_name, []).append(document_id)
+            if self._dispatch_task is None:
+                self._dispatch_task = asyncio.create_task(self._dispatch())
+        return future
+
+    async def _dispatch(self) -> None:
+        """Retrieve all requested documents, with one query per collection."""
+        queue, self._queue = self._queue, {}
+        self._dispatch_task = None
+        collection_names = list(queue)
+        results = await asyncio.gather(
+            *[
+                self.backend.get_references(name, queue[name])
+                for name in collection_names
+            ],
+            return_exceptions=True,
+        )
+        for name, result in zip(collection_names, results):
+            for document_id in queue[name]:
+                future = self._memo[(name, document_id)]
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result.get(document_id))
+
+
+async def get_document_with_references(
+    document_type: str,
+    document_id: str,
+    expand: Optional[List[str]] = None,
+    config: Config = CONFIG,
+) -> Optional[Dict]:
+    """
+    Get a document by its ID, with the references of the given
+    fields being replaced by the referenced documents.
+
+    Args:
+        document_type: The type of document
+        document_id: The ID of the document
+        expand: The reference fields to expand, like ``has_study``
+        config: The config
+
+    Returns:
+        The document, together with the reference fields that were not
+        fully expanded, or None if there is no such document
+
+    Raises:
+        InvalidReferenceError: If a field to expand is not a reference field
+    """
+    expand = expand or []
+    check_expand_fields(expand)
+    doc = await get_backend(config).get_document(document_type, document_id)
+    if doc is None:
+        return None
+    truncated = await expand_references([doc], expand, ReferenceLoader(config))
+    return {
+        "document_type": document_type,
+        "id": doc["id"],
+        "content": doc,
+        "truncated": truncated,
+    }
+
+
+def check_expand_fields(expand: Optional[List[str]]) -> None:
+    """
+    Check that all fields to expand are reference fields.
+
+    Args:
+        expand: The fields to expand, if any
+
+    Raises:
+        InvalidReferenceError: If a field is not a reference field
+    """
+    for field in expand or []:
+        if not check_reference_field(field):
+            raise InvalidReferenceError(f"'{field}' is not a reference field")
+
+
+async def expand_references(
+    documents: List[Dict], expand: List[str], loader: ReferenceLoader
+) -> List[str]:
+    """
+    Replace the references of the given fields in a list of documents
+    by the referenced documents, in place.
+
+    The references of all documents are retrieved at once by the loader,
+    which requests each referenced document only once and all references
+    to the same collection with a single query.
+    Only the first ``expand_max_items`` references of each field
+    and document are expanded, while the others are left out.
+    References that have been looked up already, like the nested fields
+    of search hits, are kept as they are.
+
+    Args:
+        documents: The documents to expand references in
+        expand: The reference fields to expand, like ``has_study``
+        loader: The loader for the referenced documents
+
+    Returns:
+        The fields of which not all references were expanded
+    """
+    max_items = loader.config.expand_max_items
+    truncated: Set[str] = set()
+    expansions = []
+    for doc in documents:
+        for field in expand:
+            value = doc.get(field)
+            if value is None:
+                continue
+            ids = [value] if isinstance(value, str) else list(value)
+            if len(ids) > max_items:
+                truncated.add(field)
+            collection_name = get_reference_collection_name(field)
+            references = [
+                loader.load(collection_name, x) if isinstance(x, str) else x
+                for x in ids[:max_items]
+            ]
+            expansions.append((doc, field, isinstance(value, str), references))
+
+    for doc, field, single, references in expansions:
+        expanded = [await x if isinstance(x, asyncio.Future) else x for x in references]
+        if single:
+            doc[field] = expanded[0] if expanded else None
+        else:
+            doc[field] = [x for x in expanded if x is not None]
+    return sorted(truncated)
@@ -0,0 +1,157 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Precomputed facet counts for browsing documents without a search query"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.core.cache import DATA_VERSIONS, DataVersions
+from metadata_search_service.core.utils import (
+    DEFAULT_FACET_FIELDS,
+    format_facets,
+    get_facet_max_options,
+    get_search_collections,
+)
+from metadata_search_service.dao.backend import get_backend
+
+
+@dataclass
+class PrecomputedFacets:
+    """The facets and total count of all documents of one document type."""
+
+    facets: List[Dict]
+    count: int
+    updated_at: datetime
+    data_versions: Dict[str, str]
+
+
+class FacetStore:
+    """
+    Materialised facet counts for searches without query and filters,
+    one entry per document type. An entry is only served as long as none
+    of the collections it has been computed from changed since.
+    """
+
+    def __init__(self, versions: DataVersions = DATA_VERSIONS):
+        self.versions = versions
+        self._entries: Dict[Tuple[str, str, str], PrecomputedFacets] = {}
+
+    def get(
+        self, document_type: str, config: Config = CONFIG
+    ) -> Optional[PrecomputedFacets]:
+        """
+        Get the precomputed facets of a given document type.
+
+        Args:
+            document_type: The type of document
+            config: The config
+
+        Returns:
+            The precomputed facets, or None if they are missing or outdated
+        """
+        entry = self._entries.get(_get_entry_key(document_type, config))
+        if entry is None or entry.data_versions != self._get_versions(document_type):
+            return None
+        return entry
+
+    async def refresh(self, document_type: str, config: Config = CONFIG) -> None:
+        """
+        Compute the facets of a given document type from the metadata store.
+
+        Args:
+            document_type: The type of document
+            config: The config
+        """
+        data_versions = self._get_versions(document_type)
+        updated_at = datetime.now(timezone.utc)
+        facet_fields = DEFAULT_FACET_FIELDS[document_type]
+        facet_results, count = await get_backend(config).get_facets(
+            collection_name=document_type,
+            facet_fields=facet_fields,
+            max_options=get_facet_max_options(facet_fields, config),
+        )
+        self._entries[_get_entry_key(document_type, config)] = PrecomputedFacets(
+            facets=format_facets(facet_results),
+            count=count,
+            updated_at=updated_at,
+            data_versions=data_versions,
+        )
+
+    async def refresh_outdated(
+        self, config: Config = CONFIG, force: bool = False
+    ) -> None:
+        """
+        Compute the facets of all document types that are missing or outdated.
+
+        Args:
+            config: The config
+            force: Whether or not to refresh the facets of all document types
+        """
+        for document_type in DEFAULT_FACET_FIELDS:
+            if force or self.get(document_type, config) is None:
+                await self.refresh(document_type, config)
+
+    def clear(self) -> None:
+        """Remove all precomputed facets."""
+        self._entries.clear()
+
+    def _get_versions(self, document_type: str) -> Dict[str, str]:
+        """Get the versions of the collections the facets depend on."""
+        return self.versions.get(get_search_collections(document_type))
+
+
+def _get_entry_key(document_type: str, config: Config) -> Tuple[str, str, str]:
+    """Get the key of the precomputed facets of a document type in a database."""
+    return (config.db_url, config.db_name, document_type)
+
+
+FACET_STORE = FacetStore()
+
+
+async def refresh_facet_store(
+    config: Config = CONFIG, store: FacetStore = FACET_STORE
+) -> None:
+    """
+    Keep the precomputed facets up to date. Outdated facets are refreshed
+    as soon as a change of the metadata store is noticed, and all facets
+    are refreshed in the interval given by ``facet_refresh_interval``.
+    This coroutine runs until it is cancelled.
+
+    Args:
+        config: The config
+        store: The facet store to refresh
+    """
+    changed = asyncio.Event()
+    store.versions.add_listener(lambda _: changed.set())
+    force = False
+    while True:
+        changed.clear()
+        try:
+            await store.refresh_outdated(config, force=force)
+        except PyMongoError as exc:
+            logging.warning("Refreshing the precomputed facets failed: %s", exc)
+        try:
+            await asyncio.wait_for(
+                changed.wait(), timeout=config.facet_refresh_interval
+            )
+            force = False
+        except asyncio.TimeoutError:
+            force = True
@@ -14,13 +14,44 @@
 # limitations under the License.
 """Business logic for performing search on the metadata store"""
 
-from typing import Dict, List, Tuple
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+
+import orjson
 
 from metadata_search_service.config import CONFIG, Config
-from metadata_search_service.core.utils import DEFAULT_FACET_FIELDS, format_facet_key
-from metadata_search_service.dao.document import get_documents
+from metadata_search_service.core.cache import (
+    DATA_VERSIONS,
+    get_search_cache,
+    make_search_cache_key,
+    make_search_etag,
+    normalize_search_query,
+)
+from metadata_search_service.core.documents import (
+    ReferenceLoader,
+    check_expand_fields,
+    expand_references,
+)
+from metadata_search_service.core.facets import FACET_STORE
+from metadata_search_service.core.utils import (
+    DEFAULT_FACET_FIELDS,
+    format_facets,
+    get_facet_max_options,
+    get_search_collections,
+    get_search_fields,
+)
+from metadata_search_service.dao.backend import get_backend
+from metadata_search_service.dao.utils import (
+    build_sort,
+    can_convert_raw_bson,
+    raw_bson_to_json,
+)
 
-# pylint: disable=too-many-locals, too-many-nested-blocks, too-many-arguments
+# pylint: disable=too-many-locals, too-many-nested-blocks, too-many-arguments, no-member
 
 
 async def perform_search(
@@ -31,11 +62,28 @@ async def perform_search(
     skip: int = 0,
     limit: int = 10,
     config: Config = CONFIG,
-) -> Tuple[List[Dict], List[Dict], int]:
+    after: Optional[str] = None,
+    max_facet_options: Optional[int] = None,
+    disjunctive_facets: bool = False,
+    fields: Optional[List[str]] = None,
+    expand: Optional[List[str]] = None,
+    loader: Optional[ReferenceLoader] = None,
+    sort: Optional[str] = None,
+) -> Dict:
     """
     Perform a search on the metadata store and get all
     documents that match a given search query.
 
+    Results are served from the search cache of this worker if an
+    equivalent search has been performed recently and none of the
+    collections it depends on have changed since. Facets and count of
+    searches without query and filters are served from the precomputed
+    facets, if available.
+
+    With ``disjunctive_facets``, the filters on a facet field are not
+    applied to the counts of that facet, so that the other values of
+    a facet stay selectable once one of its values is used as a filter.
+
     Args:
         document_type: The type of document
         search_query: The search query string to use for text serach
@@ -43,43 +91,385 @@ async def perform_search(
         skip: The number of documents to skip
         limit: The total number of documents to retrieve
         config: The config
+        after: A cursor as returned for a previous page, to continue after
+        max_facet_options: The maximum number of options per facet, which
+            overrides the configured maximum
+        disjunctive_facets: Whether or not to ignore the filters on each
+            facet field for its own facet
+        fields: The fields to include in each hit. Defaults to the configured
+            default fields of the document type, or all fields
+        expand: The reference fields of each hit to replace with the
+            referenced documents
+        loader: The loader to retrieve referenced documents with, which
+            may be shared with other searches of the same request
+        sort: ``relevance`` or one of the configured ``sort_fields``, prefixed
+            with a minus sign for descending order (see ``build_sort``).
+            Defaults to relevance for text searches
 
     Returns:
-        A list of documents, a list of facets (if ``return_facets=True``),
-        and a count representing total number of hits
+        A search result with a list of hits, a list of facets
+        (if ``return_facets=True``), a count representing total number
+        of hits, a cursor for the next page (if there might be more hits),
+        the time at which facets and count were computed, and the expanded
+        fields that were truncated
+
+    Raises:
+        InvalidReferenceError: If a field to expand is not a reference field
+        InvalidSortError: If hits cannot be sorted as given
 
     """
-    docs, facet_results, count = await get_documents(
+    check_expand_fields(expand)
+    # the cache key and the search itself have to use the same query
+    search_query = normalize_search_query(search_query)
+    sort_fields = build_sort(sort, search_query, config.sort_fields)
+    cache = get_search_cache(config)
+    cache_key = _get_cache_key(
+        document_type=document_type,
+        search_query=search_query,
+        filters=filters,
+        return_facets=return_facets,
+        skip=skip,
+        limit=limit,
+        after=after,
+        max_facet_options=max_facet_options,
+        disjunctive_facets=disjunctive_facets,
+        fields=fields,
+        expand=expand,
+        sort=sort,
+    )
+    cached_result = cache.get(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    precomputed = None
+    if (
+        return_facets
+        and search_query in {"*"}
+        and not filters
+        and max_facet_options is None
+    ):
+        precomputed = FACET_STORE.get(document_type, config)
+
+    # expanded hits are modified after retrieval, so they are never raw,
+    # and without python-bsonjs raw hits would only be decoded again
+    backend = get_backend(config)
+    raw_bson = (
+        config.raw_bson_hits
+        and not expand
+        and backend.supports_raw_bson
+        and can_convert_raw_bson()
+    )
+    facet_fields = DEFAULT_FACET_FIELDS[document_type]
+    docs, facet_results, count, next_cursor = await backend.get_documents(
         collection_name=document_type,
         search_query=search_query,
         filters=filters,
-        facet_fields=DEFAULT_FACET_FIELDS[document_type],
+        facet_fields=facet_fields,
         skip=skip,
         limit=limit,
-        config=config,
+        return_facets=return_facets and precomputed is None,
+        return_count=precomputed is None,
+        after=after,
+        max_options=get_facet_max_options(facet_fields, config, max_facet_options),
+        disjunctive_facets=disjunctive_facets,
+        raw_bson=raw_bson,
+        fields=get_search_fields(document_type, fields, config),
+        sort=sort_fields,
+    )
+    truncated = (
+        await expand_references(docs, expand, loader or ReferenceLoader(config))
+        if expand
+        else []
+    )
+    if raw_bson:
+        # the content is serialized already and embedded into the response as is
+        hits = [
+            {
+                "document_type": document_type,
+                "id": x["id"],
+                "content": orjson.Fragment(raw_bson_to_json(x["content"])),
+            }
+            for x in docs
+        ]
+    else:
+        hits = [
+            {"document_type": document_type, "id": x["id"], "content": x} for x in docs
+        ]
+    if precomputed is not None:
+        facets = precomputed.facets
+        count = precomputed.count
+        updated_at = precomputed.updated_at
+    else:
+        facets = format_facets(facet_results) if return_facets else []
+        updated_at = datetime.now(timezone.utc)
+    result = {
+        "facets": facets,
+        "count": count,
+        "hits": hits,
+        "next_cursor": next_cursor,
+        "updated_at": updated_at,
+        "truncated": truncated,
+    }
+    cache.put(cache_key, result)
+    return result
+
+
+def get_search_etag(
+    document_type: str,
+    search_query: str = "*",
+    filters: List = None,
+    return_facets: bool = False,
+    skip: int = 0,
+    limit: int = 10,
+    config: Config = CONFIG,
+    after: Optional[str] = None,
+    max_facet_options: Optional[int] = None,
+    disjunctive_facets: bool = False,
+    fields: Optional[List[str]] = None,
+    expand: Optional[List[str]] = None,
+    sort: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Get an entity tag for the result of a search, without performing it.
+
+    The entity tag changes whenever any of the collections that the search
+    depends on changes. Since this is only noticed while the metadata store
+    is watched for changes, there is no entity tag otherwise. Changes that
+    the data versions might miss are picked up once the entity tag expires
+    (see ``approximate_etag_max_age``).
+
+    Args:
+        document_type: The type of document
+        search_query: The search query string to use for text serach
+        return_facets: Whether or not to facet. Defaults to False
+        skip: The number of documents to skip
+        limit: The total number of documents to retrieve
+        config: The config
+        after: A cursor as returned for a previous page, to continue after
+        max_facet_options: The maximum number of options per facet, which
+            overrides the configured maximum
+        disjunctive_facets: Whether or not to ignore the filters on each
+            facet field for its own facet
+        fields: The fields to include in each hit
+        expand: The reference fields of each hit to expand
+        sort: The sort option (see ``perform_search``)
+
+    Returns:
+        The entity tag, or None if changes of the metadata store are not watched
+
+    Raises:
+        InvalidReferenceError: If a field to expand is not a reference field
+        InvalidSortError: If hits cannot be sorted as given
+
+    """
+    check_expand_fields(expand)
+    search_query = normalize_search_query(search_query)
+    build_sort(sort, search_query, config.sort_fields)
+    if not (config.watch_changes and DATA_VERSIONS.watched):
+        return None
+    cache_key = _get_cache_key(
+        document_type=document_type,
+        search_query=search_query,
+        filters=filters,
+        return_facets=return_facets,
+        skip=skip,
+        limit=limit,
+        after=after,
+        max_facet_options=max_facet_options,
+        disjunctive_facets=disjunctive_facets,
+        fields=fields,
+        expand=expand,
+        sort=sort,
+    )
+    collection_names = get_search_collections(document_type, filters, fields, expand)
+    approximate = DATA_VERSIONS.is_approximate(collection_names)
+    return make_search_etag(
+        cache_key, max_age=config.approximate_etag_max_age if approximate else None
+    )
+
+
+def _get_cache_key(document_type: str, filters: List = None, **kwargs) -> str:
+    """
+    Get the cache key of a search with the current data versions of all
+    collections that it depends on.
+
+    Args:
+        document_type: The type of document
+        filters: A list of filters
+        kwargs: The other parameters of the search (see ``make_search_cache_key``)
+
+    Returns:
+        The cache key
+    """
+    collection_names = get_search_collections(
+        document_type, filters, kwargs.get("fields"), kwargs.get("expand")
+    )
+    return make_search_cache_key(
+        document_type=document_type,
+        filters=filters,
+        data_versions=DATA_VERSIONS.get(collection_names),
+        **kwargs,
+    )
+
+
+async def perform_batch_search(
+    searches: List[Dict], config: Config = CONFIG
+) -> List[Dict]:
+    """
+    Perform a batch of searches concurrently, of which at most the
+    configured ``batch_max_concurrency`` run at the same time.
+
+    Searches that are equivalent (see ``make_search_cache_key``)
+    are only performed once.
+
+    Args:
+        searches: The keyword arguments of ``perform_search`` for each search
+        config: The config
+
+    Returns:
+        The search results, in the same order as the searches
+
+    """
+    semaphore = asyncio.Semaphore(config.batch_max_concurrency)
+
+    # referenced documents are shared between the searches of a batch
+    loader = ReferenceLoader(config)
+
+    async def limited_search(search: Dict) -> Dict:
+        async with semaphore:
+            return await perform_search(config=config, loader=loader, **search)
+
+    unique_searches: Dict[str, Dict] = {}
+    keys = []
+    for search in searches:
+        key = make_search_cache_key(**search)
+        unique_searches.setdefault(key, search)
+        keys.append(key)
+    results = await asyncio.gather(
+        *[limited_search(search) for search in unique_searches.values()]
     )
-    hits = [{"document_type": document_type, "id": x["id"], "content": x} for x in docs]
-    facets = []
-    if return_facets and facet_results:
-        for facet_result in facet_results:
-            for key, value in facet_result.items():
-                facet = {
-                    "key": key.replace("__", "."),
-                    "name": format_facet_key(key.replace("__", ".")),
-                    "options": [],
-                }
-                for val in value:
-                    if val["_id"]:
-                        if isinstance(val["_id"], str):
-                            facet_key = val["_id"]
-                        else:
-                            facet_key = val["_id"][0]
-                    else:
-                        facet_key = str(val["_id"])
-                    facet_option = {
-                        "option": facet_key,
-                        "count": val["count"],
-                    }
-                    facet["options"].append(facet_option)
-                facets.append(facet)
-    return hits, facets, count
+    results_by_key = dict(zip(unique_searches.keys(), results))
+    return [results_by_key[key] for key in keys]
+
+
+async def perform_federated_search(
+    search_query: str = "*",
+    skip: int = 0,
+    limit: int = 10,
+    config: Config = CONFIG,
+) -> Dict:
+    """
+    Perform a search on all document types of the metadata store at once
+    and merge their hits into a single list, ordered by relevance.
+
+    The search runs concurrently on each collection. Collections that do
+    not respond within the configured ``federated_search_timeout`` are
+    left out, and the result is marked as partial.
+
+    Args:
+        search_query: The search query string to use for text serach
+        skip: The number of documents to skip
+        limit: The total number of documents to retrieve
+        config: The config
+
+    Returns:
+        A search result with a list of hits, the total count and the
+        count per document type, and whether or not the result is partial
+
+    """
+    backend = get_backend(config)
+    document_types = list(DEFAULT_FACET_FIELDS.keys())
+    tasks = [
+        asyncio.create_task(
+            backend.get_ranked_documents(
+                collection_name=document_type,
+                search_query=search_query,
+                facet_fields=DEFAULT_FACET_FIELDS[document_type],
+                limit=skip + limit,
+            )
+        )
+        for document_type in document_types
+    ]
+    done, pending = await asyncio.wait(tasks, timeout=config.federated_search_timeout)
+    for task in pending:
+        task.cancel()
+
+    ranked_hits = []
+    counts = []
+    for document_type, task in zip(document_types, tasks):
+        if task not in done:
+            logging.warning("Federated search on %s timed out", document_type)
+            continue
+        ranked_docs, count = task.result()
+        counts.append({"document_type": document_type, "count": count})
+        # each list is already ordered by descending score
+        ranked_hits.append(
+            [
+                (-score, document_type, rank, doc)
+                for rank, (score, doc) in enumerate(ranked_docs)
+            ]
+        )
+    merged_hits = heapq.merge(*ranked_hits, key=lambda hit: hit[:3])
+    hits = [
+        {"document_type": document_type, "id": doc["id"], "content": doc}
+        for _, document_type, _, doc in itertools.islice(
+            merged_hits, skip, skip + limit
+        )
+    ]
+    return {
+        "count": sum(x["count"] for x in counts),
+        "counts": counts,
+        "hits": hits,
+        "partial": bool(pending),
+    }
+
+
+async def export_search(
+    document_type: str,
+    search_query: str = "*",
+    filters: List = None,
+    config: Config = CONFIG,
+    fields: Optional[List[str]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Export all documents that match a given search query as
+    newline-delimited JSON, with one hit per line.
+
+    Hits are written as they are read from the metadata store, in chunks
+    of the configured ``export_batch_size``, such that the memory usage
+    does not depend on the number of hits.
+
+    Args:
+        document_type: The type of document
+        search_query: The search query string to use for text serach
+        filters: A list of filters
+        config: The config
+        fields: The fields to include in each hit. Defaults to the configured
+            default fields of the document type, or all fields
+
+    Yields:
+        Chunks of newline-delimited JSON
+
+    """
+    lines: List[bytes] = []
+    async for doc in get_backend(config).iter_documents(
+        collection_name=document_type,
+        search_query=search_query,
+        filters=filters,
+        facet_fields=DEFAULT_FACET_FIELDS[document_type],
+        fields=get_search_fields(document_type, fields, config),
+    ):
+        hit = {"document_type": document_type, "id": doc["id"], "content": doc}
+        # serialized like the hits of the other search endpoints
+        lines.append(
+            orjson.dumps(
+                hit,
+                default=str,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE,
+            )
+        )
+        if len(lines) >= config.export_batch_size:
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
@@ -15,7 +15,14 @@
 """Core utilities for the Metadata Search Service"""
 
 import time
-from typing import Any, Dict, Set
+from typing import Any, Dict, List, Optional, Set
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.dao.utils import (
+    get_reference_collection_name,
+    get_referenced_collections,
+    get_sparse_fields,
+)
 
 DEFAULT_FACET_FIELDS: Dict[str, Set[Any]] = {
     "Dataset": {"type", "has_study.type"},
@@ -30,6 +37,34 @@ DEFAULT_FACET_FIELDS: Dict[str, Set[Any]] = {
 }
 
 
+def get_search_collections(
+    document_type: str,
+    filters: List = None,
+    fields: Optional[List[str]] = None,
+    expand: Optional[List[str]] = None,
+) -> Set[str]:
+    """
+    Get the names of all collections that the result of a search
+    on a given document type depends on.
+
+    Args:
+        document_type: The type of document
+        filters: A list of filters
+        fields: A list of fields to include in each hit
+        expand: A list of reference fields to expand in each hit
+
+    Returns:
+        A set of collection names
+    """
+    fields = [*DEFAULT_FACET_FIELDS[document_type], *(fields or [])]
+    fields.extend(x.key for x in filters or [])
+    return {
+        document_type,
+        *get_referenced_collections(fields),
+        *(get_reference_collection_name(x) for x in expand or []),
+    }
+
+
 def get_time_in_millis() -> int:
     """
     Get current time in milliseconds.
@@ -40,6 +75,85 @@ def get_time_in_millis() -> int:
     return int(round(time.time() * 1000))
 
 
+def get_facet_max_options(
+    facet_fields: Set[str], config: Config = CONFIG, max_facet_options: int = None
+) -> Dict[str, int]:
+    """
+    Get the maximum number of options to return for each facet field.
+
+    Args:
+        facet_fields: A set of fields to facet on
+        config: The config
+        max_facet_options: The maximum number of options for all facet
+            fields, which overrides the configured maximum
+
+    Returns:
+        A dictionary that maps each facet field to its maximum number of options
+    """
+    return {
+        field: max_facet_options
+        or config.facet_max_options_per_field.get(field, config.facet_max_options)
+        for field in facet_fields
+    }
+
+
+def get_search_fields(
+    document_type: str, fields: Optional[List[str]] = None, config: Config = CONFIG
+) -> Optional[List[str]]:
+    """
+    Get the fields to include in each hit of a search.
+
+    Args:
+        document_type: The type of document
+        fields: The requested fields, if any. Otherwise, the configured
+            default fields of the document type are used. A ``*`` stands
+            for all fields
+        config: The config
+
+    Returns:
+        A list of fields, or None to include all fields
+    """
+    if fields is None:
+        fields = config.search_default_fields.get(document_type)
+    if not fields or "*" in fields:
+        return None
+    return get_sparse_fields(fields)
+
+
+def format_facets(facet_results: List[Dict]) -> List[Dict]:
+    """
+    Format the facets as retrieved from the metadata store.
+
+    Args:
+        facet_results: A list of facets, each mapping a facet key
+            to the counts of its top values and of all other values
+
+    Returns:
+        A list of facets with their key, name and options
+    """
+    facets = []
+    for facet_result in facet_results:
+        for key, value in facet_result.items():
+            facet = {
+                "key": key.replace("__", "."),
+                "name": format_facet_key(key.replace("__", ".")),
+                "options": [],
+                "other": value["other"],
+            }
+            for val in value["options"]:
+                if isinstance(val["_id"], str):
+                    facet_key = val["_id"]
+                else:
+                    facet_key = str(val["_id"])
+                facet_option = {
+                    "option": facet_key,
+                    "count": val["count"],
+                }
+                facet["options"].append(facet_option)
+            facets.append(facet)
+    return facets
+
+
 def format_facet_key(
     key: str, top_level_document_type: str = None, separator: str = " "
 ):
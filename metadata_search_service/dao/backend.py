@@ -0,0 +1,161 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The interface of the search backends and the choice between them"""
+
+from typing import AsyncIterator, Callable, Dict, List, Optional, Protocol, Set, Tuple
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.dao.document import MongoSearchBackend
+from metadata_search_service.dao.memory_index import MemorySearchBackend
+from metadata_search_service.dao.sqlite_index import SQLiteSearchBackend
+
+# pylint: disable=too-many-arguments, unnecessary-ellipsis
+
+
+class SearchBackend(Protocol):
+    """
+    A backend that searches, counts, facets and fetches the documents
+    of the metadata store. All backends return the same results, except
+    for the relevance of the hits of a text search, which is up to the backend.
+    """
+
+    # whether or not the backend can return hits as raw BSON documents
+    supports_raw_bson: bool
+
+    async def get_documents(
+        self,
+        collection_name: str,
+        *,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        skip: int = 0,
+        limit: int = 10,
+        return_facets: bool = True,
+        return_count: bool = True,
+        after: Optional[str] = None,
+        max_options: Optional[Dict[str, int]] = None,
+        disjunctive_facets: bool = False,
+        raw_bson: bool = False,
+        fields: Optional[List[str]] = None,
+        sort: Optional[List[Tuple[str, int]]] = None,
+    ) -> Tuple[List[Dict], List[Dict], int, Optional[str]]:
+        """
+        Get a page of the documents of a collection that match a search,
+        together with the facets, the total count and a cursor for the
+        next page (see ``dao.document.get_documents``).
+        """
+        ...
+
+    async def get_ranked_documents(
+        self,
+        collection_name: str,
+        *,
+        search_query: str = "*",
+        facet_fields: Set = None,
+        limit: int = 10,
+    ) -> Tuple[List[Tuple[float, Dict]], int]:
+        """
+        Get the documents of a collection that are most relevant for
+        a text search, together with their score and the total count
+        (see ``dao.document.get_ranked_documents``).
+        """
+        ...
+
+    def iter_documents(
+        self,
+        collection_name: str,
+        *,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        batch_size: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncIterator[Dict]:
+        """
+        Iterate over all documents of a collection that match a search
+        (see ``dao.document.iter_documents``).
+        """
+        ...
+
+    async def count_documents(
+        self, collection_name: str, *, search_query: str = "*", filters: List = None
+    ) -> int:
+        """Count the documents of a collection that match a search."""
+        ...
+
+    async def get_facets(
+        self,
+        collection_name: str,
+        *,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        max_options: Optional[Dict[str, int]] = None,
+    ) -> Tuple[List[Dict], int]:
+        """
+        Get the facets and the total count of a search, without
+        retrieving any documents (see ``dao.document.get_facets``).
+        """
+        ...
+
+    async def get_document(
+        self, collection_name: str, document_id: str
+    ) -> Optional[Dict]:
+        """Get a document by its ID, or None if there is none."""
+        ...
+
+    async def get_references(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """Get the documents with the given IDs that exist, by their ID."""
+        ...
+
+
+# The available backends by the name that is used for them in the config
+SEARCH_BACKENDS: Dict[str, Callable[[Config], SearchBackend]] = {
+    "mongodb": MongoSearchBackend,
+    "memory": MemorySearchBackend,
+    "sqlite": SQLiteSearchBackend,
+}
+
+
+def get_backend(config: Config = CONFIG) -> SearchBackend:
+    """
+    Get the search backend that is chosen in the config.
+
+    Args:
+        config: The config
+
+    Returns:
+        The search backend
+    """
+    return SEARCH_BACKENDS[config.search_backend](config)
+
+
+def reads_metadata_store(config: Config = CONFIG) -> bool:
+    """
+    Check whether the search backend that is chosen in the config reads the
+    metadata store while serving requests, as opposed to a prebuilt file.
+
+    Args:
+        config: The config
+
+    Returns:
+        Whether or not the backend reads the metadata store
+    """
+    if config.search_backend == "memory":
+        return config.memory_snapshot_path is None
+    return config.search_backend == "mongodb"
@@ -15,15 +15,68 @@
 
 """Connects to database."""
 
+import logging
+from typing import Dict
+
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
 
 from metadata_search_service.config import CONFIG, Config
 
+# One pooled client per database URL and worker process,
+# shared by all requests that are served by this worker
+_DB_CLIENTS: Dict[str, AsyncIOMotorClient] = {}
+
 
 async def get_db_client(config: Config = CONFIG) -> AsyncIOMotorClient:
     """
     Get database client.
+
+    The client is created on first use and then shared by all
+    subsequent calls with the same ``db_url``, so that connections
+    are pooled instead of being established for every request.
     """
     db_url = config.db_url
-    db_client = AsyncIOMotorClient(db_url)
+    db_client = _DB_CLIENTS.get(db_url)
+    if db_client is None:
+        db_client = AsyncIOMotorClient(
+            db_url,
+            maxPoolSize=config.db_max_pool_size,
+            minPoolSize=config.db_min_pool_size,
+            maxIdleTimeMS=config.db_max_idle_time_ms,
+        )
+        _DB_CLIENTS[db_url] = db_client
     return db_client
+
+
+async def connect_db(config: Config = CONFIG) -> None:
+    """
+    Create the shared database client and warm up its connection pool.
+    Meant to be called on application startup.
+
+    The database is probed with a short server selection timeout first,
+    so that startup is not blocked for long if it is not reachable.
+    """
+    probe_client: AsyncIOMotorClient = AsyncIOMotorClient(
+        config.db_url, serverSelectionTimeoutMS=config.db_startup_timeout_ms
+    )
+    try:
+        await probe_client.admin.command("ping")
+        db_client = await get_db_client(config)
+        await db_client.admin.command("ping")
+    except PyMongoError as exc:
+        # the service should still come up if the database is not yet
+        # reachable; the pool will connect on first use
+        logging.warning("Could not reach database at startup: %s", exc)
+    finally:
+        probe_client.close()
+
+
+def close_db() -> None:
+    """
+    Close all shared database clients.
+    Meant to be called on application shutdown.
+    """
+    for db_client in _DB_CLIENTS.values():
+        db_client.close()
+    _DB_CLIENTS.clear()
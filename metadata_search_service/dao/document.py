@@ -14,12 +14,30 @@
 # limitations under the License.
 """DAO for retrieving a document from the metadata store"""
 
+import asyncio
 import logging
-from typing import Dict, List, Set, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
 
 from metadata_search_service.config import CONFIG, Config
 from metadata_search_service.dao.db import get_db_client
-from metadata_search_service.dao.utils import build_aggregation_query
+from metadata_search_service.dao.utils import (
+    RAW_KEY_FIELD,
+    SORT_KEY_FIELD,
+    build_aggregation_query,
+    build_count_query,
+    build_facet_queries,
+    build_raw_query,
+    build_reference_query,
+    build_sort,
+    check_filter_field,
+    decode_cursor,
+    encode_cursor,
+    group_filters,
+)
 
 # pylint: disable=too-many-locals, too-many-nested-blocks, too-many-arguments
 
@@ -32,10 +50,30 @@ async def get_documents(
     skip: int = 0,
     limit: int = 10,
     config: Config = CONFIG,
-) -> Tuple[List[Dict], List[Dict], int]:
+    return_facets: bool = True,
+    return_count: bool = True,
+    after: Optional[str] = None,
+    max_options: Optional[Dict[str, int]] = None,
+    disjunctive_facets: bool = False,
+    raw_bson: bool = False,
+    fields: Optional[List[str]] = None,
+    sort: Optional[List[Tuple[str, int]]] = None,
+) -> Tuple[List[Dict], List[Dict], int, Optional[str]]:
     """
     Get documents from a given ``collection_name``.
 
+    The page of documents, the total count and each facet are retrieved
+    with independent aggregation queries that run concurrently.
+
+    With ``raw_bson``, only the ID of each document is decoded, while its
+    content is returned as ``RawBSONDocument`` (see ``build_raw_query``).
+
+    If the page is full, a cursor is returned that can be passed
+    as ``after`` to efficiently retrieve the next page.
+
+    The hits of a text search are sorted by relevance by default,
+    all other hits in the order of their insertion.
+
     Args:
         collection_name: The name of the collection from which to fetch the documents
         search_query: The search query string to use for text serach
@@ -43,81 +81,497 @@ async def get_documents(
         facet_fields: A set of fields to facet on
         limit: The total number of documents to retrieve
         config: The config
+        return_facets: Whether or not to compute the facets
+        return_count: Whether or not to count the total number of hits
+        after: A cursor as returned for a previous page
+        max_options: The maximum number of options per facet field
+        disjunctive_facets: Whether or not to ignore the filters on each
+            facet field for its own facet
+        raw_bson: Whether or not to return each document as its ``id``
+            and its raw ``content``
+        fields: A list of fields to include in each document, or None
+            to include all fields
+        sort: The sort fields and directions (see ``build_sort``)
 
     Returns:
         A list of documents from the collection, a list of facets,
-        and a count that represents total number of hits
+        a count that represents total number of hits, and a cursor
+        for the next page
+
+    Raises:
+        InvalidCursorError: If ``after`` is not a valid cursor
+
+    """
+    sort = sort or build_sort(None, search_query)
+    after_key = decode_cursor(after, sort=sort) if after else None
+
+    client = await get_db_client(config)
+    database = client[config.db_name]
+    collection = database[collection_name]
+    reference_filters = await _resolve_reference_filters(database, filters)
+
+    query = build_aggregation_query(
+        search_query=search_query,
+        filters=filters,
+        facet_fields=facet_fields,
+        skip=skip,
+        limit=limit,
+        reference_filters=list(reference_filters.values()),
+        sort=sort,
+        after=after_key,
+        fields=fields,
+    )
+    page_collection = collection
+    if raw_bson:
+        query.extend(build_raw_query())
+        page_collection = collection.with_options(
+            codec_options=CodecOptions(document_class=RawBSONDocument)
+        )
+    docs, (facets, count) = await asyncio.gather(
+        page_collection.aggregate(query).to_list(None),
+        _aggregate_facets(
+            collection=collection,
+            search_query=search_query,
+            filters=filters,
+            reference_filters=reference_filters,
+            facet_fields=facet_fields if return_facets else None,
+            return_count=return_count,
+            max_options=max_options,
+            disjunctive=disjunctive_facets,
+        ),
+    )
+    if raw_bson:
+        sort_keys = [doc[RAW_KEY_FIELD]["sort_key"] for doc in docs]
+        docs = [
+            {"id": doc[RAW_KEY_FIELD]["id"], "content": doc["content"]} for doc in docs
+        ]
+    else:
+        sort_keys = [doc.pop(SORT_KEY_FIELD) for doc in docs]
+    next_cursor = None
+    if limit and len(docs) == limit:
+        next_cursor = encode_cursor(sort=sort, sort_key=sort_keys[-1])
+    return docs, facets, count, next_cursor
+
+
+async def get_ranked_documents(
+    collection_name: str,
+    search_query: str = "*",
+    facet_fields: Set = None,
+    limit: int = 10,
+    config: Config = CONFIG,
+) -> Tuple[List[Tuple[float, Dict]], int]:
+    """
+    Get the documents from a given ``collection_name`` that are most
+    relevant for a text search, together with their text score.
+
+    Without a text search, all documents have the same score of 0
+    and are returned in their default order.
+
+    Args:
+        collection_name: The name of the collection from which to fetch the documents
+        search_query: The search query string to use for text serach
+        facet_fields: A set of fields to facet on, which are looked up
+            for each document
+        limit: The total number of documents to retrieve
+        config: The config
+
+    Returns:
+        A list of text scores and documents, ordered by descending
+        score, and a count that represents total number of hits
 
     """
+    text_search = bool(search_query) and search_query not in {"*"}
+    sort = build_sort(None, search_query)
+
     client = await get_db_client(config)
     collection = client[config.db_name][collection_name]
-    if facet_fields:
-        query = build_aggregation_query(
+    query = build_aggregation_query(
+        search_query=search_query,
+        facet_fields=facet_fields,
+        limit=limit,
+        sort=sort,
+    )
+    docs, count_results = await asyncio.gather(
+        collection.aggregate(query).to_list(None),
+        collection.aggregate(build_count_query(search_query=search_query)).to_list(
+            None
+        ),
+    )
+    ranked_docs = []
+    for doc in docs:
+        sort_key = doc.pop(SORT_KEY_FIELD)
+        ranked_docs.append((sort_key[0] if text_search else 0.0, doc))
+    return ranked_docs, await _get_count(count_results)
+
+
+async def iter_documents(
+    collection_name: str,
+    search_query: str = "*",
+    filters: List = None,
+    facet_fields: Set = None,
+    config: Config = CONFIG,
+    batch_size: Optional[int] = None,
+    fields: Optional[List[str]] = None,
+) -> AsyncIterator[Dict]:
+    """
+    Iterate over all documents from a given ``collection_name`` that match
+    the search query and filters, without loading them into memory at once.
+
+    Documents are fetched from a cursor in batches of ``batch_size``.
+
+    Args:
+        collection_name: The name of the collection from which to fetch the documents
+        search_query: The search query string to use for text serach
+        filters: A list of filters
+        facet_fields: A set of fields to facet on, which are looked up
+            for each document
+        config: The config
+        batch_size: The number of documents to fetch per batch.
+            Defaults to the configured ``export_batch_size``
+        fields: A list of fields to include in each document, or None
+            to include all fields
+
+    Yields:
+        The documents matching the search query and filters
+
+    """
+    client = await get_db_client(config)
+    database = client[config.db_name]
+    reference_filters = await _resolve_reference_filters(database, filters)
+    query = build_aggregation_query(
+        search_query=search_query,
+        filters=filters,
+        facet_fields=facet_fields,
+        limit=0,
+        reference_filters=list(reference_filters.values()),
+        fields=fields,
+    )
+    cursor = database[collection_name].aggregate(
+        query, batchSize=batch_size or config.export_batch_size
+    )
+    async for doc in cursor:
+        doc.pop(SORT_KEY_FIELD, None)
+        yield doc
+
+
+async def count_documents(
+    collection_name: str,
+    search_query: str = "*",
+    filters: List = None,
+    config: Config = CONFIG,
+) -> int:
+    """
+    Count the documents from a given ``collection_name`` that match
+    the search query and filters.
+
+    Args:
+        collection_name: The name of the collection to search
+        search_query: The search query string to use for text serach
+        filters: A list of filters
+        config: The config
+
+    Returns:
+        The total number of hits
+
+    """
+    client = await get_db_client(config)
+    database = client[config.db_name]
+    reference_filters = await _resolve_reference_filters(database, filters)
+    count_query = build_count_query(
+        search_query=search_query,
+        filters=filters,
+        reference_filters=list(reference_filters.values()),
+    )
+    return await _get_count(
+        await database[collection_name].aggregate(count_query).to_list(None)
+    )
+
+
+async def get_facets(
+    collection_name: str,
+    search_query: str = "*",
+    filters: List = None,
+    facet_fields: Set = None,
+    config: Config = CONFIG,
+    max_options: Optional[Dict[str, int]] = None,
+) -> Tuple[List[Dict], int]:
+    """
+    Get the facets and the total number of hits for a search on a given
+    ``collection_name``, without retrieving any documents.
+
+    Args:
+        collection_name: The name of the collection to search
+        search_query: The search query string to use for text serach
+        filters: A list of filters
+        facet_fields: A set of fields to facet on
+        config: The config
+        max_options: The maximum number of options per facet field
+
+    Returns:
+        A list of facets and a count that represents total number of hits
+
+    """
+    client = await get_db_client(config)
+    database = client[config.db_name]
+    reference_filters = await _resolve_reference_filters(database, filters)
+    return await _aggregate_facets(
+        collection=database[collection_name],
+        search_query=search_query,
+        filters=filters,
+        reference_filters=reference_filters,
+        facet_fields=facet_fields,
+        max_options=max_options,
+    )
+
+
+async def _aggregate_facets(
+    collection: AsyncIOMotorCollection,
+    search_query: str = "*",
+    filters: List = None,
+    reference_filters: Dict[str, Dict] = None,
+    facet_fields: Set = None,
+    return_count: bool = True,
+    max_options: Optional[Dict[str, int]] = None,
+    disjunctive: bool = False,
+) -> Tuple[List[Dict], int]:
+    """
+    Run the count query and the facet queries concurrently.
+
+    Args:
+        collection: The collection to search
+        search_query: The search query string to use for text serach
+        filters: A list of filters
+        reference_filters: The resolved filters on nested fields, by filter key
+        facet_fields: A set of fields to facet on
+        return_count: Whether or not to count the total number of hits
+        max_options: The maximum number of options per facet field
+        disjunctive: Whether or not to ignore the filters on each facet field
+            for its own facet
+
+    Returns:
+        A list of facets and a count that represents total number of hits
+    """
+    tasks = []
+    if return_count:
+        count_query = build_count_query(
             search_query=search_query,
             filters=filters,
-            facet_fields=facet_fields,
-            skip=skip,
-            limit=limit,
+            reference_filters=list((reference_filters or {}).values()),
         )
-    else:
-        query = build_aggregation_query(
-            search_query=search_query, filters=filters, skip=skip, limit=limit
+        tasks.append(collection.aggregate(count_query).to_list(None))
+
+    if facet_fields:
+        facet_queries = build_facet_queries(
+            facet_fields=facet_fields,
+            search_query=search_query,
+            filters=filters,
+            reference_filters=reference_filters,
+            max_options=max_options,
+            disjunctive=disjunctive,
         )
+        for facet_query in facet_queries:
+            tasks.append(collection.aggregate(facet_query).to_list(None))
 
-    [results] = await collection.aggregate(query).to_list(None)
-    docs = results["data"]
-    count = await _get_count(results)
+    results = await asyncio.gather(*tasks)
+    count = await _get_count(results.pop(0)) if return_count else 0
 
-    facets = []
-    if facet_fields:
-        for key in results.keys():
-            if key not in {"data", "metadata"}:
-                facet = {
-                    key: sorted(results[key], key=lambda x: x["count"], reverse=True)
-                }
-                facets.append(facet)
-    return docs, facets, count
+    facets: List[Dict] = []
+    for [facet_result] in results:
+        facets.extend({key: facet} for key, facet in facet_result.items())
+    facets.sort(key=lambda facet: next(iter(facet)))
+    return facets, count
 
 
-async def _get_count(results: Dict) -> int:
+async def _resolve_reference_filters(
+    database: AsyncIOMotorDatabase, filters: List = None
+) -> Dict[str, Dict]:
+    """
+    Resolve all filters on nested fields, like ``has_study.type``,
+    into match queries on the local ``has_*`` fields.
+
+    Args:
+        database: The database of the metadata store
+        filters: A list of filters
+
+    Returns:
+        A dictionary that maps each nested filter key to its match query
+    """
+    if not filters:
+        return {}
+    nested_filters = {
+        key: values
+        for key, values in group_filters(filters).items()
+        if check_filter_field(key)
+    }
+    queries = await asyncio.gather(
+        *[
+            _resolve_reference_filter(database, key, values)
+            for key, values in nested_filters.items()
+        ]
+    )
+    return dict(zip(nested_filters.keys(), queries))
+
+
+async def _resolve_reference_filter(
+    database: AsyncIOMotorDatabase, field: str, values: List
+) -> Dict:
+    """
+    Perform a semi-join for a filter on a nested field: first get the IDs
+    of all matching documents from the referenced collection and then
+    turn them into an ``$in`` query on the local ``has_*`` field,
+    which can make use of an index.
+
+    Args:
+        database: The database of the metadata store
+        field: The nested field, like ``has_study.type``
+        values: The values to filter for
+
+    Returns:
+        A match query on the local ``has_*`` field
+    """
+    top_level_field, collection_name, query = build_reference_query(field, values)
+    [(nested_field, _)] = query.items()
+    if check_filter_field(nested_field):
+        # the referenced collection itself is filtered on a nested field
+        query = await _resolve_reference_filter(database, nested_field, values)
+    ids = await database[collection_name].distinct("id", query)
+    return {top_level_field: {"$in": ids}}
+
+
+async def _get_count(results: List[Dict]) -> int:
     """
     Extract the total number of hits as reported by MongoDB
     Args:
-        results: The results object from MongoDB
+        results: The results of the count query from MongoDB
     Returns
         The total number of hits as reported by MongoDB
     """
     count = 0
-    if "metadata" in results:
-        if results["metadata"]:
-            [total] = results["metadata"]
-            count = total["total"]
+    if results:
+        [total] = results
+        count = total["total"]
     return count
 
 
-async def _get_reference(
-    document_id: str, collection_name: str, config: Config = CONFIG
-) -> Dict:
+async def get_document(
+    collection_name: str, document_id: str, config: Config = CONFIG
+) -> Optional[Dict]:
     """
     Given a document ID and a collection name, query the metadata store
     and return the document.
 
     Args:
-        document_id: The ID of the document
         collection_name: The collection in the metadata store that has the document
+        document_id: The ID of the document
+        config: The config
 
-    Returns
-        The document corresponding to ``document_id``
+    Returns:
+        The document corresponding to ``document_id``, or None if there is none
     """
     client = await get_db_client(config)
     collection = client[config.db_name][collection_name]
-    doc = await collection.find_one({"id": document_id})
-    if doc:
-        del doc["_id"]
-    else:
-        logging.warning(
-            "Reference with ID %s not found in collection %s",
-            document_id,
-            collection_name,
-        )
-    return doc
+    return await collection.find_one({"id": document_id}, {"_id": 0})
+
+
+async def get_references(
+    collection_name: str, document_ids: List[str], config: Config = CONFIG
+) -> Dict[str, Dict]:
+    """
+    Given a list of document IDs and a collection name, query the metadata store
+    for all of these documents at once.
+
+    Args:
+        collection_name: The collection in the metadata store that has the documents
+        document_ids: The IDs of the documents
+        config: The config
+
+    Returns:
+        A dictionary that maps the ID of each document that was found to the document
+    """
+    client = await get_db_client(config)
+    collection = client[config.db_name][collection_name]
+    docs = await collection.find({"id": {"$in": document_ids}}, {"_id": 0}).to_list(
+        None
+    )
+    references = {doc["id"]: doc for doc in docs}
+    for document_id in document_ids:
+        if document_id not in references:
+            logging.warning(
+                "Reference with ID %s not found in collection %s",
+                document_id,
+                collection_name,
+            )
+    return references
+
+
+async def get_all_documents(config: Config = CONFIG) -> Dict[str, List[Dict]]:
+    """
+    Take a snapshot of all collections of the metadata store.
+
+    Args:
+        config: The config
+
+    Returns:
+        A dictionary that maps each collection name to its documents,
+        in the order of their ``_id``
+    """
+    client = await get_db_client(config)
+    database = client[config.db_name]
+    collection_names = await database.list_collection_names()
+    snapshots = await asyncio.gather(
+        *[
+            database[name].find({}, {"_id": 0}).sort("_id", 1).to_list(None)
+            for name in collection_names
+        ]
+    )
+    return dict(zip(collection_names, snapshots))
+
+
+class MongoSearchBackend:
+    """
+    The search backend for the metadata store, which runs aggregation
+    pipelines on MongoDB (see the functions of this module).
+    """
+
+    supports_raw_bson = True
+
+    def __init__(self, config: Config = CONFIG):
+        self.config = config
+
+    async def get_documents(
+        self, collection_name: str, **kwargs
+    ) -> Tuple[List[Dict], List[Dict], int, Optional[str]]:
+        """Get a page of the documents that match a search (see ``get_documents``)."""
+        return await get_documents(collection_name, config=self.config, **kwargs)
+
+    async def get_ranked_documents(
+        self, collection_name: str, **kwargs
+    ) -> Tuple[List[Tuple[float, Dict]], int]:
+        """Get the most relevant documents (see ``get_ranked_documents``)."""
+        return await get_ranked_documents(collection_name, config=self.config, **kwargs)
+
+    def iter_documents(self, collection_name: str, **kwargs) -> AsyncIterator[Dict]:
+        """Iterate over all documents that match a search (see ``iter_documents``)."""
+        return iter_documents(collection_name, config=self.config, **kwargs)
+
+    async def count_documents(self, collection_name: str, **kwargs) -> int:
+        """Count the documents that match a search (see ``count_documents``)."""
+        return await count_documents(collection_name, config=self.config, **kwargs)
+
+    async def get_facets(
+        self, collection_name: str, **kwargs
+    ) -> Tuple[List[Dict], int]:
+        """Get the facets and the count of a search (see ``get_facets``)."""
+        return await get_facets(collection_name, config=self.config, **kwargs)
+
+    async def get_document(
+        self, collection_name: str, document_id: str
+    ) -> Optional[Dict]:
+        """Get a document by its ID (see ``get_document``)."""
+        return await get_document(collection_name, document_id, self.config)
+
+    async def get_references(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """Get the documents with the given IDs (see ``get_references``)."""
+        return await get_references(collection_name, document_ids, self.config)
@@ -0,0 +1,1142 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-memory inverted index over a snapshot of the metadata store"""
+
+import asyncio
+import bisect
+import heapq
+import logging
+import math
+import re
+from abc import ABC, abstractmethod
+from array import array
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.dao.document import get_all_documents
+from metadata_search_service.dao.snapshot_file import FacetColumn, read_snapshot_file
+from metadata_search_service.dao.utils import (
+    SCORE_FIELD,
+    build_facet,
+    build_sort,
+    check_filter_field,
+    decode_cursor,
+    encode_cursor,
+    get_lookup_fields,
+    get_path_values,
+    get_reference_collection_name,
+    get_sort_value,
+    group_facet_fields,
+    group_filters,
+    iter_strings,
+    project_document,
+)
+
+# pylint: disable=too-many-locals, too-many-arguments, too-many-instance-attributes, too-many-lines
+
+# Terms are runs of letters and digits, like in the text index of MongoDB
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+# A quoted phrase, or a term that is excluded if prefixed with a minus sign
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(-?)([^\s"]+)')
+
+T = TypeVar("T")
+
+# One snapshot per database and worker process, shared by all requests
+_MEMORY_INDEXES: Dict[Tuple[str, str], "MemoryIndex"] = {}
+_MEMORY_INDEX_LOADS: Dict[Tuple[str, str], "asyncio.Future[MemoryIndex]"] = {}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text into lower case terms.
+
+    Args:
+        text: The text to split
+
+    Returns:
+        A list of terms
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_text_query(search_query: str) -> Tuple[List[str], List[List[str]], Set[str]]:
+    """
+    Parse a text search query with the syntax of MongoDB's ``$text``.
+
+    Args:
+        search_query: The search query string, like ``exome "whole genome" -mouse``
+
+    Returns:
+        The terms that contribute to the score, the terms of each phrase
+        that a document must contain, and the terms that a document
+        must not contain
+    """
+    terms: List[str] = []
+    phrases: List[List[str]] = []
+    negated: Set[str] = set()
+    for phrase, minus, term in QUERY_PATTERN.findall(search_query):
+        if phrase:
+            phrase_terms = tokenize(phrase)
+            terms.extend(phrase_terms)
+            phrases.append(phrase_terms)
+        elif minus:
+            negated.update(tokenize(term))
+        else:
+            terms.extend(tokenize(term))
+    return terms, phrases, negated
+
+
+def _is_document(value: Any) -> bool:
+    """Check if a value is a document or an array, which are not plain values."""
+    return isinstance(value, (dict, list))
+
+
+class SortOrder(NamedTuple):
+    """
+    The order of the documents of a collection by a sort field, as the
+    distinct sort values in sorted order and the rank of the value of each
+    document among them (see ``get_sort_value``).
+    """
+
+    values: List[Tuple]
+    ranks: Dict[int, int]
+
+    def find(self, value: Any) -> float:
+        """
+        Get the rank of a value with a binary search, or a rank halfway
+        between its neighbours if no document has this value.
+        """
+        sort_value = get_sort_value(value)
+        rank = bisect.bisect_left(self.values, sort_value)
+        if rank < len(self.values) and self.values[rank] == sort_value:
+            return rank
+        return rank - 0.5
+
+
+def _find_after(
+    positions: Sequence[int], key: Callable[[int], Tuple], after: Tuple
+) -> int:
+    """Find the index of the first position whose key comes after a given key."""
+    low, high = 0, len(positions)
+    while low < high:
+        middle = (low + high) // 2
+        if key(positions[middle]) <= after:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class CollectionIndex:
+    """
+    Inverted index over the documents of a single collection.
+
+    The postings of each term are kept in compact arrays of document
+    positions and field weighted term frequencies, which are ranked
+    with BM25. Exact values of fields are indexed on first use,
+    for filtering. An index can also be loaded from a snapshot file
+    (see ``from_snapshot``).
+    """
+
+    def __init__(
+        self,
+        documents: List[Dict],
+        field_weights: Optional[Dict[str, float]] = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.documents: Sequence[Dict] = documents
+        self.k1 = k1
+        self.b = b
+        self.positions: Mapping[Any, int] = {
+            doc["id"]: i for i, doc in enumerate(documents) if "id" in doc
+        }
+        self.terms: Mapping[str, int] = {}
+        self.lengths: Sequence[float] = array("f")
+        self.facet_columns: Dict[str, FacetColumn] = {}
+        field_weights = field_weights or {}
+
+        terms: Dict[str, int] = {}
+        lengths = array("f")
+        postings: List[List[int]] = []
+        frequencies: List[List[float]] = []
+        for position, doc in enumerate(documents):
+            weighted_frequencies: Dict[int, float] = {}
+            length = 0.0
+            for field, value in doc.items():
+                weight = field_weights.get(field, 1.0)
+                if not weight:
+                    continue
+                for text in iter_strings(value):
+                    for token in tokenize(text):
+                        term = terms.setdefault(token, len(terms))
+                        if term == len(postings):
+                            postings.append([])
+                            frequencies.append([])
+                        weighted_frequencies[term] = (
+                            weighted_frequencies.get(term, 0.0) + weight
+                        )
+                        length += weight
+            for term, frequency in weighted_frequencies.items():
+                postings[term].append(position)
+                frequencies[term].append(frequency)
+            lengths.append(length)
+
+        self.terms = terms
+        self.lengths = lengths
+        self.postings: Sequence[Sequence[int]] = [array("I", x) for x in postings]
+        self.frequencies: Sequence[Sequence[float]] = [
+            array("f", x) for x in frequencies
+        ]
+        self.average_length = sum(lengths) / len(documents) if documents else 0.0
+        self._values: Dict[str, Dict[Any, array]] = {}
+
+    @classmethod
+    def from_snapshot(cls, components: Dict[str, Any]) -> "CollectionIndex":
+        """
+        Create an index from the memory-mapped arrays of a snapshot file,
+        without indexing the documents again.
+
+        Args:
+            components: The values of all attributes of the index
+                (see ``read_snapshot_file``)
+
+        Returns:
+            The index of the collection
+        """
+        index = cls.__new__(cls)
+        index.__dict__.update(components)
+        index._values = {}  # pylint: disable=protected-access
+        return index
+
+    def score(self, search_query: str) -> Dict[int, float]:
+        """
+        Score all documents that match a text search query with BM25.
+
+        Like MongoDB's ``$text``, a document matches if it contains any
+        of the terms, all terms of each quoted phrase (regardless of their
+        order) and none of the terms prefixed with a minus sign.
+
+        Args:
+            search_query: The search query string
+
+        Returns:
+            A dictionary that maps the position of each matching document
+            to its score
+        """
+        terms, phrases, negated = parse_text_query(search_query)
+        num_documents = len(self.documents)
+        scores: Dict[int, float] = {}
+        for token in set(terms):
+            term = self.terms.get(token)
+            if term is None:
+                continue
+            postings = self.postings[term]
+            idf = math.log(
+                1 + (num_documents - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for position, frequency in zip(postings, self.frequencies[term]):
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.lengths[position] / self.average_length
+                )
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (
+                    self.k1 + 1
+                ) / (frequency + norm)
+
+        for phrase in phrases:
+            for token in phrase:
+                term = self.terms.get(token)
+                required = set(self.postings[term]) if term is not None else set()
+                scores = {k: v for k, v in scores.items() if k in required}
+        for token in negated:
+            term = self.terms.get(token)
+            if term is not None:
+                for position in self.postings[term]:
+                    scores.pop(position, None)
+        return scores
+
+    def match(self, field: str, values: List) -> Set[int]:
+        """
+        Get all documents that have one of the given values in a field.
+
+        Args:
+            field: A field of this collection, like ``type`` or ``has_attribute.key``
+            values: The values to match
+
+        Returns:
+            The positions of the matching documents
+        """
+        value_index = self._get_value_index(field)
+        positions: Set[int] = set()
+        for value in values:
+            positions.update(value_index.get(value, ()))
+        return positions
+
+    def _get_value_index(self, field: str) -> Dict[Any, array]:
+        """Get the positions of all documents by each value of a field."""
+        value_index = self._values.get(field)
+        if value_index is None:
+            positions: Dict[Any, List[int]] = {}
+            for position, values in enumerate(self._iter_field_values(field)):
+                for value in values:
+                    value_positions = positions.setdefault(value, [])
+                    if not value_positions or value_positions[-1] != position:
+                        value_positions.append(position)
+            value_index = {k: array("I", v) for k, v in positions.items()}
+            self._values[field] = value_index
+        return value_index
+
+    def _iter_field_values(self, field: str) -> Iterator[List]:
+        """
+        Get the plain values of a field for each document, from its facet
+        column if there is one, which avoids decoding the documents.
+        """
+        column = self.facet_columns.get(field)
+        if column is not None and not check_filter_field(field):
+            for position in range(len(self.documents)):
+                yield column.get_values(position)
+        else:
+            path = field.split(".")
+            for doc in self.documents:
+                yield [x for x in get_path_values(doc, path) if not _is_document(x)]
+
+
+class SnapshotIndex(ABC):
+    """
+    Searches a snapshot of all collections of the metadata store, with the
+    same results as the aggregation pipelines for the metadata store, except
+    that hits of a text search are ranked by BM25.
+
+    Documents are identified by their position within their collection.
+    Subclasses store the snapshot and implement ``search``, ``count_facets``,
+    ``get_hits`` and ``get_documents_by_id``, while paging, cursors and
+    facets of disjunctive groups are shared.
+    """
+
+    def __init__(self):
+        self._sort_orders: Dict[Tuple[str, str], SortOrder] = {}
+
+    @abstractmethod
+    def search(
+        self, collection_name: str, search_query: str = "*", filters: List = None
+    ) -> Tuple[List[int], Dict[int, float]]:
+        """
+        Get all documents of a collection that match a search query and filters.
+
+        Args:
+            collection_name: The name of the collection to search
+            search_query: The search query string to use for text serach
+            filters: A list of filters
+
+        Returns:
+            The positions of the matching documents in the order of the hits,
+            and the score of each matching document for a text search
+        """
+
+    @abstractmethod
+    def count_facets(
+        self,
+        collection_name: str,
+        positions: List[int],
+        facet_fields: Set,
+        max_options: Optional[Dict[str, int]] = None,
+    ) -> List[Dict]:
+        """
+        Count the values of facet fields within a set of documents.
+
+        Args:
+            collection_name: The name of the collection
+            positions: The positions of the documents to count
+            facet_fields: A set of fields to facet on
+            max_options: The maximum number of options per facet field
+
+        Returns:
+            A list of facets in the format of the facet queries
+            (see ``build_facet_query``)
+        """
+
+    @abstractmethod
+    def get_hits(
+        self,
+        collection_name: str,
+        positions: List[int],
+        filters: Optional[List] = None,
+        facet_fields: Optional[Set] = None,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict]:
+        """
+        Turn documents into search hits, where the reference fields that are
+        needed for the filters, facets and fields are replaced by the
+        referenced documents (see ``project_document``).
+
+        Args:
+            collection_name: The name of the collection
+            positions: The positions of the documents
+            filters: A list of filters
+            facet_fields: A set of fields to facet on
+            fields: A list of fields to include in each document, or None
+                to include all fields
+
+        Returns:
+            The search hits in the order of the positions
+        """
+
+    @abstractmethod
+    def get_documents_by_id(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """
+        Get the documents of a collection with the given IDs.
+
+        Args:
+            collection_name: The name of the collection
+            document_ids: The IDs of the documents
+
+        Returns:
+            A dictionary that maps the ID of each document that was found
+            to a copy of the document
+        """
+
+    def get_documents(
+        self,
+        collection_name: str,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        skip: int = 0,
+        limit: int = 10,
+        return_facets: bool = True,
+        return_count: bool = True,
+        after: Optional[str] = None,
+        max_options: Optional[Dict[str, int]] = None,
+        disjunctive_facets: bool = False,
+        fields: Optional[List[str]] = None,
+        sort: Optional[List[Tuple[str, int]]] = None,
+    ) -> Tuple[List[Dict], List[Dict], int, Optional[str]]:
+        """
+        Search the documents of a collection, like ``get_documents`` does
+        with the metadata store, where the position of a document takes
+        the place of its ``_id``.
+
+        Args:
+            collection_name: The name of the collection to search
+            search_query: The search query string to use for text serach
+            filters: A list of filters
+            facet_fields: A set of fields to facet on
+            skip: The number of documents to skip
+            limit: The total number of documents to retrieve
+            return_facets: Whether or not to compute the facets
+            return_count: Whether or not to count the total number of hits
+            after: A cursor as returned for a previous page
+            max_options: The maximum number of options per facet field
+            disjunctive_facets: Whether or not to ignore the filters on each
+                facet field for its own facet
+            fields: A list of fields to include in each document, or None
+                to include all fields
+            sort: The sort fields and directions (see ``build_sort``)
+
+        Returns:
+            A list of documents from the collection, a list of facets,
+            a count that represents total number of hits, and a cursor
+            for the next page
+
+        Raises:
+            InvalidCursorError: If ``after`` is not a valid cursor
+        """
+        positions, scores = self.search(collection_name, search_query, filters)
+        default_sort = build_sort(None, search_query)
+        sort = sort or default_sort
+        after_key = decode_cursor(after, sort=sort) if after else None
+        sort_orders = {
+            field: self.get_sort_order(collection_name, field)
+            for field, _ in sort
+            if field not in {SCORE_FIELD, "_id"}
+        }
+
+        def get_order_key(position: int) -> Tuple:
+            # all parts are numbers, which are negated for descending order
+            return tuple(
+                direction
+                * (
+                    scores.get(position, 0.0)
+                    if field == SCORE_FIELD
+                    else position
+                    if field == "_id"
+                    else sort_orders[field].ranks[position]
+                )
+                for field, direction in sort
+            )
+
+        after_order_key = (
+            tuple(
+                direction
+                * (sort_orders[field].find(value) if field in sort_orders else value)
+                for (field, direction), value in zip(sort, after_key)
+            )
+            if after_key is not None
+            else None
+        )
+        page: List[int] = positions
+        if sort == default_sort:
+            # the hits are in the default order already
+            if after_order_key is not None:
+                page = page[_find_after(page, get_order_key, after_order_key) :]
+        else:
+            if after_order_key is not None:
+                page = [x for x in page if get_order_key(x) > after_order_key]
+            # only the hits up to the end of the page need to be in order
+            page = (
+                heapq.nsmallest(skip + limit, page, key=get_order_key)
+                if limit
+                else sorted(page, key=get_order_key)
+            )
+        page = page[skip : skip + limit] if limit else page[skip:]
+
+        docs = self.get_hits(collection_name, page, filters, facet_fields, fields)
+        next_cursor = None
+        if limit and len(docs) == limit:
+            last = page[-1]
+            sort_key = [
+                scores.get(last, 0.0)
+                if field == SCORE_FIELD
+                else last
+                if field == "_id"
+                else self.get_sort_values(collection_name, [last], field)[last]
+                for field, _ in sort
+            ]
+            next_cursor = encode_cursor(sort=sort, sort_key=sort_key)
+
+        facets: List[Dict] = []
+        if return_facets and facet_fields:
+            for group_fields, group_filters_ in group_facet_fields(
+                facet_fields, filters, disjunctive_facets
+            ):
+                group_positions = positions
+                if len(group_filters_) != len(filters or []):
+                    group_positions, _ = self.search(
+                        collection_name, search_query, group_filters_
+                    )
+                facets.extend(
+                    self.count_facets(
+                        collection_name, group_positions, group_fields, max_options
+                    )
+                )
+            facets.sort(key=lambda facet: next(iter(facet)))
+        count = len(positions) if return_count else 0
+        return docs, facets, count, next_cursor
+
+    def get_sort_values(
+        self, collection_name: str, positions: List[int], field: str
+    ) -> Dict[int, Any]:
+        """
+        Get the value of a field to sort documents by, which is the first
+        value of the field, or None if there is none.
+
+        Args:
+            collection_name: The name of the collection
+            positions: The positions of the documents
+            field: The field to sort by
+
+        Returns:
+            A dictionary that maps the position of each document to its value
+        """
+        path = field.split(".")
+        return {
+            position: next(iter(get_path_values(document, path)), None)
+            for position, document in zip(
+                positions, self.get_hits(collection_name, positions)
+            )
+        }
+
+    def get_sort_order(self, collection_name: str, field: str) -> SortOrder:
+        """
+        Get the order of all documents of a collection by a sort field,
+        which is built on first use and then kept with the index.
+
+        Args:
+            collection_name: The name of the collection
+            field: The field to sort by
+
+        Returns:
+            The sort order of the collection
+        """
+        sort_order = self._sort_orders.get((collection_name, field))
+        if sort_order is None:
+            positions, _ = self.search(collection_name)
+            sort_values = {
+                position: get_sort_value(value)
+                for position, value in self.get_sort_values(
+                    collection_name, positions, field
+                ).items()
+            }
+            values = sorted(set(sort_values.values()))
+            value_ranks = {value: rank for rank, value in enumerate(values)}
+            sort_order = SortOrder(
+                values=values,
+                ranks={x: value_ranks[value] for x, value in sort_values.items()},
+            )
+            self._sort_orders[(collection_name, field)] = sort_order
+        return sort_order
+
+    def get_ranked_documents(
+        self,
+        collection_name: str,
+        search_query: str = "*",
+        facet_fields: Set = None,
+        limit: int = 10,
+    ) -> Tuple[List[Tuple[float, Dict]], int]:
+        """
+        Get the documents of a collection that are most relevant for
+        a text search, like ``get_ranked_documents`` does with the metadata store.
+
+        Args:
+            collection_name: The name of the collection to search
+            search_query: The search query string to use for text serach
+            facet_fields: A set of fields to facet on, which are looked up
+                for each document
+            limit: The total number of documents to retrieve
+
+        Returns:
+            A list of BM25 scores and documents, ordered by descending
+            score, and a count that represents total number of hits
+        """
+        positions, scores = self.search(collection_name, search_query)
+        page = positions[:limit] if limit else positions
+        docs = self.get_hits(collection_name, page, None, facet_fields, None)
+        ranked_docs = [(scores.get(x, 0.0), doc) for x, doc in zip(page, docs)]
+        return ranked_docs, len(positions)
+
+    def iter_documents(
+        self,
+        collection_name: str,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        fields: Optional[List[str]] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Dict]:
+        """
+        Iterate over all documents of a collection that match a search.
+
+        Args:
+            collection_name: The name of the collection to search
+            search_query: The search query string to use for text serach
+            filters: A list of filters
+            facet_fields: A set of fields to facet on, which are looked up
+                for each document
+            fields: A list of fields to include in each document, or None
+                to include all fields
+            batch_size: The number of documents that are turned into
+                search hits at once
+
+        Yields:
+            The documents matching the search query and filters
+        """
+        positions, _ = self.search(collection_name, search_query, filters)
+        for start in range(0, len(positions), batch_size):
+            yield from self.get_hits(
+                collection_name,
+                positions[start : start + batch_size],
+                filters,
+                facet_fields,
+                fields,
+            )
+
+    def get_facets(
+        self,
+        collection_name: str,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        max_options: Optional[Dict[str, int]] = None,
+    ) -> Tuple[List[Dict], int]:
+        """
+        Get the facets and the total number of hits for a search.
+
+        Args:
+            collection_name: The name of the collection to search
+            search_query: The search query string to use for text serach
+            filters: A list of filters
+            facet_fields: A set of fields to facet on
+            max_options: The maximum number of options per facet field
+
+        Returns:
+            A list of facets and a count that represents total number of hits
+        """
+        positions, _ = self.search(collection_name, search_query, filters)
+        facets = self.count_facets(
+            collection_name, positions, facet_fields or set(), max_options
+        )
+        return facets, len(positions)
+
+    def get_document(self, collection_name: str, document_id: str) -> Optional[Dict]:
+        """
+        Get a copy of a document by its ID.
+
+        Args:
+            collection_name: The name of the collection
+            document_id: The ID of the document
+
+        Returns:
+            The document, or None if there is none
+        """
+        return self.get_documents_by_id(collection_name, [document_id]).get(document_id)
+
+    def get_references(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """
+        Get the documents of a collection with the given IDs, logging
+        a warning for each ID that was not found.
+
+        Args:
+            collection_name: The name of the collection
+            document_ids: The IDs of the documents
+
+        Returns:
+            A dictionary that maps the ID of each document that was found
+            to a copy of the document
+        """
+        references = self.get_documents_by_id(collection_name, document_ids)
+        for document_id in document_ids:
+            if document_id not in references:
+                logging.warning(
+                    "Reference with ID %s not found in collection %s",
+                    document_id,
+                    collection_name,
+                )
+        return references
+
+
+class MemoryIndex(SnapshotIndex):
+    """
+    Searches a snapshot of all collections of the metadata store in memory,
+    with the same results as the aggregation pipelines for the metadata
+    store, except that hits of a text search are ranked by BM25.
+    """
+
+    def __init__(
+        self,
+        collections: Dict[str, List[Dict]],
+        field_weights: Optional[Dict[str, float]] = None,
+    ):
+        super().__init__()
+        self.collections = {
+            name: CollectionIndex(documents, field_weights)
+            for name, documents in collections.items()
+        }
+        self._empty = CollectionIndex([])
+
+    @classmethod
+    def from_snapshot_file(cls, path: str) -> "MemoryIndex":
+        """
+        Load an index from a snapshot file, whose arrays are memory-mapped
+        (see ``write_snapshot_file``).
+
+        Args:
+            path: The path of the snapshot file
+
+        Returns:
+            The index of the snapshot
+
+        Raises:
+            ValueError: If the file is not a snapshot file of this platform
+        """
+        memory_index = cls({})
+        memory_index.collections = {
+            name: CollectionIndex.from_snapshot(components)
+            for name, components in read_snapshot_file(path).items()
+        }
+        return memory_index
+
+    def get_collection(self, collection_name: str) -> CollectionIndex:
+        """
+        Get the index of a collection, which is empty for unknown collections.
+
+        Args:
+            collection_name: The name of the collection
+
+        Returns:
+            The index of the collection
+        """
+        return self.collections.get(collection_name, self._empty)
+
+    def search(
+        self, collection_name: str, search_query: str = "*", filters: List = None
+    ) -> Tuple[List[int], Dict[int, float]]:
+        """Search the documents of a collection (see ``SnapshotIndex.search``)."""
+        collection = self.get_collection(collection_name)
+        selected = self.select(collection_name, filters)
+        if search_query and search_query not in {"*"}:
+            scores = collection.score(search_query)
+            if selected is not None:
+                scores = {k: v for k, v in scores.items() if k in selected}
+            return sorted(scores, key=lambda x: (-scores[x], x)), scores
+        if selected is None:
+            return list(range(len(collection.documents))), {}
+        return sorted(selected), {}
+
+    def select(self, collection_name: str, filters: List = None) -> Optional[Set[int]]:
+        """
+        Get all documents of a collection that match a list of filters.
+
+        Filters on nested fields are resolved against the referenced
+        collection first, like the semi-joins for the metadata store.
+
+        Args:
+            collection_name: The name of the collection
+            filters: A list of filters
+
+        Returns:
+            The positions of the matching documents, or None without filters
+        """
+        selected: Optional[Set[int]] = None
+        for key, values in group_filters(filters or []).items():
+            if check_filter_field(key):
+                positions = self._match_reference(collection_name, key, values)
+            else:
+                positions = self.get_collection(collection_name).match(key, values)
+            selected = positions if selected is None else selected & positions
+        return selected
+
+    def _match_reference(
+        self, collection_name: str, field: str, values: List
+    ) -> Set[int]:
+        """Get all documents that reference a document matching a nested filter."""
+        top_level_field, nested_field = field.split(".", 1)
+        referenced_name = get_reference_collection_name(top_level_field)
+        referenced = self.get_collection(referenced_name)
+        if check_filter_field(nested_field):
+            positions = self._match_reference(referenced_name, nested_field, values)
+        else:
+            positions = referenced.match(nested_field, values)
+        ids = [referenced.documents[x].get("id") for x in positions]
+        return self.get_collection(collection_name).match(top_level_field, ids)
+
+    def lookup(self, field: str, document: Dict) -> List[Dict]:
+        """
+        Get the documents referenced by a ``has_*`` field of a document,
+        in the order of the referenced collection, like a ``$lookup`` does.
+
+        Args:
+            field: The top level reference field, like ``has_study``
+            document: The referencing document
+
+        Returns:
+            The referenced documents that exist
+        """
+        referenced = self.get_collection(get_reference_collection_name(field))
+        positions = {
+            referenced.positions[x]
+            for x in get_path_values(document, [field])
+            if isinstance(x, str) and x in referenced.positions
+        }
+        return [referenced.documents[x] for x in sorted(positions)]
+
+    def get_facet_values(self, document: Dict, field: str) -> List:
+        """
+        Get the values of a document for a facet field, where each value
+        of a nested field is only counted once per document.
+
+        Args:
+            document: The document
+            field: The facet field, like ``type`` or ``has_study.type``
+
+        Returns:
+            The values of the field, or a single None if there is none
+        """
+        if check_filter_field(field):
+            top_level_field, nested_field = field.split(".", 1)
+            path = nested_field.split(".")
+            values = [
+                value
+                for reference in self.lookup(top_level_field, document)
+                for value in get_path_values(reference, path)
+            ]
+            values = list(dict.fromkeys(x for x in values if not _is_document(x)))
+        else:
+            values = [
+                x
+                for x in get_path_values(document, field.split("."))
+                if not _is_document(x)
+            ]
+        return values or [None]
+
+    def count_facets(
+        self,
+        collection_name: str,
+        positions: List[int],
+        facet_fields: Set,
+        max_options: Optional[Dict[str, int]] = None,
+    ) -> List[Dict]:
+        """
+        Count the values of facet fields within a set of documents.
+
+        Args:
+            collection_name: The name of the collection
+            positions: The positions of the documents to count
+            facet_fields: A set of fields to facet on
+            max_options: The maximum number of options per facet field
+
+        Returns:
+            A list of facets in the format of the facet queries
+            (see ``build_facet_query``)
+        """
+        max_options = max_options or {}
+        collection = self.get_collection(collection_name)
+        facets = []
+        for field in sorted(facet_fields):
+            counts: Dict[Any, int] = {}
+            column = collection.facet_columns.get(field)
+            for position in positions:
+                if column is not None:
+                    values = column.get_values(position)
+                else:
+                    values = self.get_facet_values(
+                        collection.documents[position], field
+                    )
+                for value in values:
+                    counts[value] = counts.get(value, 0) + 1
+            facets.append(
+                {field.replace(".", "__"): build_facet(counts, max_options.get(field))}
+            )
+        return facets
+
+    def get_hits(
+        self,
+        collection_name: str,
+        positions: List[int],
+        filters: Optional[List] = None,
+        facet_fields: Optional[Set] = None,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict]:
+        """Turn documents into search hits (see ``SnapshotIndex.get_hits``)."""
+        documents = self.get_collection(collection_name).documents
+        return [
+            self._project(documents[x], filters, facet_fields, fields)
+            for x in positions
+        ]
+
+    def get_documents_by_id(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """Get documents by their IDs (see ``SnapshotIndex.get_documents_by_id``)."""
+        collection = self.get_collection(collection_name)
+        return {
+            x: dict(collection.documents[collection.positions[x]])
+            for x in document_ids
+            if x in collection.positions
+        }
+
+    def _project(
+        self,
+        document: Dict,
+        filters: Optional[List],
+        facet_fields: Optional[Set],
+        fields: Optional[List[str]],
+    ) -> Dict:
+        """Turn a document into a search hit (see ``project_document``)."""
+        references = {
+            field: self.lookup(field, document)
+            for field in get_lookup_fields(filters, facet_fields, fields)
+        }
+        return project_document(document, references, fields)
+
+
+async def load_memory_index(config: Config = CONFIG) -> MemoryIndex:
+    """
+    Take a snapshot of all collections of the metadata store and index it,
+    or load the snapshot file at ``memory_snapshot_path`` if configured.
+
+    Args:
+        config: The config
+
+    Returns:
+        The index of the snapshot
+    """
+    if config.memory_snapshot_path:
+        return MemoryIndex.from_snapshot_file(config.memory_snapshot_path)
+    collections = await get_all_documents(config)
+    # indexing is CPU bound and must not block the event loop
+    return await asyncio.to_thread(
+        MemoryIndex, collections, config.search_field_weights
+    )
+
+
+async def get_memory_index(config: Config = CONFIG) -> MemoryIndex:
+    """
+    Get the in-memory index of the metadata store.
+
+    The index is built from a snapshot of the metadata store on first use
+    and then shared by all subsequent calls for the same database, until
+    it is cleared with ``clear_memory_indexes``. Calls that arrive while
+    the index is being built wait for that build.
+
+    Args:
+        config: The config
+
+    Returns:
+        The index of the metadata store
+    """
+    key = (config.db_url, config.db_name)
+    memory_index = _MEMORY_INDEXES.get(key)
+    if memory_index is not None:
+        return memory_index
+    # concurrent first calls share a single build of the index
+    load = _MEMORY_INDEX_LOADS.get(key)
+    if load is None or load.cancelled():
+        load = asyncio.ensure_future(load_memory_index(config))
+        _MEMORY_INDEX_LOADS[key] = load
+    try:
+        return await asyncio.shield(load)
+    finally:
+        # the index is only kept if it was not cleared while it was built
+        if load.done() and _MEMORY_INDEX_LOADS.get(key) is load:
+            del _MEMORY_INDEX_LOADS[key]
+            if not load.cancelled() and load.exception() is None:
+                _MEMORY_INDEXES[key] = load.result()
+
+
+def clear_memory_indexes() -> None:
+    """
+    Drop all in-memory indexes, such that they are built from a new
+    snapshot of the metadata store on next use.
+    """
+    _MEMORY_INDEXES.clear()
+    _MEMORY_INDEX_LOADS.clear()
+
+
+class SnapshotSearchBackend(ABC):
+    """
+    The search backend for a ``SnapshotIndex``. Subclasses provide the index,
+    whose methods run in a worker thread, as they are CPU bound or block
+    on disk access and must not stall the event loop.
+    """
+
+    supports_raw_bson = False
+
+    def __init__(self, config: Config = CONFIG):
+        self.config = config
+
+    @abstractmethod
+    async def get_index(self) -> SnapshotIndex:
+        """Get the index to search."""
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Run a method of the index in a worker thread."""
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def get_documents(
+        self,
+        collection_name: str,
+        raw_bson: bool = False,  # pylint: disable=unused-argument
+        **kwargs,
+    ) -> Tuple[List[Dict], List[Dict], int, Optional[str]]:
+        """
+        Get a page of the documents that match a search (see
+        ``SnapshotIndex.get_documents``). Hits are never raw BSON documents.
+        """
+        index = await self.get_index()
+        return await self.run(index.get_documents, collection_name, **kwargs)
+
+    async def get_ranked_documents(
+        self, collection_name: str, **kwargs
+    ) -> Tuple[List[Tuple[float, Dict]], int]:
+        """Get the most relevant documents (see ``SnapshotIndex.get_ranked_documents``)."""
+        index = await self.get_index()
+        return await self.run(index.get_ranked_documents, collection_name, **kwargs)
+
+    async def iter_documents(
+        self,
+        collection_name: str,
+        search_query: str = "*",
+        filters: List = None,
+        facet_fields: Set = None,
+        batch_size: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncIterator[Dict]:
+        """
+        Iterate over all documents that match a search (see
+        ``SnapshotIndex.iter_documents``), turning ``batch_size``
+        documents into search hits at once.
+        """
+        index = await self.get_index()
+        positions, _ = await self.run(
+            index.search, collection_name, search_query, filters
+        )
+        batch_size = batch_size or self.config.export_batch_size
+        for start in range(0, len(positions), batch_size):
+            docs = await self.run(
+                index.get_hits,
+                collection_name,
+                positions[start : start + batch_size],
+                filters,
+                facet_fields,
+                fields,
+            )
+            for doc in docs:
+                yield doc
+
+    async def count_documents(self, collection_name: str, **kwargs) -> int:
+        """Count the documents that match a search (see ``SnapshotIndex.search``)."""
+        index = await self.get_index()
+        positions, _ = await self.run(index.search, collection_name, **kwargs)
+        return len(positions)
+
+    async def get_facets(
+        self, collection_name: str, **kwargs
+    ) -> Tuple[List[Dict], int]:
+        """Get the facets and the count of a search (see ``SnapshotIndex.get_facets``)."""
+        index = await self.get_index()
+        return await self.run(index.get_facets, collection_name, **kwargs)
+
+    async def get_document(
+        self, collection_name: str, document_id: str
+    ) -> Optional[Dict]:
+        """Get a copy of a document by its ID, or None if there is none."""
+        index = await self.get_index()
+        return await self.run(index.get_document, collection_name, document_id)
+
+    async def get_references(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """Get the documents with the given IDs (see ``SnapshotIndex.get_references``)."""
+        index = await self.get_index()
+        return await self.run(index.get_references, collection_name, document_ids)
+
+
+class MemorySearchBackend(SnapshotSearchBackend):
+    """
+    The search backend for the in-memory index of a snapshot of the
+    metadata store, which ranks the hits of a text search by BM25.
+    """
+
+    async def get_index(self) -> SnapshotIndex:
+        """Get the in-memory index (see ``get_memory_index``)."""
+        return await get_memory_index(self.config)
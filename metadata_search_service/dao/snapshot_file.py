@@ -0,0 +1,322 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Snapshot file of the in-memory index, whose flat arrays are memory-mapped
+by every worker instead of indexing the metadata store again"""
+
+import io
+import mmap
+import os
+import sys
+from array import array
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+)
+
+import orjson
+
+if TYPE_CHECKING:
+    from metadata_search_service.dao.memory_index import MemoryIndex
+
+# pylint: disable=no-member
+
+MAGIC = b"MSSIDX01"
+# Every array starts at a multiple of the largest item size
+ALIGNMENT = 8
+
+
+class Ragged:
+    """
+    A sequence of variable length slices of a flat array, like the
+    postings of all terms, where slice ``i`` spans the items from
+    ``offsets[i]`` to ``offsets[i + 1]``.
+    """
+
+    def __init__(self, values: memoryview, offsets: memoryview):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> memoryview:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.values[self.offsets[index] : self.offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        return (self[x] for x in range(len(self)))
+
+
+class DocumentTable:
+    """The documents of a collection, which are decoded on access."""
+
+    def __init__(self, documents: Ragged):
+        self.documents = documents
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __getitem__(self, index: int) -> Dict:
+        return orjson.loads(self.documents[index])
+
+    def __iter__(self) -> Iterator[Dict]:
+        return (self[x] for x in range(len(self)))
+
+
+class SortedKeys(Mapping):
+    """
+    Maps string keys, which are stored in sorted order as UTF-8, to a value
+    per key, or to the rank of the key if there are no values. Keys are
+    looked up with a binary search.
+    """
+
+    def __init__(self, keys: Ragged, values: Optional[memoryview] = None):
+        self.sorted_keys = keys
+        self.key_values = values
+
+    def _find(self, key: Any) -> int:
+        """Get the rank of a key, or -1 if it does not exist."""
+        if not isinstance(key, str):
+            return -1
+        encoded = key.encode()
+        low, high = 0, len(self.sorted_keys)
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.sorted_keys[middle]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.sorted_keys) and bytes(self.sorted_keys[low]) == encoded:
+            return low
+        return -1
+
+    def __getitem__(self, key: Any) -> int:
+        rank = self._find(key)
+        if rank < 0:
+            raise KeyError(key)
+        return rank if self.key_values is None else self.key_values[rank]
+
+    def __iter__(self) -> Iterator[str]:
+        return (bytes(x).decode() for x in self.sorted_keys)
+
+    def __len__(self) -> int:
+        return len(self.sorted_keys)
+
+
+class FacetColumn(NamedTuple):
+    """
+    The values of a facet field for all documents of a collection, as the
+    distinct values and the indexes of the values of each document.
+    """
+
+    values: List
+    value_ids: Ragged
+
+    def get_values(self, position: int) -> List:
+        """Get the values of the document at a position."""
+        return [self.values[x] for x in self.value_ids[position]]
+
+
+class _SnapshotWriter:
+    """Writes aligned arrays to a file and records where they are."""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.offset = 0
+
+    def add(self, data: array) -> List:
+        """Write an array and get its offset, length in bytes and type code."""
+        padding = -self.offset % ALIGNMENT
+        self.file.write(b"\0" * padding)
+        self.offset += padding
+        length = len(data) * data.itemsize
+        section = [self.offset, length, data.typecode]
+        data.tofile(self.file)
+        self.offset += length
+        return section
+
+    def add_ragged(self, items: List, typecode: str) -> Dict[str, List]:
+        """Write a list of arrays or byte strings as a flat array and offsets."""
+        offsets = array("Q", [0])
+        values = array(typecode)
+        for item in items:
+            if isinstance(item, bytes):
+                values.frombytes(item)
+            else:
+                values.extend(item)
+            offsets.append(len(values))
+        return {"values": self.add(values), "offsets": self.add(offsets)}
+
+
+def _add_collection(
+    writer: _SnapshotWriter,
+    memory_index: "MemoryIndex",
+    collection_name: str,
+    facet_fields: Set[str],
+) -> Dict:
+    """Write the arrays of a collection and get its entry for the header."""
+    collection = memory_index.get_collection(collection_name)
+    documents = list(collection.documents)
+    terms = sorted(collection.terms, key=lambda x: x.encode())
+    ids = sorted(
+        (x for x in collection.positions if isinstance(x, str)),
+        key=lambda x: x.encode(),
+    )
+
+    facets = {}
+    for field in sorted(facet_fields):
+        values: Dict[Any, int] = {}
+        value_ids = [
+            array(
+                "I",
+                [
+                    values.setdefault(x, len(values))
+                    for x in memory_index.get_facet_values(document, field)
+                ],
+            )
+            for document in documents
+        ]
+        facets[field] = {
+            "values": list(values),
+            "value_ids": writer.add_ragged(value_ids, "I"),
+        }
+
+    return {
+        "average_length": collection.average_length,
+        "k1": collection.k1,
+        "b": collection.b,
+        "documents": writer.add_ragged(
+            [orjson.dumps(x, default=str) for x in documents], "B"
+        ),
+        "ids": writer.add_ragged([x.encode() for x in ids], "B"),
+        "id_positions": writer.add(array("I", [collection.positions[x] for x in ids])),
+        "terms": writer.add_ragged([x.encode() for x in terms], "B"),
+        "postings": writer.add_ragged(
+            [collection.postings[collection.terms[x]] for x in terms], "I"
+        ),
+        "frequencies": writer.add_ragged(
+            [collection.frequencies[collection.terms[x]] for x in terms], "f"
+        ),
+        "lengths": writer.add(array("f", collection.lengths)),
+        "facets": facets,
+    }
+
+
+def write_snapshot_file(
+    path: str,
+    memory_index: "MemoryIndex",
+    facet_fields: Optional[Dict[str, Set[str]]] = None,
+) -> None:
+    """
+    Write an in-memory index into a snapshot file: the documents, the doc-id
+    table, the term dictionary, the postings and the facet columns of each
+    collection, as flat arrays behind a JSON header that records where they are.
+
+    The file is written to a temporary file first, which then replaces
+    the file at ``path``, such that readers never see a partial snapshot.
+
+    Args:
+        path: The path of the snapshot file
+        memory_index: The in-memory index
+        facet_fields: The facet fields of each collection, whose values are
+            stored as columns for counting them without decoding documents
+    """
+    facet_fields = facet_fields or {}
+    data = io.BytesIO()
+    writer = _SnapshotWriter(data)
+    header = {
+        "byteorder": sys.byteorder,
+        "collections": {
+            name: _add_collection(
+                writer, memory_index, name, facet_fields.get(name, set())
+            )
+            for name in memory_index.collections
+        },
+    }
+    encoded_header = orjson.dumps(header, default=str)
+    # the arrays are aligned relative to the end of the header
+    prefix = MAGIC + len(encoded_header).to_bytes(8, "little") + encoded_header
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(prefix + b"\0" * (-len(prefix) % ALIGNMENT))
+        file.write(data.getbuffer())
+    os.replace(temp_path, path)
+
+
+def read_snapshot_file(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Memory-map a snapshot file. The arrays are not read, but mapped,
+    such that all workers share the same pages of the OS page cache.
+
+    Args:
+        path: The path of the snapshot file
+
+    Returns:
+        The components of the index of each collection
+        (see ``CollectionIndex.from_snapshot``)
+
+    Raises:
+        ValueError: If the file is not a snapshot file of this platform
+    """
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    if bytes(view[: len(MAGIC)]) != MAGIC:
+        raise ValueError(f"{path} is not a snapshot file of the in-memory index.")
+    header_start = len(MAGIC) + 8
+    header_end = header_start + int.from_bytes(
+        view[len(MAGIC) : header_start], "little"
+    )
+    header = orjson.loads(view[header_start:header_end])
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError(f"{path} was written on a platform with another byte order.")
+    data = view[header_end + (-header_end % ALIGNMENT) :]
+
+    def get_array(section: List) -> memoryview:
+        offset, length, typecode = section
+        return data[offset : offset + length].cast(typecode)
+
+    def get_ragged(sections: Dict[str, List]) -> Ragged:
+        return Ragged(get_array(sections["values"]), get_array(sections["offsets"]))
+
+    return {
+        name: {
+            "documents": DocumentTable(get_ragged(entry["documents"])),
+            "positions": SortedKeys(
+                get_ragged(entry["ids"]), get_array(entry["id_positions"])
+            ),
+            "terms": SortedKeys(get_ragged(entry["terms"])),
+            "postings": get_ragged(entry["postings"]),
+            "frequencies": get_ragged(entry["frequencies"]),
+            "lengths": get_array(entry["lengths"]),
+            "average_length": entry["average_length"],
+            "k1": entry["k1"],
+            "b": entry["b"],
+            "facet_columns": {
+                field: FacetColumn(facet["values"], get_ragged(facet["value_ids"]))
+                for field, facet in entry["facets"].items()
+            },
+        }
+        for name, entry in header["collections"].items()
+    }
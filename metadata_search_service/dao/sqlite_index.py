@@ -0,0 +1,467 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read-only SQLite database with a full-text index over a snapshot of the
+metadata store"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import orjson
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.dao.memory_index import (
+    MemoryIndex,
+    SnapshotIndex,
+    SnapshotSearchBackend,
+    parse_text_query,
+)
+from metadata_search_service.dao.utils import (
+    build_facet,
+    check_filter_field,
+    get_lookup_fields,
+    get_path_values,
+    get_reference_collection_name,
+    group_filters,
+    iter_field_values,
+    iter_strings,
+    project_document,
+)
+
+# pylint: disable=too-many-arguments, too-many-locals, no-member
+
+SCHEMA = """
+CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE documents (
+    collection TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    id TEXT,
+    document TEXT NOT NULL,
+    facets TEXT NOT NULL,
+    PRIMARY KEY (collection, position)
+) WITHOUT ROWID;
+CREATE INDEX documents_by_id ON documents (collection, id);
+CREATE TABLE field_values (
+    collection TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value,
+    position INTEGER NOT NULL
+);
+"""
+
+# Created after the bulk insert, which is faster than maintaining them
+INDEXES = """
+CREATE INDEX field_values_by_value ON field_values (collection, field, value);
+"""
+
+# The tokenizer splits at everything but letters and digits, like ``tokenize``
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+
+# One set of connections per database file and worker process
+_SQLITE_INDEXES: Dict[str, "SQLiteIndex"] = {}
+
+
+def _quote(identifier: str) -> str:
+    """Quote an identifier, like a column name, for SQLite."""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _dumps(value: Any) -> str:
+    """Serialize a value as JSON, turning unsupported types into strings."""
+    return orjson.dumps(value, default=str).decode()
+
+
+def get_text_columns(field_weights: Optional[Dict[str, float]] = None) -> List[str]:
+    """
+    Get the fields that are indexed in their own column of the full-text
+    index, such that they can be weighted. All other fields are indexed
+    together in a column named ``text``.
+
+    Args:
+        field_weights: The weights of fields for the text search
+
+    Returns:
+        The sorted list of fields with a weight other than 0 and 1
+    """
+    return sorted(
+        field for field, weight in (field_weights or {}).items() if weight not in {0, 1}
+    )
+
+
+def build_match_expression(search_query: str) -> Optional[str]:
+    """
+    Translate a text search query with the syntax of MongoDB's ``$text``
+    into an FTS5 full-text query with the same meaning as in the in-memory
+    index: any of the terms, all terms of each quoted phrase and none of
+    the negated terms.
+
+    Args:
+        search_query: The search query string, like ``exome "whole genome" -mouse``
+
+    Returns:
+        The FTS5 query, or None if no document can match
+    """
+    terms, phrases, negated = parse_text_query(search_query)
+    if not terms:
+        return None
+    expression = "(" + " OR ".join(f'"{x}"' for x in dict.fromkeys(terms)) + ")"
+    for term in dict.fromkeys(x for phrase in phrases for x in phrase):
+        expression = f'({expression} AND "{term}")'
+    for term in sorted(negated):
+        expression = f'({expression} NOT "{term}")'
+    return expression
+
+
+def build_sqlite_database(
+    path: str,
+    collections: Dict[str, List[Dict]],
+    facet_fields: Optional[Dict[str, Set[str]]] = None,
+    field_weights: Optional[Dict[str, float]] = None,
+) -> None:
+    """
+    Write a snapshot of the metadata store into an SQLite database.
+
+    The database is written to a temporary file first, which then replaces
+    the file at ``path``, such that readers never see a partial database.
+
+    Args:
+        path: The path of the database file
+        collections: The documents of each collection
+        facet_fields: The facet fields of each collection, whose values are
+            stored for counting. Other fields cannot be faceted on.
+        field_weights: The weights of fields for the text search. Fields with
+            a weight of 0 are not indexed, and fields with a weight other
+            than 1 get their own column in the full-text index.
+    """
+    facet_fields = facet_fields or {}
+    field_weights = field_weights or {}
+    text_columns = get_text_columns(field_weights)
+    # resolves the references of nested facet fields
+    memory_index = MemoryIndex(collections)
+
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.executescript(SCHEMA)
+        columns = ", ".join(_quote(x) for x in [*text_columns, "text"])
+        connection.execute(
+            f"CREATE VIRTUAL TABLE documents_fts USING fts5("
+            f"collection UNINDEXED, position UNINDEXED, {columns}, "
+            f"tokenize = '{FTS_TOKENIZER}')"
+        )
+        connection.executemany(
+            "INSERT INTO settings VALUES (?, ?)",
+            [
+                ("text_columns", _dumps(text_columns)),
+                (
+                    "facet_fields",
+                    _dumps({k: sorted(v) for k, v in facet_fields.items()}),
+                ),
+            ],
+        )
+        placeholders = ", ".join("?" * (len(text_columns) + 3))
+        for collection_name, documents in collections.items():
+            collection_facet_fields = sorted(facet_fields.get(collection_name, ()))
+            for position, document in enumerate(documents):
+                facets = {
+                    x: memory_index.get_facet_values(document, x)
+                    for x in collection_facet_fields
+                }
+                connection.execute(
+                    "INSERT INTO documents VALUES (?, ?, ?, ?, ?)",
+                    (
+                        collection_name,
+                        position,
+                        document.get("id"),
+                        _dumps(document),
+                        _dumps(facets),
+                    ),
+                )
+                values = {
+                    (field, value)
+                    for field, value in iter_field_values(document)
+                    if isinstance(value, (str, int, float))
+                }
+                connection.executemany(
+                    "INSERT INTO field_values VALUES (?, ?, ?, ?)",
+                    [(collection_name, *x, position) for x in values],
+                )
+                texts: Dict[str, List[str]] = {}
+                for field, value in document.items():
+                    if field_weights.get(field, 1.0):
+                        column = field if field in text_columns else "text"
+                        texts.setdefault(column, []).extend(iter_strings(value))
+                connection.execute(
+                    f"INSERT INTO documents_fts VALUES ({placeholders})",
+                    (
+                        collection_name,
+                        position,
+                        *("\n".join(texts.get(x, [])) for x in [*text_columns, "text"]),
+                    ),
+                )
+        connection.executescript(INDEXES)
+        connection.commit()
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+    os.replace(temp_path, path)
+
+
+class SQLiteIndex(SnapshotIndex):
+    """
+    Searches a snapshot of the metadata store that was written into an
+    SQLite database with ``build_sqlite_database``, with the same results
+    as the in-memory index, except that hits of a text search are ranked
+    by the BM25 of the FTS5 full-text index.
+
+    The database is opened read-only, with one connection per thread,
+    such that multiple worker processes can share its pages.
+    """
+
+    def __init__(self, path: str, field_weights: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self._local = threading.local()
+        settings = dict(self.connection.execute("SELECT key, value FROM settings"))
+        self.text_columns: List[str] = orjson.loads(settings["text_columns"])
+        self.facet_fields: Dict[str, List[str]] = orjson.loads(settings["facet_fields"])
+        field_weights = field_weights or {}
+        # the unindexed columns come first and are not weighted
+        self.weights = [
+            0.0,
+            0.0,
+            *(field_weights.get(x, 1.0) for x in self.text_columns),
+            1.0,
+        ]
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The read-only connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.uri, uri=True)
+            self._local.connection = connection
+        return connection
+
+    def _build_filter_query(
+        self, collection_name: str, field: str, values: List
+    ) -> Tuple[str, List]:
+        """
+        Build a query for the positions of all documents that have one of
+        the given values in a field. Nested filters are resolved against
+        the referenced collection, like the semi-joins for the metadata store.
+        """
+        query = (
+            "SELECT position FROM field_values WHERE collection = ? AND field = ?"
+            " AND value IN "
+        )
+        if check_filter_field(field):
+            top_level_field, nested_field = field.split(".", 1)
+            referenced_name = get_reference_collection_name(top_level_field)
+            nested_query, nested_params = self._build_filter_query(
+                referenced_name, nested_field, values
+            )
+            return (
+                query + "(SELECT id FROM documents WHERE collection = ?"
+                f" AND position IN ({nested_query}))",
+                [collection_name, top_level_field, referenced_name, *nested_params],
+            )
+        return (
+            query + "(SELECT value FROM json_each(?))",
+            [collection_name, field, _dumps(values)],
+        )
+
+    def search(
+        self, collection_name: str, search_query: str = "*", filters: List = None
+    ) -> Tuple[List[int], Dict[int, float]]:
+        """Search the documents of a collection (see ``SnapshotIndex.search``)."""
+        conditions = ["collection = ?"]
+        params: List = [collection_name]
+        for key, values in group_filters(filters or []).items():
+            filter_query, filter_params = self._build_filter_query(
+                collection_name, key, values
+            )
+            conditions.append(f"position IN ({filter_query})")
+            params.extend(filter_params)
+        where = " AND ".join(conditions)
+
+        if search_query and search_query not in {"*"}:
+            expression = build_match_expression(search_query)
+            if expression is None:
+                return [], {}
+            weights = ", ".join("?" * len(self.weights))
+            rows = self.connection.execute(
+                f"SELECT position, -bm25(documents_fts, {weights}) AS score"
+                f" FROM documents_fts WHERE documents_fts MATCH ? AND {where}"
+                " ORDER BY score DESC, position",
+                [*self.weights, expression, *params],
+            ).fetchall()
+            return [x for x, _ in rows], dict(rows)
+        rows = self.connection.execute(
+            f"SELECT position FROM documents WHERE {where} ORDER BY position", params
+        ).fetchall()
+        return [x for (x,) in rows], {}
+
+    def count_facets(
+        self,
+        collection_name: str,
+        positions: List[int],
+        facet_fields: Set,
+        max_options: Optional[Dict[str, int]] = None,
+    ) -> List[Dict]:
+        """
+        Count the values of facet fields within a set of documents
+        (see ``SnapshotIndex.count_facets``).
+
+        Raises:
+            ValueError: If a facet field was not stored in the database
+        """
+        missing = set(facet_fields) - set(self.facet_fields.get(collection_name, ()))
+        if missing:
+            raise ValueError(
+                f"The facet fields {sorted(missing)} of collection {collection_name}"
+                " are not stored in the database."
+            )
+        max_options = max_options or {}
+        counts: Dict[str, Dict[Any, int]] = {x: {} for x in facet_fields}
+        rows = self.connection.execute(
+            "SELECT field.key, value.value, value.type, count(*)"
+            " FROM documents, json_each(documents.facets) AS field,"
+            " json_each(field.value) AS value"
+            " WHERE collection = ? AND position IN (SELECT value FROM json_each(?))"
+            " AND field.key IN (SELECT value FROM json_each(?))"
+            " GROUP BY field.key, value.value, value.type",
+            [collection_name, _dumps(positions), _dumps(sorted(facet_fields))],
+        )
+        for field, value, value_type, count in rows:
+            # SQLite has no booleans, but keeps their JSON type
+            if value_type in {"true", "false"}:
+                value = value_type == "true"
+            counts[field][value] = count
+        return [
+            {
+                field.replace(".", "__"): build_facet(
+                    counts[field], max_options.get(field)
+                )
+            }
+            for field in sorted(facet_fields)
+        ]
+
+    def _get_documents(
+        self, collection_name: str, column: str, keys: List
+    ) -> List[Tuple[int, Dict]]:
+        """Get the documents with the given IDs or positions, ordered by position."""
+        rows = self.connection.execute(
+            f"SELECT position, document FROM documents WHERE collection = ?"
+            f" AND {column} IN (SELECT value FROM json_each(?)) ORDER BY position",
+            [collection_name, _dumps(keys)],
+        )
+        return [(position, orjson.loads(document)) for position, document in rows]
+
+    def get_hits(
+        self,
+        collection_name: str,
+        positions: List[int],
+        filters: Optional[List] = None,
+        facet_fields: Optional[Set] = None,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict]:
+        """
+        Turn documents into search hits (see ``SnapshotIndex.get_hits``),
+        fetching the referenced documents of all hits at once.
+        """
+        documents = dict(self._get_documents(collection_name, "position", positions))
+        hits = [documents[x] for x in positions]
+        lookups: Dict[str, Dict[str, Tuple[int, Dict]]] = {}
+        for field in get_lookup_fields(filters, facet_fields, fields):
+            ids = {
+                x
+                for hit in hits
+                for x in get_path_values(hit, [field])
+                if isinstance(x, str)
+            }
+            lookups[field] = {
+                document["id"]: (position, document)
+                for position, document in self._get_documents(
+                    get_reference_collection_name(field), "id", sorted(ids)
+                )
+            }
+
+        def get_references(hit: Dict, field: str) -> List[Dict]:
+            references = lookups[field]
+            ids = {
+                x
+                for x in get_path_values(hit, [field])
+                if isinstance(x, str) and x in references
+            }
+            return [
+                references[x][1] for x in sorted(ids, key=lambda x: references[x][0])
+            ]
+
+        return [
+            project_document(hit, {x: get_references(hit, x) for x in lookups}, fields)
+            for hit in hits
+        ]
+
+    def get_documents_by_id(
+        self, collection_name: str, document_ids: List[str]
+    ) -> Dict[str, Dict]:
+        """Get documents by their IDs (see ``SnapshotIndex.get_documents_by_id``)."""
+        return {
+            document["id"]: document
+            for _, document in self._get_documents(collection_name, "id", document_ids)
+        }
+
+
+def get_sqlite_index(config: Config = CONFIG) -> SQLiteIndex:
+    """
+    Get the index of the SQLite database at the configured ``sqlite_path``,
+    which is shared by all subsequent calls for the same file.
+
+    Args:
+        config: The config
+
+    Returns:
+        The index of the database
+    """
+    sqlite_index = _SQLITE_INDEXES.get(config.sqlite_path)
+    if sqlite_index is None:
+        sqlite_index = SQLiteIndex(config.sqlite_path, config.search_field_weights)
+        _SQLITE_INDEXES[config.sqlite_path] = sqlite_index
+    return sqlite_index
+
+
+def clear_sqlite_indexes() -> None:
+    """
+    Drop all SQLite indexes, such that the database files are opened
+    again on next use, for instance after they were rebuilt.
+    """
+    _SQLITE_INDEXES.clear()
+
+
+class SQLiteSearchBackend(SnapshotSearchBackend):
+    """
+    The search backend for a read-only SQLite database that was built from
+    a snapshot of the metadata store (see ``build_sqlite_database``), which
+    ranks the hits of a text search by BM25.
+    """
+
+    async def get_index(self) -> SnapshotIndex:
+        """Get the index of the database (see ``get_sqlite_index``)."""
+        return get_sqlite_index(self.config)
@@ -14,14 +14,52 @@
 # limitations under the License.
 """DAO specific utilities for the Metadata Search Service"""
 
-from typing import Dict, List, Optional, Set
+import base64
+import binascii
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+import bson
+import orjson
 import stringcase
+from bson import json_util
+from bson.raw_bson import RawBSONDocument
+
+try:
+    import bsonjs
+except ImportError:
+    bsonjs = None
 
 NON_NESTED_FIELDS: Set = {"has_attribute"}
 
+# The field that holds the relevance of a document for a text search
+SCORE_FIELD = "_score"
+# The field that holds the sort key of a document, used for keyset pagination
+SORT_KEY_FIELD = "_sort_key"
+# The field that holds the ID and sort key of a raw document (see build_raw_query)
+RAW_KEY_FIELD = "_key"
+# Sort by _id, which always has to be the last sort field to break ties
+DEFAULT_SORT: List[Tuple[str, int]] = [("_id", 1)]
+# Sort the hits of a text search by descending relevance
+RANKED_SORT: List[Tuple[str, int]] = [(SCORE_FIELD, -1), *DEFAULT_SORT]
+# The sort option for ordering hits by relevance (see build_sort)
+RELEVANCE_SORT = "relevance"
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+class InvalidReferenceError(ValueError):
+    """Raised when a field does not reference documents of another collection."""
+
 
-# pylint: disable=too-many-locals, too-many-arguments
+class InvalidSortError(ValueError):
+    """Raised when hits cannot be sorted by a field."""
+
+
+# pylint: disable=too-many-locals, too-many-arguments, too-many-lines, no-member
 
 
 def check_filter_field(field: str) -> bool:
@@ -45,6 +83,23 @@ def check_filter_field(field: str) -> bool:
     return False
 
 
+def check_reference_field(field: str) -> bool:
+    """
+    Check if a given top level field references documents
+    of another collection, like ``has_study``.
+
+    Args:
+        field: Field name
+
+    Returns:
+        Whether or not the field is a reference field.
+
+    """
+    return (
+        field.startswith("has_") and "." not in field and field not in NON_NESTED_FIELDS
+    )
+
+
 def get_nested_fields(fields: List) -> Set:
     """
     Get nested fields from a given set of fields.
@@ -58,16 +113,71 @@ def get_nested_fields(fields: List) -> Set:
     """
     nested_fields = set()
     for field in fields:
-        if "." in field:
+        if check_filter_field(field):
             top_level_field, nested_field = field.split(".", 1)
             nested_fields.add((top_level_field, nested_field))
     return nested_fields
 
 
+def get_reference_collection_name(field: str) -> str:
+    """
+    Get the name of the collection that is referenced by a ``has_*`` field.
+
+    Args:
+        field: The top level field name, like ``has_study``
+
+    Returns:
+        The name of the referenced collection, like ``Study``
+
+    """
+    return stringcase.pascalcase(field.split("has_", 1)[1])
+
+
+def get_referenced_collections(fields: Iterable[str]) -> Set[str]:
+    """
+    Get the names of all collections that are referenced by
+    a given set of (possibly nested) fields.
+
+    Args:
+        fields: A list of fields, like ``has_study.has_project.name``
+
+    Returns:
+        A set of collection names, like ``{"Study", "Project"}``
+
+    """
+    collection_names = set()
+    for field in fields:
+        while check_filter_field(field):
+            top_level_field, field = field.split(".", 1)
+            collection_names.add(get_reference_collection_name(top_level_field))
+    return collection_names
+
+
+def group_filters(filters: List) -> Dict[str, List]:
+    """
+    Group the values of a list of filters by their filter key.
+
+    Args:
+        filters: A list of filters
+
+    Returns:
+        A dictionary that maps each filter key to its list of values
+
+    """
+    grouped_filters: Dict[str, List] = {}
+    for query_filter in filters:
+        grouped_filters.setdefault(query_filter.key, []).append(query_filter.value)
+    return grouped_filters
+
+
 def build_match_query(filters: List) -> Dict:
     """
     Build a match query for the MongoDB aggregation pipeline.
 
+    Filters on nested fields are not part of this match query,
+    since they are resolved against the referenced collection
+    beforehand (see ``build_reference_query``).
+
     Args:
         filters: A list of filters to use in the match query
 
@@ -76,14 +186,32 @@ def build_match_query(filters: List) -> Dict:
 
     """
     subpipelines: Dict = {}
-    for query_filter in filters:
-        if query_filter.key in subpipelines:
-            subpipelines[query_filter.key]["$in"].append(query_filter.value)
-        else:
-            subpipelines[query_filter.key] = {"$in": [query_filter.value]}
+    for key, values in group_filters(filters).items():
+        if not check_filter_field(key):
+            subpipelines[key] = {"$in": values}
     return subpipelines
 
 
+def build_reference_query(field: str, values: List) -> Tuple[str, str, Dict]:
+    """
+    Build the query for the first step of a semi-join: finding
+    the documents in a referenced collection that match a filter
+    on a nested field.
+
+    Args:
+        field: The nested field, like ``has_study.type``
+        values: The values to filter for
+
+    Returns:
+        The top level field, the name of the referenced collection
+        and the query to run against the referenced collection
+
+    """
+    top_level_field, nested_field = field.split(".", 1)
+    collection_name = get_reference_collection_name(top_level_field)
+    return top_level_field, collection_name, {nested_field: {"$in": values}}
+
+
 def build_lookup_query(
     filters: Optional[List] = None, facet_fields: Optional[Set] = None
 ) -> List:
@@ -108,9 +236,9 @@ def build_lookup_query(
         nested_fields.update(get_nested_fields(list(facet_fields)))
 
     seen = set()
-    for top_level_field, _ in nested_fields:
+    for top_level_field, _ in sorted(nested_fields):
         lookup_pipeline = {}
-        c_name = stringcase.pascalcase(top_level_field.split("has_", 1)[1])
+        c_name = get_reference_collection_name(top_level_field)
         if c_name not in seen:
             seen.add(c_name)
             lookup_pipeline["from"] = c_name
@@ -121,23 +249,139 @@ def build_lookup_query(
     return subpipelines
 
 
-def build_facet_query(facet_fields: Set) -> Dict:
+def build_facet_value_query(field: str) -> List:
     """
-    Build a facet query for the MongoDB aggregation pipeline.
+    Build the stages of a MongoDB aggregation pipeline that turn
+    each document into one document per distinct value of a facet field.
+
+    Only the top level field of the facet field is kept. Every part of the
+    path is unwound, such that array valued fields (like the looked up
+    ``has_*`` references) yield one document per value instead of one
+    per combination of values. Documents without a value yield one
+    document with a value of ``None``.
+
+    Args:
+        field: The facet field, like ``has_study.type``
+
+    Returns:
+        A list of stages that yield documents with the fields ``_id`` (of the
+        original document) and ``value``
+
+    """
+    top_level_field = field.split(".", 1)[0]
+    pipelines: List = [{"$project": {top_level_field: 1}}]
+    for query in build_lookup_query(facet_fields={field}):
+        pipelines.append({"$lookup": query})
+
+    parts = field.split(".")
+    for i in range(len(parts)):
+        path = ".".join(parts[: i + 1])
+        pipelines.append(
+            {"$unwind": {"path": f"${path}", "preserveNullAndEmptyArrays": True}}
+        )
+    if len(parts) > 1:
+        # Count each value only once per document
+        pipelines.append({"$group": {"_id": {"doc": "$_id", "value": f"${field}"}}})
+        pipelines.append({"$project": {"_id": "$_id.doc", "value": "$_id.value"}})
+    else:
+        pipelines.append({"$project": {"value": f"${field}"}})
+    return pipelines
+
+
+def build_facet_query(
+    facet_fields: Set, max_options: Optional[Dict[str, int]] = None
+) -> List:
+    """
+    Build a facet query for the MongoDB aggregation pipeline, that counts
+    the values of all given facet fields in a single pass over the
+    matching documents.
+
+    Nested facet fields look up their referenced collection
+    within their own sub-pipeline, that is only for the documents
+    that already matched the query. Array valued fields are unwound,
+    so that every value is counted once per document
+    (see ``build_facet_value_query``).
+
+    The values of each facet are sorted by their count and limited to the
+    top values within its sub-pipeline, such that the single document
+    produced by ``$facet`` never holds more than the top values of each
+    facet, however many distinct values there are. These are returned as
+    ``options``, together with the count of all other values as ``other``,
+    which is derived from a separate sub-pipeline that counts all values.
 
     Args:
         facet_fields: A list of fields to use for faceting
+        max_options: The maximum number of options per facet field.
+            Fields that are missing get all of their options
 
     Returns:
-        A dictionary that represents the facet query
+        A list that represents the facet query, which results in
+        a single document that maps each facet key to its facet
 
     """
+    max_options = max_options or {}
     subpipelines: Dict = {}
-    for field in facet_fields:
-        subpipelines[field.replace(".", "__")] = [
-            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
-        ]
-    return subpipelines
+    facets: Dict = {"_id": 0}
+    for field in sorted(facet_fields):
+        key = field.replace(".", "__")
+        subpipeline = build_facet_value_query(field)
+        subpipeline.append({"$group": {"_id": "$value", "count": {"$sum": 1}}})
+        # same as $sortByCount, but with a deterministic order for equal counts
+        subpipeline.append({"$sort": {"count": -1, "_id": 1}})
+        # a plain 0 would exclude the field in $project
+        other: Any = {"$literal": 0}
+        if max_options.get(field):
+            # the sort is coalesced with the limit into a top-k sort
+            subpipeline.append({"$limit": max_options[field]})
+            total_key = f"{key}__total"
+            subpipelines[total_key] = [
+                *build_facet_value_query(field),
+                {"$count": "count"},
+            ]
+            other = {
+                "$subtract": [
+                    {"$sum": f"${total_key}.count"},
+                    {"$sum": f"${key}.count"},
+                ]
+            }
+        subpipelines[key] = subpipeline
+        facets[key] = {"options": f"${key}", "other": other}
+    return [{"$facet": subpipelines}, {"$project": facets}]
+
+
+def group_facet_fields(
+    facet_fields: Set, filters: Optional[List] = None, disjunctive: bool = False
+) -> List[Tuple[Set, List]]:
+    """
+    Group facet fields by the filters that apply to their facets.
+
+    Usually, all facets are computed for the documents matching all filters.
+    For disjunctive facets, the filters on a facet field itself are not
+    applied to that facet, so that the counts of its other values stay
+    available once a value has been selected. Facet fields that end up
+    with the same remaining filters form one group.
+
+    Args:
+        facet_fields: A set of fields to use for faceting
+        filters: A list of filters to use in the query
+        disjunctive: Whether or not to ignore the filters on each facet field
+            for its own facet
+
+    Returns:
+        A list of facet fields and the filters that apply to them
+
+    """
+    filters = filters or []
+    if not disjunctive:
+        return [({field}, filters) for field in sorted(facet_fields)]
+    groups: Dict[frozenset, Set] = {}
+    for field in sorted(facet_fields):
+        remaining_keys = frozenset(x.key for x in filters if x.key != field)
+        groups.setdefault(remaining_keys, set()).add(field)
+    return [
+        (fields, [x for x in filters if x.key in remaining_keys])
+        for remaining_keys, fields in groups.items()
+    ]
 
 
 def build_text_search_query(query_string: str) -> Dict:
@@ -154,21 +398,53 @@ def build_text_search_query(query_string: str) -> Dict:
     return {"$text": {"$search": query_string}}
 
 
+def get_sparse_fields(fields: Iterable[str]) -> List[str]:
+    """
+    Normalize the fields requested for a sparse fieldset, such that ``id``
+    is always included and fields within other requested fields are dropped.
+
+    Args:
+        fields: A list of fields, like ``title`` or ``has_study.type``
+
+    Returns:
+        A sorted list of fields
+
+    """
+    requested = set(fields) | {"id"}
+    return sorted(
+        field
+        for field in requested
+        if not any(field.startswith(f"{other}.") for other in requested)
+    )
+
+
 def build_projection_query(
-    filters: Optional[List] = None, facet_fields: Optional[Set] = None
+    filters: Optional[List] = None,
+    facet_fields: Optional[Set] = None,
+    fields: Optional[List[str]] = None,
 ) -> Dict:
     """
     Build a projection query for the MongoDB aggregation pipeline
-    that excludes _id field from the top level and all nested documents
+    that excludes _id field from the top level and all nested documents.
+
+    If ``fields`` are given, the projection only includes these fields
+    (see ``get_sparse_fields``) instead.
 
     Args:
         filters: A list of filters used
         facet_fields: A set of fields used for faceting
+        fields: A list of fields to include
 
     Returns:
         A dictionary that represents the projection query
 
     """
+    if fields:
+        sparse_projection: Dict = {"_id": 0}
+        for field in get_sparse_fields(fields):
+            sparse_projection[field] = 1
+        return sparse_projection
+
     subpipelines: Dict = {}
     nested_fields = set()
     if filters:
@@ -176,82 +452,626 @@ def build_projection_query(
         nested_fields.update(get_nested_fields(filter_fields))
     if facet_fields:
         nested_fields.update(get_nested_fields(list(facet_fields)))
-    subpipelines["data._id"] = 0
+    subpipelines["_id"] = 0
     for top_level_field, _ in nested_fields:
-        subpipelines[f"data.{top_level_field}._id"] = 0
+        subpipelines[f"{top_level_field}._id"] = 0
     return subpipelines
 
 
+def build_search_match_query(
+    search_query: str = "*",
+    filters: Optional[List] = None,
+    reference_filters: Optional[List[Dict]] = None,
+) -> Dict:
+    """
+    Build the match query that selects all documents matching
+    a search query and a list of filters.
+
+    Filters on nested fields are not applied via a ``$lookup``.
+    Instead, they are expected to be resolved to the matching IDs
+    of the referenced collection beforehand, and passed as
+    ``reference_filters`` on the local ``has_*`` fields.
+
+    Args:
+        search_query: The search query string to use for text serach
+        filters: A list of filters to use in the query
+        reference_filters: A list of match queries on ``has_*`` fields
+            that resolve the filters on nested fields
+
+    Returns:
+        A dictionary that represents the match query
+
+    """
+    match_query: Dict = {}
+    if search_query and search_query not in {"*"}:
+        # Text search with match
+        match_query.update(build_text_search_query(search_query))
+
+    if filters:
+        # Apply filters on local fields
+        match_query.update(build_match_query(filters=filters))
+
+    if reference_filters:
+        # Apply resolved filters on nested fields
+        match_query["$and"] = reference_filters
+    return match_query
+
+
+def encode_cursor(sort: List[Tuple[str, int]], sort_key: List) -> str:
+    """
+    Encode the sort key of the last document of a page into an opaque cursor.
+
+    Args:
+        sort: The sort fields and directions that were used
+        sort_key: The values of the sort fields of the last document
+
+    Returns:
+        A URL-safe string that represents the cursor
+
+    """
+    cursor = json_util.dumps({"sort": sort, "after": sort_key})
+    return base64.urlsafe_b64encode(cursor.encode("utf8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: List[Tuple[str, int]]) -> List:
+    """
+    Decode an opaque cursor into the sort key of the document after which
+    the next page starts.
+
+    Args:
+        cursor: A cursor as returned by ``encode_cursor``
+        sort: The sort fields and directions of the current query
+
+    Returns:
+        The values of the sort fields to continue after
+
+    Raises:
+        InvalidCursorError: If the cursor is malformed or has been
+            created for a different sort order
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        decoded = json_util.loads(base64.urlsafe_b64decode(cursor + padding))
+        cursor_sort = [tuple(item) for item in decoded["sort"]]
+        sort_key = decoded["after"]
+    except (binascii.Error, ValueError, TypeError, KeyError) as exc:
+        raise InvalidCursorError("Malformed cursor") from exc
+    if cursor_sort != sort or not isinstance(sort_key, list):
+        raise InvalidCursorError("Cursor does not match the sort order")
+    return sort_key
+
+
+def build_sort(
+    sort: Optional[str], search_query: str = "*", sort_fields: Iterable[str] = ()
+) -> List[Tuple[str, int]]:
+    """
+    Turn a sort option into the sort fields and directions of a search.
+
+    Args:
+        sort: ``relevance``, a field like ``title``, or a field prefixed
+            with a minus sign for descending order, like ``-title``.
+            Defaults to relevance for text searches. Without a text search,
+            relevance is the default order
+        search_query: The search query string to use for text serach
+        sort_fields: The fields that hits can be sorted by
+
+    Returns:
+        The sort fields and directions, ending with the ``DEFAULT_SORT``
+        to break ties
+
+    Raises:
+        InvalidSortError: If hits cannot be sorted by the given field
+    """
+    if sort is None or sort == RELEVANCE_SORT:
+        text_search = bool(search_query) and search_query not in {"*"}
+        return RANKED_SORT if text_search else DEFAULT_SORT
+    field = sort[1:] if sort.startswith("-") else sort
+    if field not in sort_fields:
+        raise InvalidSortError(
+            f"Hits cannot be sorted by '{field}', only by '{RELEVANCE_SORT}'"
+            f" or one of {sorted(sort_fields)}"
+        )
+    return [(field, -1 if sort.startswith("-") else 1), *DEFAULT_SORT]
+
+
+def build_keyset_query(sort: List[Tuple[str, int]], sort_key: List) -> Dict:
+    """
+    Build a match query that selects all documents that come after
+    a given sort key in the given sort order.
+
+    Missing values and null sort before all other values, like in the
+    ``$sort`` stage, which the comparison operators do not take into account.
+
+    Args:
+        sort: The sort fields and directions
+        sort_key: The values of the sort fields to continue after
+
+    Returns:
+        A dictionary that represents the match query
+
+    """
+    conditions = []
+    for i, (field, direction) in enumerate(sort):
+        condition: Dict[str, Any] = {
+            previous_field: sort_key[j]
+            for j, (previous_field, _) in enumerate(sort[:i])
+        }
+        value = sort_key[i]
+        if value is None:
+            # nothing comes before null, but everything else comes after it
+            condition[field] = {"$ne": None} if direction > 0 else {"$lt": None}
+        elif direction < 0 and field not in {SCORE_FIELD, "_id"}:
+            condition["$or"] = [{field: {"$lt": value}}, {field: None}]
+        else:
+            condition[field] = {"$gt" if direction > 0 else "$lt": value}
+        conditions.append(condition)
+    return {"$or": conditions}
+
+
 def build_aggregation_query(
     search_query: str = "*",
     filters: Optional[List] = None,
     facet_fields: Optional[Set] = None,
     skip: int = 0,
     limit: int = 10,
+    reference_filters: Optional[List[Dict]] = None,
+    sort: Optional[List[Tuple[str, int]]] = None,
+    after: Optional[List] = None,
+    fields: Optional[List[str]] = None,
 ) -> List:
     """
     Build an aggregation query for the MongoDB aggregation pipeline,
-    by generating the appropriate pipelines (and sub-pipelines) that
-    can be used to query the underlying MongoDB store.
+    that retrieves one page of documents matching the search query
+    and filters.
+
+    If ``fields`` are given, only these fields of each document are returned
+    and only nested fields among them are looked up.
+
+    Each document of the page carries its sort key, which can be turned
+    into a cursor for the next page (see ``encode_cursor``). If ``after``
+    is given, the page starts right after that sort key, so that deep
+    pages do not have to skip over all previous documents.
 
     Args:
         search_query: The search query string to use for text serach
         filters: A list of filters to use in the query
-        facet_fields: A set of fields to use for faceting
+        facet_fields: A set of fields used for faceting
         skip: The number of documents to skip
         limit: The total number of documents to retrieve
+        reference_filters: A list of match queries on ``has_*`` fields
+            that resolve the filters on nested fields
+        sort: The sort fields and directions, where ``SCORE_FIELD``
+            refers to the text search relevance. Defaults to ``DEFAULT_SORT``
+        after: The sort key of the document after which the page starts
+        fields: A list of fields to include in each document
 
     Returns:
-        A list that represents the projection query
+        A list that represents the aggregation query
 
     """
+    sort = sort or DEFAULT_SORT
+    sort_fields = [field for field, _ in sort]
     pipelines: List = []
-    if search_query and search_query not in {"*"}:
-        # Text search with match
-        text_search_query = build_text_search_query(search_query)
-        match_pipeline = {"$match": text_search_query}
-        pipelines.append(match_pipeline)
-
-    if filters or facet_fields:
-        # Perform lookup
-        lookup_query = build_lookup_query(filters=filters, facet_fields=facet_fields)
-        if lookup_query:
-            for query in lookup_query:
-                lookup_pipeline = {"$lookup": query}
-                pipelines.append(lookup_pipeline)
-
-    if filters:
-        # Apply filters
-        match_query = build_match_query(filters=filters)
+    match_query = build_search_match_query(
+        search_query=search_query,
+        filters=filters,
+        reference_filters=reference_filters,
+    )
+    if match_query:
         match_pipeline = {"$match": match_query}
         pipelines.append(match_pipeline)
 
-    facet_query = {}
-    if facet_fields:
-        # Faceting
-        facet_query = build_facet_query(facet_fields=facet_fields)
+    if SCORE_FIELD in sort_fields:
+        # Relevance of the text search
+        pipelines.append({"$addFields": {SCORE_FIELD: {"$meta": "textScore"}}})
+
+    if after:
+        # Continue after the last document of the previous page
+        pipelines.append({"$match": build_keyset_query(sort=sort, sort_key=after)})
 
-    # Pagination (if limit = 0, use no pagination)
-    facet_query["metadata"] = [{"$count": "total"}]
+    pipelines.append({"$sort": dict(sort)})
 
+    # Pagination (if limit = 0, use no pagination). The $limit directly
+    # follows the $sort, such that both are coalesced into a top-k sort,
+    # which only keeps the first skip + limit documents in memory
     if limit != 0:
-        # Sort by _id, apply skip and limit
-        facet_query["data"] = [
-            {"$sort": {"_id": 1}},
-            {"$skip": skip},
-            {"$limit": limit},
-        ]
+        pipelines.append({"$limit": skip + limit})
+        if skip:
+            pipelines.append({"$skip": skip})
+
+    # Lookup of nested fields for the documents of the current page only
+    if fields:
+        lookup_query = build_lookup_query(facet_fields=set(get_sparse_fields(fields)))
     else:
-        # Sort by _id
-        facet_query["data"] = [{"$sort": {"_id": 1}}]
+        lookup_query = build_lookup_query(filters=filters, facet_fields=facet_fields)
+    for query in lookup_query:
+        pipelines.append({"$lookup": query})
 
-    facet_pipeline = {"$facet": facet_query}
-    pipelines.append(facet_pipeline)
+    # Keep the sort key for keyset pagination
+    pipelines.append(
+        {"$addFields": {SORT_KEY_FIELD: [f"${field}" for field in sort_fields]}}
+    )
 
     # Projection
     projection_query = build_projection_query(
-        filters=filters, facet_fields=facet_fields
+        filters=filters, facet_fields=facet_fields, fields=fields
     )
+    if fields:
+        projection_query[SORT_KEY_FIELD] = 1
+    elif SCORE_FIELD in sort_fields:
+        projection_query[SCORE_FIELD] = 0
     projection_pipeline = {"$project": projection_query}
     pipelines.append(projection_pipeline)
     return pipelines
+
+
+def build_raw_query() -> List:
+    """
+    Build the stages to append to an aggregation query (as built by
+    ``build_aggregation_query``), that move each document into a
+    ``content`` field, next to its ID and sort key in ``RAW_KEY_FIELD``.
+
+    Documents of this shape can be retrieved as ``RawBSONDocument``, such that
+    only ID and sort key need to be decoded, while the content can be
+    converted to JSON as it is (see ``raw_bson_to_json``).
+
+    Returns:
+        A list that represents the stages of the aggregation query
+
+    """
+    return [
+        {
+            "$replaceRoot": {
+                "newRoot": {
+                    RAW_KEY_FIELD: {"id": "$id", "sort_key": f"${SORT_KEY_FIELD}"},
+                    "content": "$$ROOT",
+                }
+            }
+        },
+        {"$project": {f"content.{SORT_KEY_FIELD}": 0}},
+    ]
+
+
+def can_convert_raw_bson() -> bool:
+    """
+    Check whether raw BSON documents can be converted to JSON without
+    decoding them, which needs the optional ``python-bsonjs`` package.
+
+    Returns:
+        True if ``python-bsonjs`` is installed, False otherwise
+
+    """
+    return bsonjs is not None
+
+
+def raw_bson_to_json(document: RawBSONDocument) -> bytes:
+    """
+    Convert a raw BSON document to JSON, in the same representation as the
+    content of hits that are decoded first, like ISO strings for datetimes.
+
+    If ``python-bsonjs`` is installed, the document is converted without
+    decoding it into Python objects first. Its relaxed extended JSON only
+    differs for values without a JSON counterpart, like datetimes, which
+    are wrapped in a key with a leading ``$``. Documents with such values
+    are decoded and serialized like decoded hits instead.
+
+    Args:
+        document: A raw BSON document
+
+    Returns:
+        The JSON representation of the document
+
+    """
+    if bsonjs is not None:
+        converted = bsonjs.dumps(document.raw).encode("utf8")
+        if b'"$' not in converted:
+            return converted
+    return orjson.dumps(
+        bson.decode(document.raw), default=str, option=orjson.OPT_NON_STR_KEYS
+    )
+
+
+def iter_strings(value: Any) -> Iterator[str]:
+    """
+    Iterate over all strings within a value, including nested ones.
+
+    Args:
+        value: A value of a document
+
+    Yields:
+        The strings within the value
+
+    """
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_strings(item)
+
+
+def get_path_values(value: Any, path: List[str]) -> List:
+    """
+    Get the values at a path within a document, where arrays along the path
+    are traversed like MongoDB does for dotted field names.
+
+    Args:
+        value: A document or a value within it
+        path: The parts of the field, like ``["has_attribute", "key"]``
+
+    Returns:
+        A list of all values at that path, with arrays flattened
+
+    """
+    if isinstance(value, list):
+        return [x for item in value for x in get_path_values(item, path)]
+    if not path:
+        return [value]
+    if isinstance(value, dict) and path[0] in value:
+        return get_path_values(value[path[0]], path[1:])
+    return []
+
+
+def iter_field_values(value: Any, field: str = "") -> Iterator[Tuple[str, Any]]:
+    """
+    Iterate over all plain values within a document, together with the
+    field that a filter on that value would use.
+
+    Args:
+        value: A document or a value within it
+        field: The field of the value within the document
+
+    Yields:
+        The field, like ``has_attribute.key``, and the value of each
+        plain value within the document
+
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from iter_field_values(item, f"{field}.{key}" if field else key)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_field_values(item, field)
+    else:
+        yield field, value
+
+
+def get_lookup_fields(
+    filters: Optional[List] = None,
+    facet_fields: Optional[Set] = None,
+    fields: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    Get the reference fields of a search hit that are replaced by the
+    referenced documents, like the lookups of ``build_aggregation_query``.
+
+    Args:
+        filters: A list of filters
+        facet_fields: A set of fields used for faceting
+        fields: A list of fields to include in each hit
+
+    Returns:
+        A sorted list of top level reference fields, like ``has_study``
+
+    """
+    if fields:
+        lookup_fields = get_sparse_fields(fields)
+    else:
+        lookup_fields = [*(facet_fields or []), *(x.key for x in filters or [])]
+    return sorted({field for field, _ in get_nested_fields(lookup_fields)})
+
+
+def _include_field(target: Dict, source: Dict, path: List[str]) -> None:
+    """Copy the value at a path from one document into another."""
+    key = path[0]
+    if key not in source:
+        return
+    value = source[key]
+    if len(path) == 1:
+        target[key] = value
+    elif isinstance(value, dict):
+        _include_field(target.setdefault(key, {}), value, path[1:])
+    elif isinstance(value, list):
+        items = [x for x in value if isinstance(x, dict)]
+        included = target.setdefault(key, [{} for _ in items])
+        for target_item, item in zip(included, items):
+            _include_field(target_item, item, path[1:])
+
+
+def project_document(
+    document: Dict,
+    references: Dict[str, List[Dict]],
+    fields: Optional[List[str]] = None,
+) -> Dict:
+    """
+    Turn a document into a search hit, like the lookups and the projection
+    of ``build_aggregation_query`` do, without modifying the document.
+
+    Args:
+        document: The document
+        references: The referenced documents for each reference field
+            to look up (see ``get_lookup_fields``)
+        fields: A list of fields to include, or None to include all fields
+
+    Returns:
+        A copy of the document, with the reference fields replaced
+        by the referenced documents
+
+    """
+    looked_up = {**document, **references}
+    if not fields:
+        return looked_up
+    projected: Dict = {}
+    for field in get_sparse_fields(fields):
+        _include_field(projected, looked_up, field.split("."))
+    return projected
+
+
+def get_sort_value(value: Any) -> Tuple:
+    """
+    Get a key to sort values of mixed types like the metadata store does,
+    with None first, then numbers and then all other values as strings.
+
+    Args:
+        value: A value of a document
+
+    Returns:
+        A key that is comparable with the keys of all other values
+    """
+    if value is None:
+        return (0, "")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    return (2, str(value))
+
+
+def build_facet(counts: Dict[Any, int], max_options: Optional[int] = None) -> Dict:
+    """
+    Build a facet from the counts of its values, in the same format and
+    order as the result of a facet query (see ``build_facet_query``).
+
+    Args:
+        counts: The number of documents with each value
+        max_options: The maximum number of options
+
+    Returns:
+        A dictionary with the counts of the top values as ``options``
+        and the summed up count of all other values as ``other``
+
+    """
+    options = [
+        {"_id": value, "count": count}
+        for value, count in sorted(
+            counts.items(), key=lambda x: (-x[1], get_sort_value(x[0]))
+        )
+    ]
+    if max_options:
+        options = options[:max_options]
+    other = sum(counts.values()) - sum(x["count"] for x in options)
+    return {"options": options, "other": other}
+
+
+def get_collection_name(key: str) -> str:
+    """
+    Get the name of a collection from the key of its documents
+    in a JSON file, like the files of the test data.
+
+    Args:
+        key: The key, like ``data_access_policies``
+
+    Returns:
+        The name of the collection, like ``DataAccessPolicy``
+
+    """
+    singular = key[:-3] + "y" if key.endswith("ies") else key.rstrip("s")
+    return stringcase.pascalcase(singular)
+
+
+def read_json_collections(directory: Path) -> Dict[str, List[Dict]]:
+    """
+    Read the documents of all collections from the JSON files in a directory,
+    each of which has an object that maps a key like ``data_access_policies``
+    to the list of documents of a collection.
+
+    Args:
+        directory: The directory with the JSON files
+
+    Returns:
+        A dictionary that maps each collection name to its documents
+
+    """
+    collections: Dict[str, List[Dict]] = {}
+    for path in sorted(Path(directory).glob("*.json")):
+        with open(path, "r", encoding="utf8") as file:
+            for key, documents in json.load(file).items():
+                collections[get_collection_name(key)] = documents
+    return collections
+
+
+def build_count_query(
+    search_query: str = "*",
+    filters: Optional[List] = None,
+    reference_filters: Optional[List[Dict]] = None,
+) -> List:
+    """
+    Build an aggregation query for the MongoDB aggregation pipeline,
+    that counts all documents matching the search query and filters.
+
+    Args:
+        search_query: The search query string to use for text serach
+        filters: A list of filters to use in the query
+        reference_filters: A list of match queries on ``has_*`` fields
+            that resolve the filters on nested fields
+
+    Returns:
+        A list that represents the aggregation query
+
+    """
+    pipelines: List = []
+    match_query = build_search_match_query(
+        search_query=search_query,
+        filters=filters,
+        reference_filters=reference_filters,
+    )
+    if match_query:
+        pipelines.append({"$match": match_query})
+    pipelines.append({"$count": "total"})
+    return pipelines
+
+
+def build_facet_queries(
+    facet_fields: Set,
+    search_query: str = "*",
+    filters: Optional[List] = None,
+    reference_filters: Optional[Dict[str, Dict]] = None,
+    max_options: Optional[Dict[str, int]] = None,
+    disjunctive: bool = False,
+) -> List[List]:
+    """
+    Build the aggregation queries for the MongoDB aggregation pipeline,
+    that count the documents matching the search query and filters for
+    each value of the facet fields.
+
+    Usually, there is one query per facet field, so that each of them can
+    run concurrently. For disjunctive facets, facet fields that share the
+    same remaining filters are computed together with one query
+    (see ``group_facet_fields``).
+
+    Args:
+        facet_fields: A set of fields to use for faceting
+        search_query: The search query string to use for text serach
+        filters: A list of filters to use in the query
+        reference_filters: The match queries on ``has_*`` fields that resolve
+            the filters on nested fields, by their filter key
+        max_options: The maximum number of options per facet field
+        disjunctive: Whether or not to ignore the filters on each facet field
+            for its own facet
+
+    Returns:
+        A list of aggregation queries, each of which results in a single
+        document that maps facet keys to their facets
+
+    """
+    reference_filters = reference_filters or {}
+    facet_queries: List[List] = []
+    for fields, facet_filters in group_facet_fields(
+        facet_fields=facet_fields, filters=filters, disjunctive=disjunctive
+    ):
+        filter_keys = {x.key for x in facet_filters}
+        match_query = build_search_match_query(
+            search_query=search_query,
+            filters=facet_filters,
+            reference_filters=[
+                query for key, query in reference_filters.items() if key in filter_keys
+            ],
+        )
+        pipelines: List = []
+        if match_query:
+            pipelines.append({"$match": match_query})
+        pipelines.extend(
+            build_facet_query(facet_fields=fields, max_options=max_options)
+        )
+        facet_queries.append(pipelines)
+    return facet_queries
@@ -15,6 +15,7 @@
 
 """Defines all dataclasses/classes pertaining to a data model or schema"""
 
+from datetime import datetime
 from enum import Enum
 from typing import Dict, List, Optional
 
@@ -59,6 +60,10 @@ class Facet(BaseModel):
     options: List[FacetOption] = Field(
         description="One or more values and their counts"
     )
+    other: int = Field(
+        0,
+        description="The summed up count of all values that are not among the options",
+    )
 
 
 class FilterOption(BaseModel):
@@ -96,6 +101,20 @@ class SearchHit(BaseModel):
     )
 
 
+class Document(BaseModel):
+    """
+    Represents a Document, with some of its references expanded.
+    """
+
+    document_type: DocumentType = Field(description="The type of document")
+    id: str = Field(description="The unique identifier of the document")
+    content: Dict = Field(description="The full document")
+    truncated: List[str] = Field(
+        [],
+        description="The expanded reference fields of which not all references are included",
+    )
+
+
 class SearchResult(BaseModel):
     """
     Represents the Search Result.
@@ -106,3 +125,81 @@ class SearchResult(BaseModel):
     )
     count: int = Field(description="Number of hits")
     hits: List[SearchHit] = Field(description="One or more search hits")
+    next_cursor: Optional[str] = Field(
+        None,
+        description="An opaque cursor that can be passed as 'after' to retrieve the next page",
+    )
+    updated_at: Optional[datetime] = Field(
+        None,
+        description="The time at which facets and count were computed (if precomputed)",
+    )
+    truncated: List[str] = Field(
+        [],
+        description="The expanded reference fields of which not all references are included",
+    )
+
+
+class BatchSearchQuery(SearchQuery):
+    """
+    Represents one Search Query of a batch, together with its parameters.
+    """
+
+    document_type: DocumentType = Field(description="The type of document")
+    return_facets: bool = Field(False, description="Whether or not to facet")
+    skip: int = Field(0, description="The number of documents to skip")
+    limit: int = Field(10, description="The total number of documents to retrieve")
+    after: Optional[str] = Field(
+        None, description="A cursor as returned for a previous page"
+    )
+    max_facet_options: Optional[int] = Field(
+        None, description="The maximum number of options per facet"
+    )
+    disjunctive_facets: bool = Field(
+        False, description="Whether or not facets ignore the filters on themselves"
+    )
+    fields: Optional[List[str]] = Field(
+        None, description="The fields to include in each hit, or '*' for all fields"
+    )
+    expand: Optional[List[str]] = Field(
+        None, description="The reference fields to expand in each hit"
+    )
+    sort: Optional[str] = Field(
+        None,
+        description="'relevance' or a field to sort the hits by, prefixed with"
+        " '-' for descending order",
+    )
+
+
+class BatchSearchResult(BaseModel):
+    """
+    Represents the Search Results of a batch, in the order of its queries.
+    """
+
+    results: List[SearchResult] = Field(description="One search result per query")
+
+
+class DocumentTypeCount(BaseModel):
+    """
+    Represents the number of hits for one type of document.
+    """
+
+    document_type: DocumentType = Field(description="The type of document")
+    count: int = Field(description="Number of hits")
+
+
+class FederatedSearchResult(BaseModel):
+    """
+    Represents the Search Result across all types of document.
+    """
+
+    count: int = Field(description="Number of hits across all types of document")
+    counts: List[DocumentTypeCount] = Field(
+        description="Number of hits per type of document"
+    )
+    hits: List[SearchHit] = Field(
+        description="One or more search hits, ordered by relevance"
+    )
+    partial: bool = Field(
+        False,
+        description="Whether or not some types of document could not be searched in time",
+    )
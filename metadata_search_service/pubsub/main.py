@@ -14,3 +14,203 @@
 # limitations under the License.
 
 """Consuming or Subscribing to Async Messaging Topics"""
+
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from bson import Timestamp
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+from metadata_search_service.config import CONFIG, Config
+from metadata_search_service.core.cache import DATA_VERSIONS, DataVersions
+from metadata_search_service.dao.db import get_db_client
+
+# Error code of MongoDB if change streams are used on a standalone server
+CHANGE_STREAMS_NOT_SUPPORTED = 40573
+
+
+async def watch_metadata_store(
+    config: Config = CONFIG, versions: DataVersions = DATA_VERSIONS
+) -> None:
+    """
+    Watch all collections of the metadata store for changes and bump
+    their data versions accordingly.
+
+    A change stream on the whole database is used if the database is a
+    replica set. Otherwise, the collections are polled for changes as a
+    local stand-in if ``poll_changes`` is set, or not watched at all.
+    While the metadata store is watched, ``versions.watched`` is set.
+    This coroutine runs until it is cancelled.
+
+    Args:
+        config: The config
+        versions: The data versions to bump
+    """
+    client = await get_db_client(config)
+    database = client[config.db_name]
+    poll = False
+    while True:
+        try:
+            if poll:
+                await _poll_collections(
+                    database, versions, interval=config.change_poll_interval
+                )
+            else:
+                await _watch_change_stream(database, versions)
+        except OperationFailure as exc:
+            if exc.code != CHANGE_STREAMS_NOT_SUPPORTED:
+                logging.warning("Watching the metadata store failed: %s", exc)
+            elif not config.poll_changes:
+                logging.info(
+                    "Change streams are not supported, "
+                    "the metadata store is not watched for changes"
+                )
+                return
+            else:
+                logging.info(
+                    "Change streams are not supported, polling for changes instead"
+                )
+                # polling starts on the next iteration, such that its errors
+                # are retried like the errors of change streams
+                poll = True
+        except PyMongoError as exc:
+            logging.warning("Watching the metadata store failed: %s", exc)
+        finally:
+            versions.watched = False
+        await asyncio.sleep(config.change_poll_interval)
+
+
+async def _watch_change_stream(
+    database: AsyncIOMotorDatabase, versions: DataVersions
+) -> None:
+    """
+    Bump the data version of a collection for every change event
+    that is reported by a change stream on the whole database, such
+    that all collections a search can depend on are covered.
+
+    Changes might have been missed while the stream was not open, so all
+    collections start at their fingerprint once it is open, which all
+    processes that watch the metadata store agree on as long as nothing
+    changes. The versions of changes are their cluster times, which all
+    processes that see the change agree on as well.
+
+    Args:
+        database: The database of the metadata store
+        versions: The data versions to bump
+    """
+    start_time = (await database.command("ping")).get("operationTime")
+    async with database.watch(start_at_operation_time=start_time) as change_stream:
+        await seed_versions(database, versions)
+        versions.watched = True
+        async for change in change_stream:
+            version = _get_version(change.get("clusterTime"))
+            if "ns" in change and "coll" in change["ns"]:
+                versions.bump(change["ns"]["coll"], version)
+            else:
+                # like dropping or renaming the database
+                versions.bump_all(version)
+
+
+def _get_version(cluster_time: Optional[Timestamp]) -> Optional[str]:
+    """Get the data version for a cluster time, if there is one."""
+    return f"{cluster_time.time}.{cluster_time.inc}" if cluster_time else None
+
+
+async def _poll_collections(
+    database: AsyncIOMotorDatabase, versions: DataVersions, interval: float
+) -> None:
+    """
+    Periodically check all collections for changes.
+
+    Args:
+        database: The database of the metadata store
+        versions: The data versions to bump
+        interval: The number of seconds to wait between two checks
+    """
+    fingerprints = await seed_versions(database, versions)
+    versions.watched = True
+    while True:
+        await asyncio.sleep(interval)
+        await check_collections(database, versions, fingerprints)
+
+
+async def seed_versions(
+    database: AsyncIOMotorDatabase, versions: DataVersions
+) -> Dict[str, Optional[Tuple]]:
+    """
+    Set the data versions of all collections to their current fingerprint,
+    including the collections that do not exist, which are all the same.
+    Since fingerprints miss some changes, these versions are approximate.
+
+    Args:
+        database: The database of the metadata store
+        versions: The data versions to set
+
+    Returns:
+        The current fingerprint of each existing collection
+    """
+    versions.bump_all(repr(None), approximate=True)
+    fingerprints: Dict[str, Optional[Tuple]] = {}
+    await check_collections(database, versions, fingerprints)
+    return fingerprints
+
+
+async def get_fingerprint(
+    database: AsyncIOMotorDatabase, collection_name: str
+) -> Optional[Tuple]:
+    """
+    Get a cheap fingerprint of a collection, made of its number of documents,
+    its size and its largest ``_id``, which are read from the collection
+    statistics and the ``_id`` index without reading any documents.
+    In-place updates that do not change the size of a document are missed.
+
+    Args:
+        database: The database of the metadata store
+        collection_name: The name of the collection
+
+    Returns:
+        The fingerprint, or None if the collection does not exist
+    """
+    try:
+        stats = await database.command("collStats", collection_name)
+    except OperationFailure:
+        return None
+    last_document = await database[collection_name].find_one(
+        {}, {"_id": 1}, sort=[("_id", -1)]
+    )
+    return (
+        stats.get("count"),
+        stats.get("size"),
+        last_document["_id"] if last_document else None,
+    )
+
+
+async def check_collections(
+    database: AsyncIOMotorDatabase,
+    versions: DataVersions,
+    fingerprints: Dict[str, Optional[Tuple]],
+) -> None:
+    """
+    Compare the current fingerprint of each collection with its previous
+    fingerprint and bump the data versions of all collections that changed,
+    including the collections that were created or dropped since. The
+    fingerprints serve as approximate data versions, which all processes
+    that poll the metadata store agree on.
+
+    Args:
+        database: The database of the metadata store
+        versions: The data versions to bump
+        fingerprints: The previous fingerprint of each collection, which is updated
+    """
+    collection_names = set(await database.list_collection_names())
+    for collection_name in sorted(collection_names | set(fingerprints)):
+        fingerprint = (
+            await get_fingerprint(database, collection_name)
+            if collection_name in collection_names
+            else None
+        )
+        if fingerprints.get(collection_name) != fingerprint:
+            versions.bump(collection_name, repr(fingerprint), approximate=True)
+        fingerprints[collection_name] = fingerprint
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the CPU time spent on serializing a search result with and without
+validation against the response model.
+
+    Usage:
+        `scripts/benchmark_json_response.py --hits 100 --repeat 200`
+"""
+
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from typer import Typer
+
+from metadata_search_service.api.responses import FastJSONResponse
+from metadata_search_service.models import SearchResult
+
+HERE = Path(__file__).parent.resolve()
+TEST_DATA_DIR = HERE.parent.resolve() / "tests" / "fixtures" / "test_data"
+
+cli = Typer()
+
+
+def get_search_result(hits: int) -> Dict:
+    """
+    Build a search result with the given number of dataset hits, taken from
+    the test data, that have their studies and files looked up.
+    """
+    with open(TEST_DATA_DIR / "datasets.json", encoding="utf8") as file:
+        datasets = json.load(file)["datasets"]
+    with open(TEST_DATA_DIR / "studies.json", encoding="utf8") as file:
+        studies = {x["id"]: x for x in json.load(file)["studies"]}
+    with open(TEST_DATA_DIR / "files.json", encoding="utf8") as file:
+        files = {x["id"]: x for x in json.load(file)["files"]}
+
+    documents = []
+    for i in range(hits):
+        dataset = dict(datasets[i % len(datasets)])
+        dataset["has_study"] = [
+            studies[x] for x in dataset["has_study"] if x in studies
+        ]
+        dataset["has_file"] = [files[x] for x in dataset["has_file"] if x in files]
+        documents.append(dataset)
+    return {
+        "facets": [],
+        "count": hits,
+        "hits": [
+            {"document_type": "Dataset", "id": x["id"], "content": x} for x in documents
+        ],
+        "next_cursor": None,
+        "updated_at": datetime.now(timezone.utc),
+    }
+
+
+def validated_response(result: Dict) -> bytes:
+    """Serialize like FastAPI does for a dict that is returned by an endpoint."""
+    return JSONResponse(jsonable_encoder(SearchResult(**result))).body
+
+
+def fast_response(result: Dict) -> bytes:
+    """Serialize the result as it is."""
+    return FastJSONResponse(result).body
+
+
+def measure(serialize: Callable[[Dict], bytes], result: Dict, repeat: int) -> float:
+    """Measure the CPU time per serialization in milliseconds."""
+    start = time.process_time()
+    for _ in range(repeat):
+        serialize(result)
+    return (time.process_time() - start) / repeat * 1000
+
+
+@cli.command()
+def main(hits: int = 100, repeat: int = 200):
+    """Print the CPU time per request for both ways of serialization."""
+    result = get_search_result(hits)
+    validated = measure(validated_response, result, repeat)
+    fast = measure(fast_response, result, repeat)
+    print(f"validated response: {validated:.3f} ms per request")
+    print(f"fast response:      {fast:.3f} ms per request")
+    print(f"CPU time saved:     {validated - fast:.3f} ms ({validated / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    cli()
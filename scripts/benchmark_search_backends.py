@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the latency of text searches on the metadata store (using `$text`)
+with the latency of text searches on the in-memory index.
+
+    Usage:
+        `scripts/benchmark_search_backends.py --db-url mongodb://localhost:27017
+        --load-test-data --repeat 100`
+"""
+
+import asyncio
+import time
+from pathlib import Path
+from typing import List
+
+from pymongo import MongoClient
+from typer import Option, Typer
+
+from metadata_search_service.config import Config
+from metadata_search_service.core.utils import DEFAULT_FACET_FIELDS
+from metadata_search_service.dao.backend import get_backend
+from metadata_search_service.dao.db import close_db
+from metadata_search_service.dao.memory_index import get_memory_index
+from metadata_search_service.dao.utils import read_json_collections
+
+HERE = Path(__file__).parent.resolve()
+TEST_DATA_DIR = HERE.parent.resolve() / "tests" / "fixtures" / "test_data"
+DEFAULT_QUERIES = ["sequencing", "whole genome", "exome cancer", "methylation"]
+
+cli = Typer()
+
+
+def load_test_data(config: Config) -> None:
+    """Replace the collections of the metadata store with the test data."""
+    client: MongoClient = MongoClient(config.db_url)
+    database = client[config.db_name]
+    for collection_name, documents in read_json_collections(TEST_DATA_DIR).items():
+        database.drop_collection(collection_name)
+        database[collection_name].insert_many(documents)
+        database[collection_name].create_index([("$**", "text")])
+    client.close()
+
+
+async def measure(config: Config, queries: List[str], repeat: int) -> float:
+    """Measure the latency per search in milliseconds."""
+    backend = get_backend(config)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            await backend.get_documents(
+                collection_name="Dataset",
+                search_query=query,
+                facet_fields=DEFAULT_FACET_FIELDS["Dataset"],
+            )
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1000
+
+
+async def benchmark(config: Config, queries: List[str], repeat: int) -> None:
+    """Print the latency per search for both backends."""
+    mongodb_config = config.copy(update={"search_backend": "mongodb"})
+    memory_config = config.copy(update={"search_backend": "memory"})
+
+    start = time.perf_counter()
+    await get_memory_index(memory_config)
+    print(f"building the index: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # warm up the connection pool before measuring
+    await measure(mongodb_config, queries, 1)
+    mongodb = await measure(mongodb_config, queries, repeat)
+    memory = await measure(memory_config, queries, repeat)
+    print(f"$text search:       {mongodb:.3f} ms per search")
+    print(f"in-memory search:   {memory:.3f} ms per search")
+    print(f"latency saved:      {mongodb - memory:.3f} ms ({mongodb / memory:.1f}x)")
+    close_db()
+
+
+@cli.command()
+def main(
+    db_url: str = "mongodb://localhost:27017",
+    db_name: str = "metadata-store-benchmark",
+    load_test_data_: bool = Option(
+        False, "--load-test-data", help="Load the test data into the database first"
+    ),
+    queries: List[str] = Option(DEFAULT_QUERIES, "--query"),
+    repeat: int = 100,
+):
+    """Print the latency per search of the metadata store and the in-memory index."""
+    config = Config(db_url=db_url, db_name=db_name)
+    if load_test_data_:
+        load_test_data(config)
+    asyncio.run(benchmark(config, queries, repeat))
+
+
+if __name__ == "__main__":
+    cli()
@@ -16,5 +16,13 @@
 """Fixtures that are used in both integration and unit tests"""
 
 from pathlib import Path
+from typing import Dict, List
+
+from metadata_search_service.dao.utils import read_json_collections
 
 BASE_DIR = Path(__file__).parent.resolve()
+
+
+def load_test_data() -> Dict[str, List[Dict]]:
+    """Load the documents of all collections from the test data."""
+    return read_json_collections(BASE_DIR / "test_data")
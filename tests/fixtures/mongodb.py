@@ -16,8 +16,6 @@
 """Fixture that setup and tears down a MongoDB database together with a correspondingly
 configured app client."""
 
-import json
-import os
 from dataclasses import dataclass
 
 import pytest
@@ -27,8 +25,13 @@ from testcontainers.mongodb import MongoDbContainer
 from metadata_search_service.api.deps import get_config
 from metadata_search_service.api.main import app
 from metadata_search_service.config import Config
+from metadata_search_service.core.cache import get_search_cache
+from metadata_search_service.core.facets import FACET_STORE
+from metadata_search_service.dao.db import close_db
+from metadata_search_service.dao.memory_index import clear_memory_indexes
+from metadata_search_service.dao.sqlite_index import clear_sqlite_indexes
 
-from . import BASE_DIR
+from . import load_test_data
 
 
 @dataclass
@@ -44,34 +47,22 @@ def mongo_app_fixture():
     configured app client.
     """
 
-    json_files = [
-        ("biospecimens.json", "Biospecimen"),
-        ("data_access_committees.json", "DataAccessCommittee"),
-        ("data_access_policies.json", "DataAccessPolicy"),
-        ("datasets.json", "Dataset"),
-        ("experiments.json", "Experiment"),
-        ("files.json", "File"),
-        ("individuals.json", "Individual"),
-        ("projects.json", "Project"),
-        ("samples.json", "Sample"),
-        ("studies.json", "Study"),
-        ("technologies.json", "Technology"),
-    ]
-
     with MongoDbContainer() as mongodb:
         connection_url = mongodb.get_connection_url()
         db_client = mongodb.get_connection_client()
         config = Config(db_url=connection_url, db_name="test")
 
-        for filename, collection_name in json_files:
-            file_path = BASE_DIR / "test_data" / filename
-            with open(file_path, "r", encoding="utf8") as file:
-                file_content = json.load(file)
-                objects = file_content[os.path.splitext(filename)[0]]
-                db_client[config.db_name][collection_name].insert_many(objects)
+        for collection_name, objects in load_test_data().items():
+            db_client[config.db_name][collection_name].insert_many(objects)
             db_client[config.db_name][collection_name].create_index([("$**", "text")])
 
         app.dependency_overrides[get_config] = lambda: config
         app_client = TestClient(app)
 
         yield MongoAppFixture(app_client=app_client, config=config)
+
+        close_db()
+        get_search_cache().clear()
+        FACET_STORE.clear()
+        clear_memory_indexes()
+        clear_sqlite_indexes()
@@ -15,12 +15,25 @@
 
 """Test the api module"""
 
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
 import pytest
 from fastapi import status
 from fastapi.testclient import TestClient
 
+from metadata_search_service.api.deps import get_config
 from metadata_search_service.api.main import app
+from metadata_search_service.config import Config
+from metadata_search_service.core.cache import DATA_VERSIONS, get_search_cache
+from metadata_search_service.core.facets import FACET_STORE
+from metadata_search_service.core.utils import DEFAULT_FACET_FIELDS
+from metadata_search_service.dao.sqlite_index import build_sqlite_database
+from metadata_search_service.models import SearchResult
 
+from ..fixtures import load_test_data
 from ..fixtures.mongodb import MongoAppFixture, mongo_app_fixture  # noqa: F401
 
 
@@ -219,3 +232,420 @@ def test_search(  # noqa: C901
                     assert (
                         key in facets[facet_name] and facets[facet_name][key] == value
                     )
+
+
+def test_search_with_cursor(mongo_app_fixture: MongoAppFixture):  # noqa: F811
+    """Test that paging with a cursor yields the same hits as paging with skip"""
+    client = mongo_app_fixture.app_client
+    url = "/rpc/search?document_type=Dataset&limit=2"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    next_cursor = response.json()["next_cursor"]
+    assert next_cursor
+
+    response = client.post(f"{url}&after={next_cursor}", json={"query": "*"})
+    assert response.status_code == 200
+    hits_after = response.json()["hits"]
+    response = client.post(f"{url}&skip=2", json={"query": "*"})
+    hits_skip = response.json()["hits"]
+    assert [x["id"] for x in hits_after] == [x["id"] for x in hits_skip]
+
+    response = client.post(f"{url}&after=invalid", json={"query": "*"})
+    assert response.status_code == 400
+
+
+def test_search_with_precomputed_facets(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that facets of unfiltered searches are served from precomputed facets"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    asyncio.run(FACET_STORE.refresh("Dataset", config))
+    precomputed = FACET_STORE.get("Dataset", config)
+    assert precomputed is not None and precomputed.count == 5
+
+    url = "/rpc/search?document_type=Dataset&return_facets=true"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 5
+    assert data["facets"] == precomputed.facets
+    assert data["updated_at"].startswith(precomputed.updated_at.isoformat()[:19])
+
+
+def test_search_with_max_facet_options(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that only the most frequent facet options are returned"""
+    client = mongo_app_fixture.app_client
+    url = "/rpc/search?document_type=Dataset&return_facets=true&max_facet_options=1"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    [facet] = [x for x in response.json()["facets"] if x["key"] == "type"]
+    assert facet["options"] == [{"option": "Exome sequencing", "count": 2}]
+    assert facet["other"] == 3
+
+
+def test_search_with_disjunctive_facets(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that the counts of a facet ignore the filters on that facet"""
+    client = mongo_app_fixture.app_client
+    url = "/rpc/search?document_type=Dataset&return_facets=true&disjunctive_facets=true"
+    query: Dict[str, Any] = {
+        "query": "*",
+        "filters": [{"key": "type", "value": "Exome sequencing"}],
+    }
+    response = client.post(url, json=query)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 2
+    [facet] = [x for x in data["facets"] if x["key"] == "type"]
+    assert {"option": "Exome sequencing", "count": 2} in facet["options"]
+    assert sum(option["count"] for option in facet["options"]) == 5
+
+
+def test_export(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that all hits are exported as newline-delimited JSON"""
+    client = mongo_app_fixture.app_client
+    query: Dict[str, Any] = {
+        "query": "*",
+        "filters": [{"key": "type", "value": "Exome sequencing"}],
+    }
+    response = client.post("/rpc/search/export?document_type=Dataset", json=query)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    hits = [json.loads(line) for line in response.text.splitlines()]
+    assert len(hits) == 2
+    for hit in hits:
+        assert hit["document_type"] == "Dataset"
+        assert hit["content"]["type"] == "Exome sequencing"
+        assert hit["id"] == hit["content"]["id"]
+
+
+def test_search_batch(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that a batch of searches returns one result per query in order"""
+    client = mongo_app_fixture.app_client
+    exome_query: Dict[str, Any] = {
+        "query": "*",
+        "filters": [{"key": "type", "value": "Exome sequencing"}],
+        "document_type": "Dataset",
+        "return_facets": True,
+    }
+    queries: List[Dict[str, Any]] = [
+        exome_query,
+        {"query": "*", "document_type": "Study", "limit": 1},
+        exome_query,
+    ]
+    response = client.post("/rpc/search/batch", json=queries)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 3
+    assert results[0]["count"] == 2
+    assert results[0]["facets"]
+    assert len(results[1]["hits"]) == 1
+    assert results[1]["hits"][0]["document_type"] == "Study"
+    assert results[2] == results[0]
+
+    config = mongo_app_fixture.config
+    response = client.post(
+        "/rpc/search/batch", json=[exome_query] * (config.batch_max_size + 1)
+    )
+    assert response.status_code == 400
+
+
+def test_search_federated(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that all document types are searched at once"""
+    client = mongo_app_fixture.app_client
+    response = client.post("/rpc/search/federated?limit=5", json={"query": "*"})
+    assert response.status_code == 200
+    data = response.json()
+    assert not data["partial"]
+    counts = {x["document_type"]: x["count"] for x in data["counts"]}
+    assert counts["Dataset"] == 5
+    assert data["count"] == sum(counts.values())
+    assert len(data["hits"]) == 5
+
+    query: Dict[str, Any] = {
+        "query": "*",
+        "filters": [{"key": "type", "value": "Exome sequencing"}],
+    }
+    response = client.post("/rpc/search/federated", json=query)
+    assert response.status_code == 400
+
+
+def test_search_response_schema(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that the unvalidated search response conforms to its schema"""
+    client = mongo_app_fixture.app_client
+    url = "/rpc/search?document_type=Dataset&return_facets=true"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    data = response.json()
+    assert json.loads(SearchResult(**data).json(exclude_unset=True)) == data
+
+
+def test_search_with_raw_bson_hits(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that hits passed through as raw BSON have the same content"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    url = "/rpc/search?document_type=Dataset&limit=3"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    expected = response.json()
+
+    get_search_cache().clear()
+    app.dependency_overrides[get_config] = lambda: config.copy(
+        update={"raw_bson_hits": True}
+    )
+    response = client.post(url, json={"query": "*"})
+    app.dependency_overrides[get_config] = lambda: config
+    assert response.status_code == 200
+    data = response.json()
+    assert data["hits"] == expected["hits"]
+    assert data["next_cursor"] == expected["next_cursor"]
+
+
+def test_search_with_fields(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that only the requested fields are included in each hit"""
+    client = mongo_app_fixture.app_client
+    url = "/rpc/search?document_type=Dataset&fields=title,type,has_study.type"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    hits = response.json()["hits"]
+    assert len(hits) == 5
+    for hit in hits:
+        assert set(hit["content"]) == {"id", "title", "type", "has_study"}
+        for study in hit["content"]["has_study"]:
+            assert set(study) == {"type"}
+
+
+def test_search_with_expand(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that the references of each hit can be expanded"""
+    client = mongo_app_fixture.app_client
+    url = "/rpc/search?document_type=Dataset&fields=title,has_file"
+    response = client.post(url, json={"query": "*"})
+    assert response.status_code == 200
+    hits = response.json()["hits"]
+    assert all(isinstance(x, str) for x in hits[0]["content"]["has_file"])
+
+    response = client.post(f"{url}&expand=has_file", json={"query": "*"})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["hits"]) == 5
+    for hit in data["hits"]:
+        assert all(isinstance(x, dict) for x in hit["content"]["has_file"])
+        assert all("id" in x for x in hit["content"]["has_file"])
+    assert isinstance(data["truncated"], list)
+
+    response = client.post(f"{url}&expand=title", json={"query": "*"})
+    assert response.status_code == 400
+    response = client.get(f"{url}&expand=title")
+    assert response.status_code == 400
+
+
+def get_backend_config(config: Config, backend: str, tmp_path: Path) -> Config:
+    """Get a config for a snapshot backend, building its database if needed."""
+    update = {"search_backend": backend}
+    if backend == "sqlite":
+        sqlite_path = str(tmp_path / "metadata_store.sqlite3")
+        build_sqlite_database(
+            sqlite_path,
+            load_test_data(),
+            facet_fields=DEFAULT_FACET_FIELDS,
+            field_weights=config.search_field_weights,
+        )
+        update["sqlite_path"] = sqlite_path
+    return config.copy(update=update)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+@pytest.mark.parametrize(
+    "document_type,filters,params",
+    [
+        ("Dataset", [], "return_facets=true"),
+        ("Dataset", [{"key": "type", "value": "Exome sequencing"}], "limit=1"),
+        (
+            "Dataset",
+            [{"key": "has_study.type", "value": "Other"}],
+            "return_facets=true&disjunctive_facets=true",
+        ),
+        (
+            "Dataset",
+            [
+                {
+                    "key": "has_study.has_project.name",
+                    "value": "Project for Study 6c41f0c2-8145-468a-8d79-63ef900d0e2b",
+                }
+            ],
+            "fields=title",
+        ),
+        ("Study", [], "return_facets=true&fields=title,has_project.name"),
+        ("File", [], "return_facets=true&skip=2&limit=3"),
+    ],
+)
+def test_search_with_snapshot_backend(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+    tmp_path,
+    backend,
+    document_type,
+    filters,
+    params,
+):
+    """Test that the snapshot backends return the same results as the metadata store"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    url = f"/rpc/search?document_type={document_type}&{params}"
+    query = {"query": "*", "filters": filters}
+    expected = client.post(url, json=query).json()
+
+    get_search_cache().clear()
+    backend_config = get_backend_config(config, backend, tmp_path)
+    app.dependency_overrides[get_config] = lambda: backend_config
+    response = client.post(url, json=query)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["count"] == expected["count"] > 0
+    assert result["hits"] == expected["hits"]
+    assert result["facets"] == expected["facets"]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+@pytest.mark.parametrize(
+    "method,url,body",
+    [
+        ("get", "/documents/Dataset/ed0845e8-c71b-4940-abe0-52c9e5910de2", None),
+        (
+            "get",
+            "/documents/Dataset/ed0845e8-c71b-4940-abe0-52c9e5910de2?expand=has_study",
+            None,
+        ),
+        ("post", "/rpc/search/export?document_type=Study", {"query": "*"}),
+        ("post", "/rpc/search/federated?limit=20", {"query": "*"}),
+    ],
+)
+def test_snapshot_backend_endpoints(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+    tmp_path,
+    backend,
+    method,
+    url,
+    body,
+):
+    """Test that all endpoints respond the same with the snapshot backends"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    expected = client.request(method, url, json=body)
+    assert expected.status_code == 200
+
+    backend_config = get_backend_config(config, backend, tmp_path)
+    app.dependency_overrides[get_config] = lambda: backend_config
+    response = client.request(method, url, json=body)
+    assert response.status_code == 200
+    assert response.text == expected.text
+
+
+def test_search_get_with_etag(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that a cacheable search is only performed if its data has changed"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    app.dependency_overrides[get_config] = lambda: config.copy(
+        update={"watch_changes": True}
+    )
+    # there are no entity tags unless the metadata store is being watched
+    response = client.get("/rpc/search?document_type=Dataset")
+    assert "etag" not in response.headers
+    DATA_VERSIONS.watched = True
+
+    url = "/rpc/search?document_type=Dataset&filter=type:Exome%20sequencing"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json()["count"] == 2
+    etag = response.headers["etag"]
+
+    # equivalent searches share the same result and entity tag
+    equivalent_response = client.get(f"{url}&query=%20*%20")
+    assert equivalent_response.json()["hits"] == response.json()["hits"]
+    assert equivalent_response.headers["etag"] == etag
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert not response.content
+
+    DATA_VERSIONS.bump("Dataset")
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+    response = client.get("/rpc/search?document_type=Dataset&filter=type")
+    assert response.status_code == 400
+    DATA_VERSIONS.watched = False
+    app.dependency_overrides[get_config] = lambda: config
+
+
+def test_get_document(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+):
+    """Test that a document can be retrieved with its references expanded"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    url = "/documents/Dataset/e95a3a0a-fd25-4fd3-8540-da5e6d90c475"
+    response = client.get(url)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["document_type"] == "Dataset"
+    assert data["id"] == data["content"]["id"]
+    assert all(isinstance(x, str) for x in data["content"]["has_study"])
+
+    response = client.get(f"{url}?expand=has_study,has_file,has_data_access_policy")
+    assert response.status_code == 200
+    content = response.json()["content"]
+    assert content["has_study"][0]["id"] == data["content"]["has_study"][0]
+    assert len(content["has_file"]) == min(52, config.expand_max_items)
+    # the referenced policy is not part of the test data
+    assert content["has_data_access_policy"] is None
+
+    response = client.get(f"{url}?expand=has_attribute")
+    assert response.status_code == 400
+    response = client.get("/documents/Dataset/unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("backend", ["mongodb", "memory", "sqlite"])
+def test_search_with_sort(
+    mongo_app_fixture: MongoAppFixture,  # noqa: F811
+    tmp_path,
+    backend,
+):
+    """Test that the hits of a search can be sorted by a configured field"""
+    client = mongo_app_fixture.app_client
+    config = mongo_app_fixture.config
+    backend_config = get_backend_config(config, backend, tmp_path)
+    app.dependency_overrides[get_config] = lambda: backend_config
+    url = "/rpc/search?document_type=Dataset&sort=-title&limit=2"
+    titles: List[str] = []
+    for skip in range(0, 5, 2):
+        response = client.get(f"{url}&skip={skip}")
+        assert response.status_code == 200
+        titles.extend(x["content"]["title"] for x in response.json()["hits"])
+    expected = sorted((x["title"] for x in load_test_data()["Dataset"]), reverse=True)
+    assert titles == expected
+
+    response = client.get("/rpc/search?document_type=Dataset&sort=type")
+    assert response.status_code == 400
+    app.dependency_overrides[get_config] = lambda: config
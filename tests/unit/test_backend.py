@@ -0,0 +1,134 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the choice of the search backend"""
+
+import asyncio
+
+import pytest
+
+from metadata_search_service.config import Config
+from metadata_search_service.dao import memory_index
+from metadata_search_service.dao.backend import get_backend, reads_metadata_store
+from metadata_search_service.dao.document import MongoSearchBackend
+from metadata_search_service.dao.memory_index import (
+    MemoryIndex,
+    MemorySearchBackend,
+    SnapshotIndex,
+    SnapshotSearchBackend,
+    clear_memory_indexes,
+    get_memory_index,
+)
+from metadata_search_service.models import FilterOption
+
+from ..fixtures import load_test_data
+
+
+def test_get_backend():
+    """Test that the backend is chosen in the config"""
+    assert isinstance(get_backend(Config()), MongoSearchBackend)
+    backend = get_backend(Config(search_backend="memory"))
+    assert isinstance(backend, MemorySearchBackend)
+    assert not backend.supports_raw_bson
+    # subclasses that do not implement the interface cannot be instantiated
+    with pytest.raises(TypeError):
+        SnapshotIndex()  # type: ignore[abstract]
+    with pytest.raises(TypeError):
+        SnapshotSearchBackend(Config())  # type: ignore[abstract]
+
+
+def test_reads_metadata_store():
+    """Test that backends of prebuilt files do not need the metadata store"""
+    assert reads_metadata_store(Config())
+    assert reads_metadata_store(Config(search_backend="memory"))
+    assert not reads_metadata_store(
+        Config(search_backend="memory", memory_snapshot_path="index.snapshot")
+    )
+    assert not reads_metadata_store(Config(search_backend="sqlite"))
+
+
+def test_get_memory_index_builds_once(monkeypatch):
+    """Test that concurrent first calls share a single build of the index"""
+    builds = []
+
+    async def load_memory_index(config):  # pylint: disable=unused-argument
+        builds.append(config)
+        await asyncio.sleep(0.01)
+        return MemoryIndex({})
+
+    monkeypatch.setattr(memory_index, "load_memory_index", load_memory_index)
+    config = Config(search_backend="memory")
+
+    async def get_concurrently():
+        return await asyncio.gather(*[get_memory_index(config) for _ in range(5)])
+
+    clear_memory_indexes()
+    indexes = asyncio.run(get_concurrently())
+    assert len(builds) == 1
+    assert all(x is indexes[0] for x in indexes)
+    assert asyncio.run(get_memory_index(config)) is indexes[0]
+
+    clear_memory_indexes()
+    assert asyncio.run(get_memory_index(config)) is not indexes[0]
+    assert len(builds) == 2
+    clear_memory_indexes()
+
+
+def test_memory_backend(monkeypatch):
+    """Test that the memory backend searches, counts, facets and fetches documents"""
+    test_index = MemoryIndex(load_test_data())
+
+    async def get_memory_index(config):  # pylint: disable=unused-argument
+        return test_index
+
+    monkeypatch.setattr(memory_index, "get_memory_index", get_memory_index)
+    backend = get_backend(Config(search_backend="memory"))
+    filters = [FilterOption(key="type", value="Exome sequencing")]
+
+    async def use_backend():
+        docs, _, count, _ = await backend.get_documents("Dataset", filters=filters)
+        assert count == len(docs) == 2
+        assert await backend.count_documents("Dataset", filters=filters) == 2
+        assert await backend.count_documents("Dataset", search_query="unknown") == 0
+
+        facets, count = await backend.get_facets("Dataset", facet_fields={"type"})
+        assert count == 5
+        assert facets[0]["type"]["options"][0] == {
+            "_id": "Exome sequencing",
+            "count": 2,
+        }
+
+        exported = [
+            doc
+            async for doc in backend.iter_documents(
+                "Dataset", filters=filters, fields=["title"]
+            )
+        ]
+        assert exported == [{"id": x["id"], "title": x["title"]} for x in docs]
+
+        ranked_docs, count = await backend.get_ranked_documents(
+            "Dataset", search_query="sequencing", limit=2
+        )
+        assert count == 4
+        assert len(ranked_docs) == 2
+        assert ranked_docs[0][0] >= ranked_docs[1][0] > 0
+
+        document = await backend.get_document("Dataset", docs[0]["id"])
+        assert document == docs[0]
+        assert await backend.get_document("Dataset", "unknown") is None
+        references = await backend.get_references("Dataset", [docs[1]["id"], "unknown"])
+        assert references == {docs[1]["id"]: docs[1]}
+
+    asyncio.run(use_backend())
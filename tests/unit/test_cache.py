@@ -0,0 +1,138 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the search result cache"""
+
+from metadata_search_service.core import cache
+from metadata_search_service.core.cache import (
+    DataVersions,
+    SearchCache,
+    make_search_cache_key,
+    make_search_etag,
+    normalize_search_query,
+)
+from metadata_search_service.models import FilterOption
+
+
+def test_cache_lru_eviction():
+    """Test that the least recently used entry is evicted first"""
+    cache = SearchCache(max_entries=2, ttl=60, max_bytes=1024)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [1]
+    assert cache.get("c") == [3]
+    assert cache.stats() == {
+        "entries": 2,
+        "bytes": 6,
+        "hits": 3,
+        "misses": 1,
+        "evictions": 1,
+    }
+
+
+def test_cache_ttl_and_byte_budget():
+    """Test that entries expire and that the byte budget is respected"""
+    cache = SearchCache(max_entries=10, ttl=0, max_bytes=10)
+    cache.put("a", [1])
+    assert cache.get("a") is None
+
+    cache = SearchCache(max_entries=10, ttl=60, max_bytes=8)
+    cache.put("large", "x" * 20)
+    assert cache.get("large") is None
+    cache.put("a", "xxx")
+    cache.put("b", "xxx")
+    assert cache.get("a") is None
+    assert cache.get("b") == "xxx"
+    assert cache.stats()["bytes"] == 5
+    assert cache.stats()["evictions"] == 1
+
+    cache = SearchCache(max_entries=0, ttl=60, max_bytes=1024)
+    cache.put("a", [1])
+    assert cache.get("a") is None
+
+
+def test_normalize_search_query():
+    """Test that queries are normalized in their whitespace"""
+    assert normalize_search_query(" pancreatic  cancer ") == "pancreatic cancer"
+    assert normalize_search_query(" * ") == "*"
+    assert normalize_search_query("  ") == "*"
+    assert normalize_search_query(None) == "*"
+
+
+def test_make_search_cache_key():
+    """Test that equivalent searches share the same cache key"""
+    filters = [
+        FilterOption(key="type", value="Exome sequencing"),
+        FilterOption(key="has_study.type", value="Other"),
+    ]
+    key = make_search_cache_key("Dataset", " pancreatic  cancer", filters)
+    assert key == make_search_cache_key(
+        "Dataset", "pancreatic cancer", list(reversed(filters))
+    )
+    assert key != make_search_cache_key("Dataset", "pancreatic cancer", filters[:1])
+    assert key != make_search_cache_key("Study", "pancreatic cancer", filters)
+
+
+def test_make_search_etag():
+    """Test that entity tags only depend on the cache key"""
+    etag = make_search_etag("key")
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert make_search_etag("key") == etag
+    assert make_search_etag("other key") != etag
+
+
+def test_make_search_etag_with_max_age(monkeypatch):
+    """Test that entity tags with a maximum age expire at the same time"""
+    monkeypatch.setattr(cache.time, "time", lambda: 1000.0)
+    etag = make_search_etag("key", max_age=60)
+    assert etag != make_search_etag("key")
+    monkeypatch.setattr(cache.time, "time", lambda: 1019.0)
+    assert make_search_etag("key", max_age=60) == etag
+    monkeypatch.setattr(cache.time, "time", lambda: 1020.0)
+    assert make_search_etag("key", max_age=60) != etag
+
+
+def test_data_versions():
+    """Test that versions of unwatched processes never match other versions"""
+    versions = DataVersions()
+    initial_versions = versions.get(["Dataset", "Study"])
+    assert initial_versions != DataVersions().get(["Dataset", "Study"])
+
+    versions.bump("Study", "42.1")
+    assert versions.get(["Dataset", "Study"]) == {
+        "Dataset": initial_versions["Dataset"],
+        "Study": "42.1",
+    }
+    versions.bump_all("43.1")
+    assert versions.get(["Dataset", "File"]) == {"Dataset": "43.1", "File": "43.1"}
+
+
+def test_data_versions_approximate():
+    """Test that versions derived from fingerprints are approximate"""
+    versions = DataVersions()
+    assert not versions.is_approximate(["Dataset", "Study"])
+    versions.bump_all("None", approximate=True)
+    versions.bump("Dataset", "(5, 100, 5)", approximate=True)
+    assert versions.is_approximate(["Dataset"])
+    assert versions.is_approximate(["File"])
+
+    # a change reported by a change stream makes the version exact
+    versions.bump("Dataset", "42.1")
+    assert not versions.is_approximate(["Dataset"])
+    assert versions.is_approximate(["Dataset", "Study"])
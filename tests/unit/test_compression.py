@@ -0,0 +1,157 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test the response compression middleware"""
+
+import asyncio
+import gzip
+import threading
+import time
+import zlib
+from typing import List
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from metadata_search_service.api import compression
+from metadata_search_service.api.compression import (
+    CompressionMiddleware,
+    select_encoding,
+)
+
+
+def test_select_encoding():
+    """Test that the accepted encoding with the highest quality is selected"""
+    encodings = ["zstd", "br", "gzip"]
+    assert select_encoding("gzip, deflate, br", encodings) == "br"
+    assert select_encoding("gzip;q=1.0, br;q=0.5", encodings) == "gzip"
+    assert select_encoding("*", encodings) == "zstd"
+    assert select_encoding("*, zstd;q=0", encodings) == "br"
+    assert select_encoding("deflate", encodings) is None
+    assert select_encoding("", encodings) is None
+
+
+def test_compression_middleware():
+    """Test that large and streaming responses are compressed"""
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100, offload_size=1000)
+    bodies = {"small": "x" * 10, "medium": "x" * 500, "large": "x" * 5000}
+
+    @app.get("/{size}")
+    async def text(size: str):
+        return PlainTextResponse(bodies[size])
+
+    @app.get("/stream/{size}")
+    async def stream(size: str):
+        return StreamingResponse(iter([bodies[size], bodies["large"]]))
+
+    client = TestClient(app)
+    headers = {"Accept-Encoding": "gzip"}
+    for size in ("medium", "large"):
+        response = client.get(f"/{size}", headers=headers)
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert int(response.headers["content-length"]) < len(bodies[size])
+        assert response.text == bodies[size]
+
+    response = client.get("/small", headers=headers)
+    assert "content-encoding" not in response.headers
+    assert response.text == bodies["small"]
+
+    for size in ("small", "large"):
+        response = client.get(f"/stream/{size}", headers=headers)
+        assert response.headers["content-encoding"] == "gzip"
+        assert "content-length" not in response.headers
+        assert response.text == bodies[size] + bodies["large"]
+
+    response = client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+
+
+class UnsafeZstandard:  # pylint: disable=too-few-public-methods
+    """Stands in for zstandard with compressors that may not be shared by threads"""
+
+    class ZstdCompressor:
+        """A compressor that fails if it is used by two threads at once"""
+
+        def __init__(self, level: int):
+            self.level = level
+            self.lock = threading.Lock()
+
+        def compress(self, data: bytes) -> bytes:
+            """Compress a whole body, which is what a shared compressor would do"""
+            obj = self.compressobj()
+            return obj.compress(data) + obj.flush()
+
+        def compressobj(self):
+            """Create an incremental compressor, writing gzip for simplicity"""
+            lock = self.lock
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+            class CompressObj:
+                """An incremental compressor that detects concurrent use"""
+
+                @staticmethod
+                def compress(data: bytes) -> bytes:
+                    """Compress a chunk slowly, so that concurrent use overlaps"""
+                    if lock.locked():
+                        raise RuntimeError("compressor used by two threads")
+                    with lock:
+                        time.sleep(0.01)
+                        return compressor.compress(data)
+
+                @staticmethod
+                def flush() -> bytes:
+                    """Finish the stream"""
+                    return compressor.flush()
+
+            return CompressObj()
+
+
+def test_compression_middleware_concurrent_offload(monkeypatch):
+    """Test that bodies compressed in worker threads at once do not share state"""
+    monkeypatch.setattr(compression, "zstandard", UnsafeZstandard)
+
+    async def app(scope, receive, send):  # pylint: disable=unused-argument
+        body = scope["path"].encode() * 1000
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": body})
+
+    middleware = CompressionMiddleware(app, minimum_size=10, offload_size=10)
+
+    async def request(path: str) -> bytes:
+        messages: List = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def receive():
+            return {"type": "http.request"}
+
+        scope = {
+            "type": "http",
+            "path": path,
+            "headers": [(b"accept-encoding", b"zstd")],
+        }
+        await middleware(scope, receive, send)
+        assert (b"content-encoding", b"zstd") in messages[0]["headers"]
+        return gzip.decompress(messages[1]["body"])
+
+    async def request_all():
+        paths = [f"/{number}" for number in range(10)]
+        bodies = await asyncio.gather(*(request(path) for path in paths))
+        assert bodies == [path.encode() * 1000 for path in paths]
+
+    asyncio.run(request_all())
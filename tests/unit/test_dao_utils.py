@@ -0,0 +1,326 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the DAO utilities that build MongoDB queries"""
+
+import json
+from datetime import datetime
+
+import bson
+import orjson
+import pytest
+from bson import ObjectId, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from metadata_search_service.dao import utils
+from metadata_search_service.dao.utils import (
+    DEFAULT_SORT,
+    RANKED_SORT,
+    RAW_KEY_FIELD,
+    SCORE_FIELD,
+    SORT_KEY_FIELD,
+    InvalidCursorError,
+    InvalidSortError,
+    build_aggregation_query,
+    build_count_query,
+    build_facet_queries,
+    build_facet_value_query,
+    build_keyset_query,
+    build_match_query,
+    build_raw_query,
+    build_reference_query,
+    build_sort,
+    decode_cursor,
+    encode_cursor,
+    get_sparse_fields,
+    group_facet_fields,
+    raw_bson_to_json,
+)
+from metadata_search_service.models import FilterOption
+
+
+def test_build_match_query_skips_nested_filters():
+    """Test that nested filters are not part of the local match query"""
+    filters = [
+        FilterOption(key="type", value="Exome sequencing"),
+        FilterOption(key="type", value="Whole genome sequencing"),
+        FilterOption(key="has_study.type", value="Other"),
+        FilterOption(key="has_attribute.key", value="centerName"),
+    ]
+    match_query = build_match_query(filters)
+    assert match_query == {
+        "type": {"$in": ["Exome sequencing", "Whole genome sequencing"]},
+        "has_attribute.key": {"$in": ["centerName"]},
+    }
+
+
+def test_build_reference_query():
+    """Test the query for the first step of a semi-join"""
+    top_level_field, collection_name, query = build_reference_query(
+        "has_data_access_policy.has_data_access_committee.name", ["DAC"]
+    )
+    assert top_level_field == "has_data_access_policy"
+    assert collection_name == "DataAccessPolicy"
+    assert query == {"has_data_access_committee.name": {"$in": ["DAC"]}}
+
+
+def test_build_aggregation_query_semi_join():
+    """Test that nested filters are matched before any lookup is performed"""
+    filters = [
+        FilterOption(key="type", value="Exome sequencing"),
+        FilterOption(key="has_study.type", value="Other"),
+    ]
+    reference_filters = [{"has_study": {"$in": ["study-1", "study-2"]}}]
+    pipelines = build_aggregation_query(
+        filters=filters, reference_filters=reference_filters, skip=5, limit=5
+    )
+    assert pipelines[0] == {
+        "$match": {
+            "type": {"$in": ["Exome sequencing"]},
+            "$and": reference_filters,
+        }
+    }
+    # the $limit directly follows the $sort, which makes it a top-k sort
+    assert pipelines[1:4] == [{"$sort": {"_id": 1}}, {"$limit": 10}, {"$skip": 5}]
+    assert pipelines[4]["$lookup"]["from"] == "Study"
+
+
+def test_build_count_and_facet_queries():
+    """Test that count and facets are independent queries with the same match"""
+    filters = [FilterOption(key="type", value="Exome sequencing")]
+    match_pipeline = {"$match": {"type": {"$in": ["Exome sequencing"]}}}
+
+    count_query = build_count_query(filters=filters)
+    assert count_query == [match_pipeline, {"$count": "total"}]
+
+    facet_queries = build_facet_queries(
+        facet_fields={"type", "has_study.type"}, filters=filters
+    )
+    assert len(facet_queries) == 2
+    for facet_query in facet_queries:
+        assert facet_query[0] == match_pipeline
+    assert set(facet_queries[0][1]["$facet"]) == {"has_study__type"}
+    assert set(facet_queries[1][1]["$facet"]) == {"type"}
+
+
+def test_build_facet_queries_top_options():
+    """Test that only the top options are returned together with the rest count"""
+    [facet_query] = build_facet_queries(
+        facet_fields={"type", "format"}, max_options={"type": 3}, disjunctive=True
+    )
+    subpipelines = facet_query[0]["$facet"]
+    # only the top options are collected into the result document
+    assert subpipelines["type"][-2:] == [
+        {"$sort": {"count": -1, "_id": 1}},
+        {"$limit": 3},
+    ]
+    assert subpipelines["type__total"][-1] == {"$count": "count"}
+    assert subpipelines["format"][-1] == {"$sort": {"count": -1, "_id": 1}}
+    assert "format__total" not in subpipelines
+    assert facet_query[1]["$project"]["type"] == {
+        "options": "$type",
+        "other": {
+            "$subtract": [{"$sum": "$type__total.count"}, {"$sum": "$type.count"}]
+        },
+    }
+    assert facet_query[1]["$project"]["format"] == {
+        "options": "$format",
+        "other": {"$literal": 0},
+    }
+
+
+def test_build_disjunctive_facet_queries():
+    """Test that each facet ignores its own filters and groups share a query"""
+    filters = [
+        FilterOption(key="type", value="Exome sequencing"),
+        FilterOption(key="has_study.type", value="Cancer"),
+    ]
+    reference_filters = {"has_study.type": {"has_study": {"$in": ["study-1"]}}}
+    facet_queries = build_facet_queries(
+        facet_fields={"type", "has_study.type", "format"},
+        filters=filters,
+        reference_filters=reference_filters,
+        disjunctive=True,
+    )
+    matches = {
+        frozenset(query[1]["$facet"]): query[0]["$match"] for query in facet_queries
+    }
+    assert matches == {
+        frozenset({"format"}): {
+            "type": {"$in": ["Exome sequencing"]},
+            "$and": [{"has_study": {"$in": ["study-1"]}}],
+        },
+        frozenset({"has_study__type"}): {"type": {"$in": ["Exome sequencing"]}},
+        frozenset({"type"}): {"$and": [{"has_study": {"$in": ["study-1"]}}]},
+    }
+
+    groups = group_facet_fields(
+        facet_fields={"type", "format", "sex"}, filters=filters[:1], disjunctive=True
+    )
+    assert groups == [({"format", "sex"}, filters[:1]), ({"type"}, [])]
+
+
+def test_cursor_roundtrip():
+    """Test that a cursor encodes the sort key of the last document"""
+    sort = [(SCORE_FIELD, -1), ("_id", 1)]
+    sort_key = [1.5, ObjectId("62a0c1f0e4b0a1b2c3d4e5f6")]
+    cursor = encode_cursor(sort=sort, sort_key=sort_key)
+    assert decode_cursor(cursor, sort=sort) == sort_key
+
+    with pytest.raises(InvalidCursorError):
+        decode_cursor(cursor, sort=DEFAULT_SORT)
+    with pytest.raises(InvalidCursorError):
+        decode_cursor("not-a-cursor", sort=sort)
+
+
+def test_build_aggregation_query_keyset():
+    """Test that a relevance sorted page continues after the given sort key"""
+    sort = [(SCORE_FIELD, -1), ("_id", 1)]
+    pipelines = build_aggregation_query(
+        search_query="cancer", sort=sort, after=[1.5, "abc"], limit=10
+    )
+    assert pipelines[:5] == [
+        {"$match": {"$text": {"$search": "cancer"}}},
+        {"$addFields": {SCORE_FIELD: {"$meta": "textScore"}}},
+        {
+            "$match": {
+                "$or": [
+                    {SCORE_FIELD: {"$lt": 1.5}},
+                    {SCORE_FIELD: 1.5, "_id": {"$gt": "abc"}},
+                ]
+            }
+        },
+        {"$sort": {SCORE_FIELD: -1, "_id": 1}},
+        {"$limit": 10},
+    ]
+
+
+def test_build_sort():
+    """Test that text searches are sorted by relevance unless sorted by a field"""
+    assert build_sort(None, "cancer") == RANKED_SORT
+    assert build_sort("relevance", "*") == DEFAULT_SORT
+    assert build_sort(None, "*") == DEFAULT_SORT
+    assert build_sort("-title", "cancer", ["title"]) == [("title", -1), ("_id", 1)]
+    with pytest.raises(InvalidSortError):
+        build_sort("type", "cancer", ["title"])
+
+
+def test_build_keyset_query_with_null():
+    """Test that a cursor continues after missing values, which sort first"""
+    sort = [("title", 1), ("_id", 1)]
+    assert build_keyset_query(sort, [None, "abc"]) == {
+        "$or": [{"title": {"$ne": None}}, {"title": None, "_id": {"$gt": "abc"}}]
+    }
+    sort = [("title", -1), ("_id", 1)]
+    assert build_keyset_query(sort, ["B", "abc"]) == {
+        "$or": [
+            {"$or": [{"title": {"$lt": "B"}}, {"title": None}]},
+            {"title": "B", "_id": {"$gt": "abc"}},
+        ]
+    }
+
+
+def test_build_facet_value_query():
+    """Test that array valued facet fields are unwound and deduplicated"""
+    assert build_facet_value_query("type") == [
+        {"$project": {"type": 1}},
+        {"$unwind": {"path": "$type", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"value": "$type"}},
+    ]
+
+    pipelines = build_facet_value_query("has_study.type")
+    assert pipelines[0] == {"$project": {"has_study": 1}}
+    assert pipelines[1]["$lookup"]["from"] == "Study"
+    assert pipelines[2:] == [
+        {"$unwind": {"path": "$has_study", "preserveNullAndEmptyArrays": True}},
+        {"$unwind": {"path": "$has_study.type", "preserveNullAndEmptyArrays": True}},
+        {"$group": {"_id": {"doc": "$_id", "value": "$has_study.type"}}},
+        {"$project": {"_id": "$_id.doc", "value": "$_id.value"}},
+    ]
+
+
+def test_raw_document():
+    """Test that only the key of a raw document is decoded"""
+    [replace_root, project] = build_raw_query()
+    assert replace_root["$replaceRoot"]["newRoot"][RAW_KEY_FIELD] == {
+        "id": "$id",
+        "sort_key": f"${SORT_KEY_FIELD}",
+    }
+    assert project == {"$project": {f"content.{SORT_KEY_FIELD}": 0}}
+
+    object_id = ObjectId("62a0c1f0e4b0a1b2c3d4e5f6")
+    content = {"id": "dataset-1", "has_study": [{"id": "study-1", "type": "Other"}]}
+    raw = bson.encode(
+        {
+            RAW_KEY_FIELD: {"id": "dataset-1", "sort_key": [object_id]},
+            "content": content,
+        }
+    )
+    doc = RawBSONDocument(raw, CodecOptions(document_class=RawBSONDocument))
+    assert doc[RAW_KEY_FIELD]["sort_key"] == [object_id]
+    assert isinstance(doc["content"], RawBSONDocument)
+    assert json.loads(raw_bson_to_json(doc["content"])) == content
+
+
+@pytest.mark.parametrize("with_bsonjs", [False, True])
+def test_raw_bson_to_json(monkeypatch, with_bsonjs):
+    """Test that raw BSON is converted to JSON like decoded documents"""
+
+    class RelaxedBsonjs:  # pylint: disable=too-few-public-methods
+        """Converts BSON to relaxed extended JSON, like python-bsonjs"""
+
+        @staticmethod
+        def dumps(raw):
+            return json_util.dumps(
+                bson.decode(raw), json_options=json_util.RELAXED_JSON_OPTIONS
+            )
+
+    monkeypatch.setattr(utils, "bsonjs", RelaxedBsonjs() if with_bsonjs else None)
+    content = {"id": "dataset-1", "release_date": datetime(2021, 6, 1, 12, 30)}
+    document = RawBSONDocument(bson.encode(content))
+    expected = orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+    assert raw_bson_to_json(document) == expected
+    assert json.loads(expected)["release_date"] == "2021-06-01T12:30:00"
+
+    plain_content = {"id": "dataset-1", "has_study": ["study-1"]}
+    plain_document = RawBSONDocument(bson.encode(plain_content))
+    assert json.loads(raw_bson_to_json(plain_document)) == plain_content
+
+
+def test_build_aggregation_query_with_fields():
+    """Test that sparse fieldsets are included and only they are looked up"""
+    filters = [FilterOption(key="has_study.type", value="Other")]
+    pipelines = build_aggregation_query(
+        filters=filters,
+        facet_fields={"has_study.type"},
+        fields=["title", "has_sample.name", "has_sample", "type"],
+    )
+    assert [x for x in pipelines if "$lookup" in x] == []
+    assert pipelines[-1] == {
+        "$project": {
+            "_id": 0,
+            "has_sample": 1,
+            "id": 1,
+            "title": 1,
+            "type": 1,
+            SORT_KEY_FIELD: 1,
+        }
+    }
+
+    pipelines = build_aggregation_query(fields=["has_study.type"])
+    [lookup] = [x["$lookup"] for x in pipelines if "$lookup" in x]
+    assert lookup["from"] == "Study"
+    assert get_sparse_fields(["has_study.type"]) == ["has_study.type", "id"]
@@ -0,0 +1,68 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test the business logic for retrieving documents and their references"""
+
+import asyncio
+
+import pytest
+
+from metadata_search_service.config import Config
+from metadata_search_service.core import documents
+from metadata_search_service.dao.utils import InvalidReferenceError
+
+
+def test_expand_references(monkeypatch):
+    """Test that references are retrieved with one query per collection"""
+    queries = []
+
+    class Backend:  # pylint: disable=too-few-public-methods
+        """A search backend that records its queries"""
+
+        async def get_references(self, collection_name, document_ids):
+            queries.append((collection_name, document_ids))
+            return {x: {"id": x} for x in document_ids if x != "missing"}
+
+    monkeypatch.setattr(documents, "get_backend", lambda config: Backend())
+    docs = [
+        {"id": "d1", "has_study": ["s1", "missing"], "has_file": ["f1", "f2", "f3"]},
+        {"id": "d2", "has_study": ["s1"], "has_data_access_policy": "p1"},
+    ]
+    expand = ["has_study", "has_file", "has_data_access_policy"]
+    config = Config(expand_max_items=2)
+
+    async def expand_twice():
+        loader = documents.ReferenceLoader(config)
+        truncated = await documents.expand_references(docs, expand, loader)
+        # shared references are only retrieved once per loader
+        other_docs = [{"id": "d3", "has_study": ["s1"]}]
+        await documents.expand_references(other_docs, expand, loader)
+        assert other_docs[0]["has_study"] == [{"id": "s1"}]
+        return truncated
+
+    truncated = asyncio.run(expand_twice())
+
+    assert truncated == ["has_file"]
+    assert sorted(queries) == [
+        ("DataAccessPolicy", ["p1"]),
+        ("File", ["f1", "f2"]),
+        ("Study", ["s1", "missing"]),
+    ]
+    assert docs[0]["has_study"] == [{"id": "s1"}]
+    assert docs[0]["has_file"] == [{"id": "f1"}, {"id": "f2"}]
+    assert docs[1]["has_data_access_policy"] == {"id": "p1"}
+    assert "has_file" not in docs[1]
+
+    with pytest.raises(InvalidReferenceError):
+        documents.check_expand_fields(["has_attribute"])
@@ -0,0 +1,184 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the in-memory inverted index"""
+
+import pytest
+
+from metadata_search_service.dao.memory_index import (
+    CollectionIndex,
+    MemoryIndex,
+    parse_text_query,
+    tokenize,
+)
+from metadata_search_service.dao.utils import InvalidCursorError, encode_cursor
+from metadata_search_service.models import FilterOption
+
+from ..fixtures import load_test_data
+
+
+def test_tokenize():
+    """Test that texts are split into lower case terms at punctuation"""
+    assert tokenize("DATA_SET_Coverage bias, 4 WG-seq") == [
+        "data",
+        "set",
+        "coverage",
+        "bias",
+        "4",
+        "wg",
+        "seq",
+    ]
+
+
+def test_parse_text_query():
+    """Test that phrases and negated terms are recognized"""
+    terms, phrases, negated = parse_text_query('exome "whole genome" -mouse')
+    assert terms == ["exome", "whole", "genome"]
+    assert phrases == [["whole", "genome"]]
+    assert negated == {"mouse"}
+
+
+def test_score():
+    """Test that documents are ranked by BM25 with field weights"""
+    documents = [
+        {"id": "1", "title": "Cancer", "description": "A study of tumors"},
+        {"id": "2", "title": "Tumors", "description": "A study of cancer"},
+        {"id": "3", "title": "Mice", "description": "Cancer in cancer mice"},
+        {"id": "4", "title": "Sequencing", "description": "Whole genome"},
+    ]
+    scores = CollectionIndex(documents).score("cancer")
+    assert set(scores) == {0, 1, 2}
+    assert max(scores, key=scores.__getitem__) == 2
+
+    scores = CollectionIndex(documents, {"title": 3.0}).score("cancer")
+    assert max(scores, key=scores.__getitem__) == 0
+
+    scores = CollectionIndex(documents, {"title": 0}).score("mice tumors")
+    assert set(scores) == {0, 2}
+
+    index = CollectionIndex(documents)
+    assert set(index.score("cancer -mice")) == {0, 1}
+    assert set(index.score('"genome whole"')) == {3}
+    assert not index.score("unknown")
+
+
+def test_get_documents():
+    """Test searching the test data with text queries and filters"""
+    memory_index = MemoryIndex(load_test_data())
+    facet_fields = {"type", "has_study.type"}
+
+    docs, facets, count, _ = memory_index.get_documents(
+        "Dataset", "sequencing", facet_fields=facet_fields
+    )
+    assert count == len(docs) == 4
+    assert docs[0]["title"].startswith("Exome sequencing")
+    assert [next(iter(x)) for x in facets] == ["has_study__type", "type"]
+    # the studies are looked up for the nested facet field
+    assert all(isinstance(y, dict) for x in docs for y in x["has_study"])
+
+    filters = [FilterOption(key="has_study.type", value="Other")]
+    docs, facets, count, _ = memory_index.get_documents(
+        "Dataset", filters=filters, facet_fields=facet_fields, disjunctive_facets=True
+    )
+    assert count == len(docs) == 2
+    [study_types] = [x["has_study__type"] for x in facets if "has_study__type" in x]
+    assert sum(x["count"] for x in study_types["options"]) == 5
+
+    docs, _, count, _ = memory_index.get_documents(
+        "Dataset", "sequencing", filters=filters
+    )
+    assert count == len(docs) == 2
+
+
+@pytest.mark.parametrize("search_query", ["*", "sequencing"])
+def test_get_documents_with_cursor(search_query):
+    """Test that a cursor continues after the last hit of a page"""
+    memory_index = MemoryIndex(load_test_data())
+    all_docs, _, _, _ = memory_index.get_documents("Dataset", search_query, limit=0)
+
+    docs, _, _, cursor = memory_index.get_documents("Dataset", search_query, limit=2)
+    assert cursor is not None
+    next_docs, _, _, _ = memory_index.get_documents(
+        "Dataset", search_query, limit=2, after=cursor
+    )
+    assert docs + next_docs == all_docs[:4]
+
+    other_query = "*" if search_query != "*" else "sequencing"
+    with pytest.raises(InvalidCursorError):
+        memory_index.get_documents("Dataset", other_query, after=cursor)
+
+
+@pytest.mark.parametrize("direction", [1, -1])
+def test_get_documents_with_sort(direction):
+    """Test that the hits are sorted by a field and paged with a cursor"""
+    memory_index = MemoryIndex(load_test_data())
+    sort = [("title", direction), ("_id", 1)]
+    docs, cursor = [], None
+    while True:
+        page, _, _, cursor = memory_index.get_documents(
+            "Experiment", limit=10, after=cursor, sort=sort
+        )
+        docs.extend(page)
+        if cursor is None:
+            break
+
+    titles = [x["title"] for x in docs]
+    assert titles == sorted(titles, reverse=direction < 0)
+    assert len({x["id"] for x in docs}) == len(docs) == 98
+
+
+def test_get_documents_with_sort_and_skip():
+    """Test that the top hits of a sorted page are the same as in a full sort"""
+    memory_index = MemoryIndex(load_test_data())
+    sort = [("title", -1), ("_id", 1)]
+    all_docs, _, _, _ = memory_index.get_documents("Experiment", limit=0, sort=sort)
+    docs, _, _, _ = memory_index.get_documents(
+        "Experiment", skip=10, limit=5, sort=sort
+    )
+    assert docs == all_docs[10:15]
+
+
+@pytest.mark.parametrize("direction,expected_ids", [(1, ["c"]), (-1, ["b", "a"])])
+def test_get_documents_after_missing_sort_value(monkeypatch, direction, expected_ids):
+    """Test that a cursor continues after a sort value that no document has"""
+    memory_index = MemoryIndex(
+        {
+            "Dataset": [
+                {"id": "a", "title": "A"},
+                {"id": "c", "title": "C"},
+                {"id": "b", "title": "B"},
+            ]
+        }
+    )
+    sort = [("title", direction), ("_id", 1)]
+    memory_index.get_sort_order("Dataset", "title")
+
+    # pages only read the sort value of their last hit, for the next cursor
+    read_positions = []
+    get_sort_values = memory_index.get_sort_values
+
+    def record_sort_values(collection_name, positions, field):
+        read_positions.extend(positions)
+        return get_sort_values(collection_name, positions, field)
+
+    monkeypatch.setattr(memory_index, "get_sort_values", record_sort_values)
+    cursor = encode_cursor(sort=sort, sort_key=["Bb", 1])
+    docs, _, _, _ = memory_index.get_documents(
+        "Dataset", after=cursor, sort=sort, limit=1
+    )
+    assert [x["id"] for x in docs] == expected_ids[:1]
+    assert len(read_positions) == 1
+    docs, _, _, _ = memory_index.get_documents("Dataset", after=cursor, sort=sort)
+    assert [x["id"] for x in docs] == expected_ids
@@ -0,0 +1,219 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test watching the metadata store for changes"""
+
+import asyncio
+from typing import Dict, List
+
+import pytest
+from bson import Timestamp
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from metadata_search_service.config import Config
+from metadata_search_service.core.cache import DataVersions
+from metadata_search_service.pubsub import main
+from metadata_search_service.pubsub.main import (
+    CHANGE_STREAMS_NOT_SUPPORTED,
+    check_collections,
+    watch_metadata_store,
+)
+
+
+class PollingCollection:
+    """A collection that only knows its largest _id."""
+
+    def __init__(self, last_id: int):
+        self.last_id = last_id
+
+    async def find_one(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Get the document with the largest _id"""
+        return {"_id": self.last_id}
+
+
+class PollingDatabase:
+    """A database that reports given statistics for each collection."""
+
+    def __init__(self, stats: Dict[str, Dict]):
+        self.stats = stats
+
+    async def list_collection_names(self):
+        """List the collections"""
+        return list(self.stats)
+
+    async def command(self, name: str, collection_name: str = None):
+        """Answer the ping and collStats commands"""
+        if name == "ping":
+            return {"ok": 1}
+        assert name == "collStats"
+        if collection_name not in self.stats:
+            raise OperationFailure("ns not found", code=26)
+        return self.stats[collection_name]
+
+    def watch(self, *args, **kwargs):
+        """Fail like a standalone server, which has no change streams"""
+        raise OperationFailure("not a replica set", code=CHANGE_STREAMS_NOT_SUPPORTED)
+
+    def __getitem__(self, collection_name: str) -> PollingCollection:
+        return PollingCollection(self.stats[collection_name]["count"])
+
+
+@pytest.mark.asyncio
+async def test_check_collections():
+    """Test that only collections whose fingerprint changed get a new version"""
+    versions = DataVersions()
+    changed: List[str] = []
+    database = PollingDatabase(
+        {"Dataset": {"count": 5, "size": 100}, "Study": {"count": 5, "size": 80}}
+    )
+    fingerprints: Dict = {}
+
+    # all collections are bumped on the first check
+    await check_collections(database, versions, fingerprints)
+    first_versions = versions.get(["Dataset", "Study"])
+    assert first_versions == {"Dataset": "(5, 100, 5)", "Study": "(5, 80, 5)"}
+
+    versions.add_listener(changed.append)
+    await check_collections(database, versions, fingerprints)
+    assert not changed
+
+    database.stats["Study"]["size"] = 90
+    database.stats["File"] = {"count": 1, "size": 10}
+    del database.stats["Dataset"]
+    await check_collections(database, versions, fingerprints)
+    assert versions.get(["Dataset", "File", "Study"]) == {
+        "Dataset": "None",
+        "File": "(1, 10, 1)",
+        "Study": "(5, 90, 5)",
+    }
+    assert changed == ["Dataset", "File", "Study"]
+
+    # other processes that poll the same data agree on the versions
+    other_versions = DataVersions()
+    await check_collections(database, other_versions, {})
+    assert other_versions.get(["File", "Study"]) == versions.get(["File", "Study"])
+
+
+@pytest.mark.asyncio
+async def test_watch_metadata_store_retries_polling(monkeypatch):
+    """Test that polling continues after a transient error of the database"""
+    config = Config(poll_changes=True, change_poll_interval=0.01)
+    database = PollingDatabase({"Dataset": {"count": 5, "size": 100}})
+    checks = []
+    polled_again = asyncio.Event()
+
+    async def get_db_client(config):  # pylint: disable=unused-argument
+        return {config.db_name: database}
+
+    async def flaky_check_collections(*args):
+        checks.append(args)
+        if len(checks) == 1:
+            raise AutoReconnect("connection reset")
+        polled_again.set()
+        await check_collections(*args)
+
+    monkeypatch.setattr(main, "get_db_client", get_db_client)
+    monkeypatch.setattr(main, "check_collections", flaky_check_collections)
+    versions = DataVersions()
+    watcher = asyncio.create_task(watch_metadata_store(config, versions))
+    await asyncio.wait_for(polled_again.wait(), timeout=5)
+    await asyncio.sleep(0)
+    assert not watcher.done()
+    assert versions.watched
+    watcher.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await watcher
+
+
+class ChangeStream:
+    """A change stream that reports the changes that are added to a list."""
+
+    def __init__(self, changes: List[Dict]):
+        self.changes = changes
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.changes:
+            await asyncio.sleep(0.001)
+        return self.changes.pop(0)
+
+
+class ReplicaSetDatabase(PollingDatabase):
+    """A database with change streams, whose operation time moves on."""
+
+    def __init__(self, stats: Dict[str, Dict]):
+        super().__init__(stats)
+        self.change_streams: List[ChangeStream] = []
+        self.operation_time = 100
+
+    async def command(self, name: str, collection_name: str = None):
+        """Answer the ping with the current operation time"""
+        if name == "ping":
+            self.operation_time += 1
+            return {"ok": 1, "operationTime": Timestamp(self.operation_time, 1)}
+        return await super().command(name, collection_name)
+
+    def watch(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Open a change stream"""
+        change_stream = ChangeStream([])
+        self.change_streams.append(change_stream)
+        return change_stream
+
+    def report(self, change: Dict):
+        """Report a change to all open change streams"""
+        for change_stream in self.change_streams:
+            change_stream.changes.append(change)
+
+
+@pytest.mark.asyncio
+async def test_watch_change_stream_seeds_shared_versions(monkeypatch):
+    """Test that processes that start watching at different times agree"""
+    database = ReplicaSetDatabase(
+        {"Dataset": {"count": 5, "size": 100}, "Study": {"count": 5, "size": 80}}
+    )
+
+    async def get_db_client(config):  # pylint: disable=unused-argument
+        return {config.db_name: database}
+
+    async def watch(versions: DataVersions):
+        watcher = asyncio.create_task(watch_metadata_store(Config(), versions))
+        while not versions.watched:
+            await asyncio.sleep(0)
+        return watcher
+
+    monkeypatch.setattr(main, "get_db_client", get_db_client)
+    versions, other_versions = DataVersions(), DataVersions()
+    watchers = [await watch(versions), await watch(other_versions)]
+    collection_names = ["Dataset", "File", "Study"]
+    assert versions.get(collection_names) == other_versions.get(collection_names)
+    assert versions.get(collection_names)["File"] == "None"
+    assert versions.is_approximate(collection_names)
+
+    # changes are versioned by their cluster time, which is exact
+    database.report({"ns": {"coll": "Study"}, "clusterTime": Timestamp(7, 2)})
+    while any(x.changes for x in database.change_streams):
+        await asyncio.sleep(0)
+    assert versions.get(["Study"]) == other_versions.get(["Study"]) == {"Study": "7.2"}
+    assert not versions.is_approximate(["Study"])
+    for watcher in watchers:
+        watcher.cancel()
@@ -0,0 +1,144 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test the business logic for performing search"""
+
+import asyncio
+from typing import Any, Dict, List
+
+from metadata_search_service.config import Config
+from metadata_search_service.core import search
+from metadata_search_service.core.cache import get_search_cache
+from metadata_search_service.dao import utils
+from metadata_search_service.models import FilterOption
+
+
+def test_perform_search_with_whitespace_query(monkeypatch):
+    """Test that queries that only differ in whitespace share their result"""
+    queries = []
+
+    class Backend:  # pylint: disable=too-few-public-methods
+        """A search backend that only finds documents with the query '*'"""
+
+        supports_raw_bson = False
+
+        async def get_documents(
+            self, search_query, **kwargs
+        ):  # pylint: disable=unused-argument
+            queries.append(search_query)
+            docs = [{"id": "1"}] if search_query == "*" else []
+            return docs, [], len(docs), None
+
+    monkeypatch.setattr(search, "get_backend", lambda config: Backend())
+    config = Config()
+    get_search_cache(config).clear()
+    result = asyncio.run(search.perform_search("Dataset", " * ", config=config))
+    assert result["count"] == 1
+    cached_result = asyncio.run(search.perform_search("Dataset", "*", config=config))
+    assert cached_result == result
+    assert queries == ["*"]
+    get_search_cache(config).clear()
+
+
+def test_perform_search_without_bsonjs(monkeypatch):
+    """Test that raw BSON hits are turned off without python-bsonjs"""
+    raw_bson_options = []
+
+    class Backend:  # pylint: disable=too-few-public-methods
+        """A search backend that records whether hits are requested as raw BSON"""
+
+        supports_raw_bson = True
+
+        async def get_documents(
+            self, raw_bson, **kwargs
+        ):  # pylint: disable=unused-argument
+            raw_bson_options.append(raw_bson)
+            return [{"id": "1"}], [], 1, None
+
+    monkeypatch.setattr(search, "get_backend", lambda config: Backend())
+    monkeypatch.setattr(utils, "bsonjs", None)
+    config = Config(raw_bson_hits=True)
+    get_search_cache(config).clear()
+    result = asyncio.run(search.perform_search("Dataset", config=config))
+    assert result["hits"][0]["content"] == {"id": "1"}
+    assert raw_bson_options == [False]
+    get_search_cache(config).clear()
+
+
+def test_perform_batch_search(monkeypatch):
+    """Test that identical searches of a batch are only performed once"""
+    calls = []
+    running = 0
+    max_running = 0
+
+    async def perform_search(config, **kwargs):  # pylint: disable=unused-argument
+        nonlocal running, max_running
+        calls.append(kwargs)
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0)
+        running -= 1
+        return {"document_type": kwargs["document_type"]}
+
+    monkeypatch.setattr(search, "perform_search", perform_search)
+    filters = [FilterOption(key="type", value="Exome sequencing")]
+    searches: List[Dict[str, Any]] = [
+        {"document_type": "Dataset", "filters": filters},
+        {"document_type": "Study"},
+        {"document_type": "File"},
+        {"document_type": "Dataset", "filters": filters},
+    ]
+    config = Config(batch_max_concurrency=2)
+    results = asyncio.run(search.perform_batch_search(searches, config=config))
+
+    assert [x["document_type"] for x in results] == [
+        "Dataset",
+        "Study",
+        "File",
+        "Dataset",
+    ]
+    assert len(calls) == 3
+    assert max_running == 2
+    # all searches of a batch share the loader of referenced documents
+    assert len({id(x["loader"]) for x in calls}) == 1
+
+
+def test_perform_federated_search(monkeypatch):
+    """Test that hits are merged by score and slow collections are left out"""
+    scores = {"Dataset": [3.0, 1.0], "Study": [2.0, 0.5], "File": [2.5]}
+
+    class Backend:  # pylint: disable=too-few-public-methods
+        """A search backend that is slow for all collections without scores"""
+
+        async def get_ranked_documents(
+            self, collection_name, limit, **kwargs
+        ):  # pylint: disable=unused-argument
+            if collection_name not in scores:
+                await asyncio.sleep(10)
+            ranked_docs = [
+                (score, {"id": f"{collection_name}-{i}"})
+                for i, score in enumerate(scores[collection_name])
+            ]
+            return ranked_docs[:limit], len(ranked_docs)
+
+    monkeypatch.setattr(search, "get_backend", lambda config: Backend())
+    config = Config(federated_search_timeout=0.1)
+    result = asyncio.run(
+        search.perform_federated_search("cancer", skip=1, limit=3, config=config)
+    )
+
+    assert [x["id"] for x in result["hits"]] == ["File-0", "Study-0", "Dataset-1"]
+    assert result["count"] == 5
+    assert {x["document_type"] for x in result["counts"]} == set(scores)
+    assert result["partial"]
@@ -0,0 +1,97 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the snapshot file of the in-memory index"""
+
+import asyncio
+
+import pytest
+
+from metadata_search_service.cli import main
+from metadata_search_service.config import Config
+from metadata_search_service.core.utils import DEFAULT_FACET_FIELDS
+from metadata_search_service.dao.memory_index import MemoryIndex, load_memory_index
+from metadata_search_service.dao.snapshot_file import (
+    FacetColumn,
+    SortedKeys,
+    write_snapshot_file,
+)
+from metadata_search_service.models import FilterOption
+
+from ..fixtures import BASE_DIR, load_test_data
+
+
+@pytest.mark.parametrize("search_query", ["*", "sequencing", '"whole genome" -mouse'])
+@pytest.mark.parametrize(
+    "filters",
+    [
+        [],
+        [FilterOption(key="type", value="Exome sequencing")],
+        [FilterOption(key="has_study.type", value="Other")],
+    ],
+)
+def test_same_results_as_memory_index(tmp_path, search_query, filters):
+    """Test that a loaded snapshot returns the same results as the index it was written from"""
+    memory_index = MemoryIndex(load_test_data(), {"title": 2.0})
+    snapshot_path = str(tmp_path / "metadata_store.snapshot")
+    write_snapshot_file(snapshot_path, memory_index, DEFAULT_FACET_FIELDS)
+    snapshot_index = MemoryIndex.from_snapshot_file(snapshot_path)
+
+    for collection_name, facet_fields in DEFAULT_FACET_FIELDS.items():
+        kwargs = dict(
+            search_query=search_query,
+            filters=filters,
+            facet_fields=facet_fields,
+            limit=0,
+            disjunctive_facets=True,
+        )
+        assert snapshot_index.get_documents(
+            collection_name, **kwargs
+        ) == memory_index.get_documents(collection_name, **kwargs)
+
+    collection = snapshot_index.get_collection("Dataset")
+    assert isinstance(collection.positions, SortedKeys)
+    assert (
+        dict(collection.positions) == memory_index.get_collection("Dataset").positions
+    )
+    assert isinstance(collection.facet_columns["type"], FacetColumn)
+
+
+def test_invalid_snapshot_file(tmp_path):
+    """Test that other files are not loaded as a snapshot"""
+    path = tmp_path / "metadata_store.snapshot"
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        MemoryIndex.from_snapshot_file(str(path))
+
+
+def test_load_memory_index_from_snapshot_file(tmp_path):
+    """Test that the snapshot file is built with the command line interface and loaded"""
+    snapshot_path = str(tmp_path / "cli.snapshot")
+    main(
+        [
+            "build-snapshot",
+            "--json-dir",
+            str(BASE_DIR / "test_data"),
+            "--output",
+            snapshot_path,
+        ]
+    )
+    memory_index = asyncio.run(
+        load_memory_index(Config(memory_snapshot_path=snapshot_path))
+    )
+    docs, _, count, _ = memory_index.get_documents("Dataset", "sequencing")
+    assert count == len(docs) == 4
+    assert docs[0]["title"].startswith("Exome sequencing")
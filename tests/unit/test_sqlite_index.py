@@ -0,0 +1,138 @@
+# Copyright 2021 - 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the SQLite search backend"""
+
+import asyncio
+
+import pytest
+
+from metadata_search_service.cli import main
+from metadata_search_service.config import Config
+from metadata_search_service.core.utils import DEFAULT_FACET_FIELDS
+from metadata_search_service.dao.backend import get_backend
+from metadata_search_service.dao.memory_index import MemoryIndex
+from metadata_search_service.dao.sqlite_index import (
+    SQLiteIndex,
+    SQLiteSearchBackend,
+    build_match_expression,
+    build_sqlite_database,
+)
+from metadata_search_service.models import FilterOption
+
+from ..fixtures import BASE_DIR, load_test_data
+
+FIELD_WEIGHTS = {"title": 2.0, "id": 0}
+
+
+@pytest.fixture(name="sqlite_path")
+def fixture_sqlite_path(tmp_path):
+    """Build a database from the test data and return its path"""
+    sqlite_path = str(tmp_path / "metadata_store.sqlite3")
+    build_sqlite_database(
+        sqlite_path, load_test_data(), DEFAULT_FACET_FIELDS, FIELD_WEIGHTS
+    )
+    return sqlite_path
+
+
+def test_build_match_expression():
+    """Test that text queries are translated into full-text queries"""
+    assert build_match_expression('exome "whole genome" -mouse') == (
+        '(((("exome" OR "whole" OR "genome") AND "whole") AND "genome")' ' NOT "mouse")'
+    )
+    assert build_match_expression("-mouse") is None
+
+
+@pytest.mark.parametrize("search_query", ["*", "sequencing", '"whole genome" -mouse'])
+@pytest.mark.parametrize(
+    "filters",
+    [
+        [],
+        [FilterOption(key="type", value="Exome sequencing")],
+        [FilterOption(key="has_study.type", value="Other")],
+    ],
+)
+def test_same_results_as_memory_index(sqlite_path, search_query, filters):
+    """Test that the database returns the same results as the in-memory index"""
+    sqlite_index = SQLiteIndex(sqlite_path, FIELD_WEIGHTS)
+    memory_index = MemoryIndex(load_test_data(), FIELD_WEIGHTS)
+    for collection_name, facet_fields in DEFAULT_FACET_FIELDS.items():
+        kwargs = dict(
+            search_query=search_query,
+            filters=filters,
+            facet_fields=facet_fields,
+            limit=0,
+            disjunctive_facets=True,
+        )
+        docs, facets, count, _ = sqlite_index.get_documents(collection_name, **kwargs)
+        expected = memory_index.get_documents(collection_name, **kwargs)
+        assert facets == expected[1]
+        assert count == expected[2]
+        if search_query == "*":
+            assert docs == expected[0]
+        else:
+            # ranked differently, but the same hits
+            assert sorted(x["id"] for x in docs) == sorted(x["id"] for x in expected[0])
+
+
+def test_unknown_facet_field(sqlite_path):
+    """Test that only the facet fields of the database can be counted"""
+    sqlite_index = SQLiteIndex(sqlite_path)
+    with pytest.raises(ValueError):
+        sqlite_index.get_facets("Dataset", facet_fields={"title"})
+
+
+def test_sqlite_backend(tmp_path):
+    """Test that the database is built with the command line interface and searched"""
+    sqlite_path = str(tmp_path / "cli.sqlite3")
+    main(
+        [
+            "build-sqlite",
+            "--json-dir",
+            str(BASE_DIR / "test_data"),
+            "--output",
+            sqlite_path,
+        ]
+    )
+    backend = get_backend(Config(search_backend="sqlite", sqlite_path=sqlite_path))
+    assert isinstance(backend, SQLiteSearchBackend)
+    assert not backend.supports_raw_bson
+
+    async def use_backend():
+        docs, _, count, cursor = await backend.get_documents(
+            "Dataset", search_query="sequencing", limit=2
+        )
+        assert count == 4
+        next_docs, _, _, _ = await backend.get_documents(
+            "Dataset", search_query="sequencing", limit=2, after=cursor
+        )
+        assert {x["id"] for x in docs}.isdisjoint(x["id"] for x in next_docs)
+
+        exported = [
+            doc
+            async for doc in backend.iter_documents(
+                "Dataset", search_query="sequencing", batch_size=3, fields=["title"]
+            )
+        ]
+        assert exported[:2] == [{"id": x["id"], "title": x["title"]} for x in docs]
+        assert len(exported) == 4
+
+        document = await backend.get_document("Dataset", docs[0]["id"])
+        assert document == docs[0]
+        assert await backend.get_document("Dataset", "unknown") is None
+        references = await backend.get_references("Dataset", [docs[1]["id"], "x"])
+        assert list(references) == [docs[1]["id"]]
+
+    asyncio.run(use_backend())